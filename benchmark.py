@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Scaling benchmark for both generators against synthetic matrices.
+
+generate_circleci_config.py is timed on a synthetic matrix of --distros
+distros × --versions versions, a collection of --branches branches and
+--repos spec projects (temporary directories):
+
+  - generate: building one project's config dict
+  - render: serializing it to YAML (fastyaml, and ruamel for reference)
+  - batch cold: regenerating every project, cache ignored (--jobs workers)
+  - batch warm: the same with a warm fingerprint cache (nothing to emit)
+
+generate_config.py is timed resolving --distros latest releases through a
+fake lastversion answering after --poll-latency seconds, sequentially and
+with --workers threads.
+
+Startup is timed in fresh interpreters: importing each generator (over a
+bare `python -c pass`) and a warm single-project run of
+generate_circleci_config.py, the way hooks call it. The heavy modules each of
+them ended up importing are listed; ruamel/lastversion showing up there is a
+startup regression.
+
+    ./benchmark.py --distros 12 --versions 3 --branches 10 --repos 150 --jobs 8
+
+Compare runs before/after a generator change on the same machine; absolute
+numbers mean little across machines.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate_circleci_config
+import generate_config
+
+# Modules that must not load on the startup paths benchmarked by bench_startup()
+heavy_modules = [
+    "ruamel.yaml",
+    "lastversion",
+    "yaml",
+    "concurrent.futures",
+    "tempfile",
+]
+
+
+def synthetic_matrix(distros, versions, branches):
+    """A matrix.json-shaped dict of the requested size."""
+    return {
+        "distro_defaults": {"os_versions": versions},
+        "distros": {
+            f"distro{i}": {
+                "dist": f"d{i}",
+                "dir": f"distro{i}",
+                "description": f"Distro {i}",
+                "rpmbuilder_name": f"distro{i}",
+                "versions": list(range(100, 100 - versions, -1)),
+                "has_aarch64": i % 3 != 0,
+            }
+            for i in range(distros)
+        },
+        "collections": {
+            "bench": {
+                "branches": {
+                    f"branch{i}": {"description": f"Branch {i}"} for i in range(branches)
+                }
+            }
+        },
+    }
+
+
+def make_projects(root, repos):
+    """Create `repos` spec projects in the bench collection under root."""
+    project_dirs = []
+    for i in range(repos):
+        project_dir = os.path.join(root, f"bench-{i}")
+        os.makedirs(project_dir)
+        with open(os.path.join(project_dir, "settings.yml"), "w") as f:
+            f.write("collection: bench\n")
+        with open(os.path.join(project_dir, f"bench-{i}.spec"), "w") as f:
+            f.write(f"Name: bench-{i}\nVersion: 1.0\nRelease: 1%{{?dist}}\n")
+            if i % 5 == 0:
+                f.write("BuildArch: noarch\n")
+        project_dirs.append(project_dir)
+    return project_dirs
+
+
+def timed(fn, repeat):
+    """(best, median) wall time of `repeat` calls of fn, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+
+def report(name, best, median):
+    print(f"{name:<40} best {best * 1000:10.1f} ms   median {median * 1000:10.1f} ms")
+
+
+def bench_circleci(args):
+    matrix_config = synthetic_matrix(args.distros, args.versions, args.branches)
+    with tempfile.TemporaryDirectory(prefix="buildstrap-bench-") as root:
+        project_dirs = make_projects(root, args.repos)
+        config = generate_circleci_config.generate(project_dirs[1], matrix_config)
+        print(
+            f"generate_circleci_config: {args.distros} distros × {args.versions} versions, "
+            f"{args.branches} branches, {len(config['workflows'])} workflows per project, "
+            f"{args.repos} projects"
+        )
+        report(
+            "generate (one project)",
+            *timed(
+                lambda: generate_circleci_config.generate(project_dirs[1], matrix_config),
+                args.repeat,
+            ),
+        )
+        report(
+            "render (one project)",
+            *timed(lambda: generate_circleci_config.render_config(config), args.repeat),
+        )
+        report(
+            "render through ruamel (one project)",
+            *timed(lambda: generate_circleci_config.render_config_ruamel(config), args.repeat),
+        )
+        cache_file = os.path.join(root, "cache.json")
+        matrix_file = os.path.join(root, "matrix.json")
+        with open(matrix_file, "w") as f:
+            json.dump(matrix_config, f)
+        argv = [
+            "--project-dirs", os.path.join(root, "bench-*"),
+            "--jobs", str(args.jobs),
+            "--matrix", matrix_file,
+            "--cache-file", cache_file,
+        ]
+        devnull = open(os.devnull, "w")
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            cold = timed(lambda: generate_circleci_config.main(argv + ["--force"]), args.repeat)
+            warm = timed(lambda: generate_circleci_config.main(argv), args.repeat)
+        finally:
+            sys.stdout = stdout
+            devnull.close()
+        report(f"batch cold ({args.repos} projects, {args.jobs} jobs)", *cold)
+        report(f"batch warm ({args.repos} projects, {args.jobs} jobs)", *warm)
+
+
+def bench_versions(args):
+    distro_names = [f"distro{i}" for i in range(args.distros)]
+
+    def latest(distro):
+        time.sleep(args.poll_latency)
+        return 100
+
+    print(
+        f"generate_config: {args.distros} distros, "
+        f"{args.poll_latency * 1000:.0f} ms per lastversion poll"
+    )
+    for workers in sorted({1, args.workers}):
+        report(
+            f"resolve latest versions ({workers} workers)",
+            *timed(
+                lambda: generate_config.resolve_latest_versions(
+                    distro_names, cache_file=None, latest=latest, workers=workers
+                ),
+                args.repeat,
+            ),
+        )
+
+
+def run_python(code, repeat):
+    """Best wall time of `repeat` fresh interpreters running code, and its output."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=here, check=True, capture_output=True, text=True
+        ).stdout
+        times.append(time.perf_counter() - start)
+    return min(times), output.strip()
+
+
+def loaded_heavy_modules(code):
+    """Python code running `code`, then printing which heavy_modules got imported."""
+    return (
+        f"import sys\n{code}\n"
+        f"print(' '.join(m for m in {heavy_modules!r} if m in sys.modules) or '-')"
+    )
+
+
+def bench_startup(args):
+    repeat = max(args.repeat, 5)
+    interpreter, _ = run_python("pass", repeat)
+    print(f"startup (over {interpreter * 1000:.1f} ms of bare interpreter startup)")
+    for module in ("generate_circleci_config", "generate_config"):
+        best, loaded = run_python(loaded_heavy_modules(f"import {module}"), repeat)
+        print(f"{'import ' + module:<40} {(best - interpreter) * 1000:10.1f} ms   loads: {loaded}")
+    with tempfile.TemporaryDirectory(prefix="buildstrap-bench-") as root:
+        project_dir = make_projects(root, 1)[0]
+        matrix_file = os.path.join(root, "matrix.json")
+        with open(matrix_file, "w") as f:
+            json.dump(synthetic_matrix(args.distros, args.versions, args.branches), f)
+        argv = [
+            "--project-dir", project_dir,
+            "--matrix", matrix_file,
+            "--cache-file", os.path.join(root, "cache.json"),
+        ]
+        code = loaded_heavy_modules(
+            "import io, contextlib, generate_circleci_config\n"
+            "with contextlib.redirect_stdout(io.StringIO()):\n"
+            f"    generate_circleci_config.main({argv!r})"
+        )
+        run_python(code, 1)  # cold run, fills the fingerprint cache
+        best, loaded = run_python(code, repeat)
+        print(f"{'warm run (one project)':<40} {(best - interpreter) * 1000:10.1f} ms   loads: {loaded}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the generators at scale.")
+    parser.add_argument("--distros", type=int, default=12)
+    parser.add_argument("--versions", type=int, default=3)
+    parser.add_argument("--branches", type=int, default=10)
+    parser.add_argument("--repos", type=int, default=50)
+    parser.add_argument("--jobs", type=int, default=1, help="Batch worker processes.")
+    parser.add_argument("--workers", type=int, default=4, help="lastversion poll threads.")
+    parser.add_argument("--poll-latency", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--only", choices=["circleci", "versions", "startup"], help="Run one benchmark."
+    )
+    args = parser.parse_args(argv)
+
+    if args.only in (None, "circleci"):
+        bench_circleci(args)
+    if args.only in (None, "versions"):
+        bench_versions(args)
+    if args.only in (None, "startup"):
+        bench_startup(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/bin/sh
+# Build phase timings for generate_circleci_config.py (settings.yml `instrument: true`).
+# The build job ships this file itself (as /tmp/build-timings.sh).
+#
+#   build-timings.sh mark PHASE       PHASE starts now (and the previous one ends)
+#   build-timings.sh filter           pass build output through, marking the
+#                                     rpmbuild stages (deps, prep, compile, install,
+#                                     check) and rpmlint as phases as they start, and
+#                                     each rpmbuild's span from %prep to its last Wrote:
+#   build-timings.sh report DIR KEY=VALUE...
+#                                     end the last phase and write DIR/build-timings.json
+#                                     and DIR/junit.xml (one testcase per phase); KEY=VALUE
+#                                     pairs (repo, dist, arch, branch, ...) describe the cell;
+#                                     the specs in the current directory are listed as built,
+#                                     with the seconds of the spans that wrote their packages
+#
+# Phases are "<name> <epoch>" lines in $BUILD_TIMINGS (default /tmp/build-phases);
+# a phase repeated (e.g. one rpmbuild per spec) is summed. Spans are "start <epoch>"
+# and "wrote <epoch> <rpm>" lines in $BUILD_TIMINGS.spans.
+phases=${BUILD_TIMINGS:-/tmp/build-phases}
+spans=$phases.spans
+
+mark() {
+    echo "$1 $(date +%s.%N)" >> "$phases"
+}
+
+filter() {
+    linted=""
+    while IFS= read -r line; do
+        printf '%s\n' "$line"
+        case "$line" in
+            *"Executing(%prep)"*)
+                mark prep
+                echo "start $(date +%s.%N)" >> "$spans"
+                ;;
+            *"Wrote: "*) echo "wrote $(date +%s.%N) ${line##* }" >> "$spans" ;;
+            *"Executing(%build)"*) mark compile ;;
+            *"Executing(%install)"*) mark install ;;
+            *"Executing(%check)"*) mark check ;;
+            *rpmlint*) [ -n "$linted" ] || { linted=1; mark rpmlint; } ;;
+        esac
+    done
+}
+
+# json_string VALUE: VALUE as a JSON string
+json_string() {
+    printf '"%s"' "$(printf '%s' "$1" | sed 's/\\/\\\\/g; s/"/\\"/g')"
+}
+
+report() {
+    dir=$1
+    shift
+    mark end
+    mkdir -p "$dir"
+    # Peak memory and OOM kills of the job's cgroup (v2, else v1)
+    peak=$(cat /sys/fs/cgroup/memory.peak 2> /dev/null \
+        || cat /sys/fs/cgroup/memory/memory.max_usage_in_bytes 2> /dev/null || echo 0)
+    oom=$(cat /sys/fs/cgroup/memory.events /sys/fs/cgroup/memory/memory.oom_control 2> /dev/null \
+        | awk '$1 == "oom_kill" { n += $2 } END { print n + 0 }')
+    {
+        printf '{'
+        for pair; do
+            printf '%s: %s, ' "$(json_string "${pair%%=*}")" "$(json_string "${pair#*=}")"
+        done
+        printf '"specs": [%s], ' "$(ls *.spec 2> /dev/null \
+            | awk '{ printf "%s\"%s\"", (NR > 1 ? ", " : ""), $0 }')"
+        # A span belongs to the spec whose Name: its source RPM (else its shortest
+        # RPM name, the main package's) carries; spans of failed builds wrote
+        # nothing and don't count
+        for spec in *.spec; do
+            [ -f "$spec" ] || continue
+            name=$(rpmspec -q --srpm --qf '%{name}' "$spec" 2> /dev/null) || name=""
+            echo "${name:-${spec%.spec}} $spec"
+        done > "$phases.names"
+        touch "$spans"
+        awk '
+            function flush() {
+                name = (source != "" ? source : shortest)
+                if (end != "" && (name in spec)) {
+                    if (!(spec[name] in took)) order[++n] = spec[name]
+                    took[spec[name]] += end - start
+                }
+                start = end = source = shortest = ""
+            }
+            NR == FNR { spec[$1] = $2; next }
+            $1 == "start" { flush(); start = $2 }
+            $1 == "wrote" && start != "" {
+                end = $2
+                # name-version-release.arch.rpm
+                rpm = $3
+                sub(/.*\//, "", rpm)
+                sub(/\.[^.]*\.rpm$/, "", rpm)
+                sub(/-[^-]*-[^-]*$/, "", rpm)
+                if ($3 ~ /\.src\.rpm$/) source = rpm
+                else if (shortest == "" || length(rpm) < length(shortest)) shortest = rpm
+            }
+            END {
+                flush()
+                printf "\"spec_times\": {"
+                for (i = 1; i <= n; i++)
+                    printf "%s\"%s\": %.3f", (i > 1 ? ", " : ""), order[i], took[order[i]]
+                printf "}, "
+            }' "$phases.names" "$spans"
+        printf '"peak_rss_mb": %d, "oom": %s, ' "$((peak / 1048576))" \
+            "$([ "$oom" -gt 0 ] && echo true || echo false)"
+        awk '
+            NR == 1 { first = $2 }
+            NR > 1 {
+                if (!(name in took)) order[++n] = name
+                took[name] += $2 - start
+            }
+            { name = $1; start = $2 }
+            END {
+                printf "\"duration\": %.3f, \"phases\": {", start - first
+                for (i = 1; i <= n; i++)
+                    printf "%s\"%s\": %.3f", (i > 1 ? ", " : ""), order[i], took[order[i]]
+                printf "}, "
+            }' "$phases"
+        find /output -name '*.rpm' -type f -printf '%s %f\n' 2> /dev/null | awk '
+            {
+                rpms = rpms sprintf("%s{\"name\": \"%s\", \"bytes\": %d}", (NR > 1 ? ", " : ""), $2, $1)
+                bytes += $1
+            }
+            END { printf "\"rpm_count\": %d, \"rpm_bytes\": %d, \"rpms\": [%s]}\n", NR, bytes, rpms }'
+    } > "$dir/build-timings.json"
+    awk -v job="${CIRCLE_JOB:-build}" '
+        NR > 1 {
+            if (!(name in took)) order[++n] = name
+            took[name] += $2 - start
+            total += $2 - start
+        }
+        { name = $1; start = $2 }
+        END {
+            printf "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+            printf "<testsuite name=\"build-phases\" tests=\"%d\" time=\"%.3f\">\n", n, total
+            for (i = 1; i <= n; i++)
+                printf "  <testcase classname=\"%s\" name=\"%s\" time=\"%.3f\"/>\n", job, order[i], took[order[i]]
+            printf "</testsuite>\n"
+        }' "$phases" > "$dir/junit.xml"
+    cat "$dir/build-timings.json"
+}
+
+command=$1
+shift
+case "$command" in
+    mark) mark "$@" ;;
+    filter) filter ;;
+    report) report "$@" ;;
+    *)
+        echo "usage: $0 mark PHASE | filter | report DIR KEY=VALUE..." >&2
+        exit 64
+        ;;
+esac
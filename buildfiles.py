@@ -0,0 +1,66 @@
+"""
+Files shared by the buildstrap entry points.
+
+generate_config.py writes matrix.json, pull_images.py writes the image lock
+and generate_circleci_config.py reads both; all of them write through
+write_if_changed(). This module only holds those helpers, so none of the
+scripts has to import another one (or what that one imports) for them.
+"""
+import json
+import os
+
+# matrix.json shipped next to the scripts (written by generate_config.py)
+default_matrix_file = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "matrix.json"
+)
+
+# rpmbuilder image tag → digest lock written by pull_images.py, next to
+# matrix.json (settings.yml `pin_images: true` pins the build image by it)
+default_image_lock_file = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "rpmbuilder.lock.json"
+)
+
+
+def load_matrix(matrix_file=None):
+    """Read matrix.json (defaults to the copy shipped next to the scripts)."""
+    with open(matrix_file or default_matrix_file, "r") as f:
+        return json.load(f)
+
+
+def load_image_lock(image_lock_file=None):
+    """Read the image lock ({dist: "sha256:..."}); {} if there is none."""
+    try:
+        with open(image_lock_file or default_image_lock_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_if_changed(path, data):
+    """Atomically replace `path` with `data` unless it already holds those bytes.
+
+    Returns True when the file was (re)written.
+    """
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
@@ -0,0 +1,181 @@
+"""
+Lazy expansion of the build matrix into cells.
+
+A cell is one distro version × branch × arch (× any extra axes declared in
+matrix.yml) that gets its own build. expand_cells() streams them in the
+generator's historical order (distro → version → branch → arch → extra axes)
+and applies every matrix/project filter on the way:
+
+  - branch `only_dists` / `only_archs`, per-version `has_plesk`
+  - distro `has_aarch64`
+  - project `exclude` and `dists` allowlist
+  - `restrict`: regexes a run is limited to (--build-dists, ...)
+
+Filter pattern lists are fnmatch-style; each list is compiled once into a
+single regex instead of re-running fnmatch per pattern per combo.
+
+Extra axes are declared in matrix.yml:
+
+    axes:
+      openssl:
+        description: "OpenSSL flavour"
+        values: [system, openssl3]
+
+and enabled per collection (`collections.<name>.axes: [openssl]`) or per
+project (settings.yml `axes: [openssl]`, wins over the collection).
+"""
+import fnmatch
+import re
+from collections import namedtuple
+
+
+class Cell(namedtuple("Cell", "distro dist version branch arch axes")):
+    """One build cell; `axes` is a tuple of (axis name, value) pairs."""
+
+    __slots__ = ()
+
+    @property
+    def dist_version(self):
+        return f"{self.dist}{self.version}"
+
+    @property
+    def suffix(self):
+        """Name suffix for the extra axes, e.g. "-openssl3" (empty without axes)."""
+        return "".join(f"-{value}" for _, value in self.axes)
+
+
+def compile_patterns(patterns):
+    """Compile fnmatch patterns into one regex; None for an empty list."""
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in patterns))
+
+
+def matches_any(regex, values):
+    return any(regex.match(value) for value in values)
+
+
+def resolve_axes(matrix_config, collection_name=None, project_settings=None):
+    """Return [(axis name, values)] enabled for a project, in declaration order."""
+    declared = matrix_config.get("axes") or {}
+    enabled = None
+    if collection_name:
+        collection = matrix_config.get("collections", {}).get(collection_name, {})
+        enabled = collection.get("axes")
+    if project_settings and "axes" in project_settings:
+        enabled = project_settings["axes"]
+    if not enabled:
+        return []
+    unknown = [name for name in enabled if name not in declared]
+    if unknown:
+        raise KeyError(f"axes not declared in matrix.yml: {', '.join(unknown)}")
+    return [(name, list(declared[name]["values"])) for name in declared if name in enabled]
+
+
+def _version_overrides(distro_info, version):
+    # matrix.json stores version_overrides keys as strings (e.g. "10")
+    # since JSON has no integer keys; matrix.yml versions arrive as ints.
+    # Look up by both for safety.
+    version_overrides_all = distro_info.get("version_overrides", {})
+    return (
+        version_overrides_all.get(version)
+        or version_overrides_all.get(str(version))
+        or {}
+    )
+
+
+def distro_setting(distro_info, version, key, defaults=None):
+    """A distro setting for one version: its version_overrides, then the
+    distro's own value, then matrix.yml `distro_defaults` (None if unset)."""
+    overrides = _version_overrides(distro_info, version)
+    if key in overrides:
+        return overrides[key]
+    return distro_info.get(key, (defaults or {}).get(key))
+
+
+def _axis_combos(axes):
+    combos = [()]
+    for name, values in axes:
+        combos = [combo + ((name, value),) for combo in combos for value in values]
+    return combos
+
+
+def compile_restrict(restrict):
+    """Full-match regexes for the "dist", "arch" and "branch" keys of restrict."""
+    return {
+        key: re.compile(pattern)
+        for key, pattern in (restrict or {}).items()
+        if pattern and pattern != ".*"
+    }
+
+
+def expand_cells(distros, branches, archs, exclude=(), allowlist=(), axes=(), restrict=None):
+    """Yield Cell records for every buildable combination.
+
+    `distros` is matrix.json's "distros" mapping, `branches` the resolved
+    branch mapping of the project, `axes` the output of resolve_axes().
+    `restrict` maps "dist" (dist-version, e.g. el9), "arch" and "branch" to
+    regexes the cell's value must match in full, like CircleCI's `matches`.
+    """
+    exclude_re = compile_patterns(exclude)
+    allow_re = compile_patterns(allowlist)
+    restrict = compile_restrict(restrict)
+    restrict_dist = restrict.get("dist")
+    restrict_arch = restrict.get("arch")
+    restrict_branch = restrict.get("branch")
+    branch_filters = {
+        branch: (
+            compile_patterns(branch_config.get("only_dists")) if "only_dists" in branch_config else None,
+            compile_patterns(branch_config.get("only_archs")) if "only_archs" in branch_config else None,
+            "only_dists" in branch_config,
+            "only_archs" in branch_config,
+        )
+        for branch, branch_config in branches.items()
+    }
+    axis_combos = _axis_combos(axes)
+
+    for distro_name, distro_info in distros.items():
+        dist = distro_info.get("dist", distro_name)
+        has_aarch64 = distro_info.get("has_aarch64", True)
+        for version in distro_info.get("versions", []):
+            dist_version = f"{dist}{version}"
+            if restrict_dist and not restrict_dist.fullmatch(dist_version):
+                continue
+            # Per-version distro overrides — primarily the plesk branch axis:
+            # matrix.yml's rhel.version_overrides.10.has_plesk=False excludes
+            # el10-plesk workflows even though el10 ∈ only_dists: ["el*"].
+            has_plesk = _version_overrides(distro_info, version).get(
+                "has_plesk", distro_info.get("has_plesk", False)
+            )
+            for branch, branch_config in branches.items():
+                if restrict_branch and not restrict_branch.fullmatch(branch):
+                    continue
+                # Skip plesk branch on distro versions that don't support Plesk
+                # (e.g. el10). Mirrors generate_config.py:175 logic.
+                if branch_config.get("git_branch", branch) == "plesk" and not has_plesk:
+                    continue
+                only_dists_re, only_archs_re, has_only_dists, has_only_archs = branch_filters[branch]
+                # An empty only_dists/only_archs list matches nothing
+                if has_only_dists and not (only_dists_re and only_dists_re.match(dist_version)):
+                    continue
+                for arch in archs:
+                    # Skip architectures that are not supported
+                    if arch == "aarch64" and not has_aarch64:
+                        continue
+                    if restrict_arch and not restrict_arch.fullmatch(arch):
+                        continue
+                    if has_only_archs and not (only_archs_re and only_archs_re.match(arch)):
+                        continue
+                    # exclude: config can either have exclude: el or el7 or exclude: el7-x86_64 items
+                    # check excludes with wildcard support (e.g., "*", "el*", "amzn*-aarch64")
+                    combo_values = (dist, dist_version, f"{dist_version}-{arch}")
+                    for combo in axis_combos:
+                        values = combo_values
+                        if combo:
+                            values += (f"{dist_version}-{arch}" + "".join(f"-{v}" for _, v in combo),)
+                        if exclude_re and matches_any(exclude_re, values):
+                            continue
+                        # If a `dists:` allowlist is set, drop anything that doesn't match it.
+                        if allow_re and not matches_any(allow_re, values):
+                            continue
+                        yield Cell(distro_name, dist, version, branch, arch, combo)
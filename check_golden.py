@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Golden-output regression check for generate_circleci_config.py.
+
+Every directory in fixtures/projects/ is a synthetic spec project (settings.yml
++ specs) covering one generator feature. Its generated files, rendered against
+the pinned fixtures/matrix.json, must match fixtures/expected/<project>/
+byte for byte; this is what keeps the "byte-identical for non-opting
+consumers" promise honest across generator changes. For the fixtures in
+output_fixtures, the --output config the config.yml setup template
+continues with is recorded as well, and a full run also checks that
+config.yml declares the parameters those configs do.
+
+    ./check_golden.py             # compare, exit 1 on any difference
+    ./check_golden.py --update    # re-record the expected outputs
+    ./check_golden.py plain self  # only some fixtures
+    ./check_golden.py --cross-check  # also render every config through ruamel
+
+Review the diff of fixtures/expected/ after --update: every change in there
+is a change in what ~150 spec repositories get.
+
+--cross-check additionally compares fastyaml's output for every generated
+config with ruamel's (the reference the fast emitter must match byte for
+byte); run it when touching fastyaml.py or the shape of the generated config.
+"""
+import argparse
+import difflib
+import functools
+import os
+import sys
+
+import checkrun
+import fastyaml
+import generate_circleci_config
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+projects_dir = os.path.join(fixtures_dir, "projects")
+expected_dir = os.path.join(fixtures_dir, "expected")
+# Pinned, so that the daily matrix.json refresh doesn't churn the goldens
+fixtures_matrix_file = os.path.join(fixtures_dir, "matrix.json")
+# Likewise the image lock of the `pin_images: true` fixtures
+fixtures_image_lock_file = os.path.join(fixtures_dir, "rpmbuilder.lock.json")
+# Fixtures whose --output config (what the config.yml setup template
+# continues with) is recorded too, as .circleci/generated_config.yml
+output_fixtures = ["plain", "nginx-module-plan"]
+setup_template_file = os.path.join(os.path.dirname(fixtures_dir), "config.yml")
+
+
+def output_config(project, matrix_config, image_lock):
+    """The config the setup template would continue with for a fixture."""
+    return generate_circleci_config.template_continuation(
+        generate_circleci_config.generate(
+            os.path.join(projects_dir, project), matrix_config, image_lock=image_lock
+        )
+    )
+
+
+def render_outputs(project, matrix_config, image_lock):
+    """A fixture's generated files: {relative path: bytes}."""
+    project_dir = os.path.join(projects_dir, project)
+    files = generate_circleci_config.generate_files(
+        project_dir, matrix_config, image_lock=image_lock
+    )
+    if project in output_fixtures:
+        files[".circleci/generated_config.yml"] = generate_circleci_config.render_config(
+            output_config(project, matrix_config, image_lock)
+        )
+    return files
+
+
+def read_expected(project):
+    """The recorded outputs of a fixture: {relative path: bytes}."""
+    files = {}
+    project_expected_dir = os.path.join(expected_dir, project)
+    for root, _, names in os.walk(project_expected_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, project_expected_dir)] = f.read()
+    return files
+
+
+def write_expected(project, files):
+    project_expected_dir = os.path.join(expected_dir, project)
+    for name in read_expected(project):
+        if name not in files:
+            os.unlink(os.path.join(project_expected_dir, name))
+    for name, data in files.items():
+        path = os.path.join(project_expected_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        generate_circleci_config.write_if_changed(path, data)
+
+
+def diff_files(project, expected, actual):
+    """Unified diff lines between the recorded and the generated outputs."""
+    lines = []
+    for name in sorted(set(expected) | set(actual)):
+        if expected.get(name) == actual.get(name):
+            continue
+        lines += difflib.unified_diff(
+            expected.get(name, b"").decode("utf-8").splitlines(keepends=True),
+            actual.get(name, b"").decode("utf-8").splitlines(keepends=True),
+            fromfile=f"expected/{project}/{name}",
+            tofile=f"generated/{project}/{name}",
+        )
+    return lines
+
+
+def cross_check(project, matrix_config, image_lock):
+    """Diff lines between ruamel's and fastyaml's rendering of a fixture's configs."""
+    circleci_config, setup = generate_circleci_config._generate(
+        os.path.join(projects_dir, project), matrix_config, image_lock=image_lock
+    )
+    configs = {"config.yml": circleci_config}
+    if setup:
+        configs = {
+            "config.yml": generate_circleci_config.setup_config(**setup),
+            "continue_config.yml": circleci_config,
+        }
+    if project in output_fixtures:
+        configs["generated_config.yml"] = output_config(project, matrix_config, image_lock)
+    lines = []
+    for name, config in configs.items():
+        try:
+            fast = fastyaml.dump(config)
+        except fastyaml.UnsupportedValue:
+            # written through ruamel anyway
+            continue
+        reference = generate_circleci_config.render_config_ruamel(config).decode("utf-8")
+        lines += difflib.unified_diff(
+            reference.splitlines(keepends=True),
+            fast.splitlines(keepends=True),
+            fromfile=f"ruamel/{project}/{name}",
+            tofile=f"fastyaml/{project}/{name}",
+        )
+    return lines
+
+
+def check_setup_template():
+    """config.yml declares the parameters the --output configs expect it to pass on."""
+    from ruamel.yaml import YAML
+
+    with open(setup_template_file, "r") as f:
+        declared = YAML(typ="safe").load(f)["parameters"]
+    expected = generate_circleci_config.setup_template_parameters
+
+    def signature(parameters):
+        return {
+            name: (parameter["type"], parameter.get("default"))
+            for name, parameter in parameters.items()
+        }
+
+    if signature(declared) != signature(expected):
+        return [
+            f"config.yml parameters {signature(declared)!r} differ from "
+            f"setup_template_parameters {signature(expected)!r}"
+        ]
+    return []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare generated configs of the fixture projects with their goldens."
+    )
+    parser.add_argument("projects", nargs="*", help="Fixture names (default: all).")
+    parser.add_argument(
+        "--update", action="store_true", help="Record the current outputs as expected."
+    )
+    parser.add_argument(
+        "--cross-check",
+        action="store_true",
+        help="Also compare fastyaml's rendering with ruamel's.",
+    )
+    args = parser.parse_args(argv)
+
+    matrix_config = generate_circleci_config.load_matrix(fixtures_matrix_file)
+    image_lock = generate_circleci_config.load_image_lock(fixtures_image_lock_file)
+    projects = args.projects or sorted(os.listdir(projects_dir))
+
+    if args.update:
+        for project in projects:
+            write_expected(project, render_outputs(project, matrix_config, image_lock))
+            print(f"recorded {project}")
+        return 0
+
+    def check(project):
+        actual = render_outputs(project, matrix_config, image_lock)
+        diff = diff_files(project, read_expected(project), actual)
+        if args.cross_check:
+            diff += cross_check(project, matrix_config, image_lock)
+        return ["".join(diff)] if diff else []
+
+    checks = {project: functools.partial(check, project) for project in projects}
+    if not args.projects:
+        checks["setup-template"] = check_setup_template
+    failed = checkrun.run_checks(checks)
+    if failed:
+        print("If the change is intended, re-record with ./check_golden.py --update")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
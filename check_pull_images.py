@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Local checks of pull_images.py with a fake docker on PATH.
+
+The fake docker keeps a "registry" (tag → manifest and digest) and the
+"local" images in a JSON state file and logs every call, so the manifest
+check, skipping up-to-date tags, failed pulls and the digest lock are
+exercised without a docker daemon or network:
+
+    ./check_pull_images.py          # run every check, exit 1 on any failure
+    ./check_pull_images.py lock     # only the checks whose name contains "lock"
+
+The last check feeds the written lock to generate_circleci_config.py and
+expects the pinned digests in the build jobs of a `pin_images: true` project.
+Run it after touching pull_images.py or the image pinning.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import checkrun
+import generate_circleci_config
+
+here = os.path.dirname(os.path.abspath(__file__))
+pin_images_fixture = os.path.join(here, "fixtures", "projects", "pin-images")
+fixtures_matrix_file = os.path.join(here, "fixtures", "matrix.json")
+
+fake_docker = """#!/usr/bin/env python3
+import fcntl, json, os, sys
+
+state_file = os.environ["FAKE_DOCKER_STATE"]
+# pull_images.py runs several of us at once
+lock = open(state_file + ".lock", "w")
+fcntl.flock(lock, fcntl.LOCK_EX)
+with open(state_file) as f:
+    state = json.load(f)
+with open(state_file + ".log", "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+args = sys.argv[1:]
+reference = args[-1]
+image, _, tag = reference.rpartition(":")
+if args[:2] == ["manifest", "inspect"]:
+    if tag not in state["registry"]:
+        sys.exit("no such manifest: " + reference)
+    print(json.dumps({"manifest": state["registry"][tag]["manifest"]}))
+elif args[:2] == ["image", "inspect"]:
+    if tag not in state["local"]:
+        sys.exit("No such image: " + reference)
+    print(json.dumps([image + "@" + state["local"][tag]]))
+elif args[0] == "pull":
+    if tag in state["broken"]:
+        sys.exit("Error response from daemon: received unexpected HTTP status: 500")
+    state["local"][tag] = state["registry"][tag]["digest"]
+    with open(state_file, "w") as f:
+        json.dump(state, f)
+    print(reference)
+else:
+    sys.exit("fake docker: unsupported " + " ".join(args))
+"""
+
+
+def digest(name):
+    return "sha256:" + name.encode("utf-8").hex().ljust(64, "0")[:64]
+
+
+class FakeDocker:
+    """A temporary directory with the fake docker on PATH and its state."""
+
+    def __init__(self, tmp):
+        self.tmp = tmp
+        self.bin_dir = os.path.join(tmp, "bin")
+        os.makedirs(self.bin_dir)
+        with open(os.path.join(self.bin_dir, "docker"), "w") as f:
+            f.write(fake_docker)
+        os.chmod(os.path.join(self.bin_dir, "docker"), 0o755)
+        self.state_file = os.path.join(tmp, "docker-state.json")
+        self.matrix_file = os.path.join(tmp, "matrix.json")
+        self.index_file = os.path.join(tmp, "cache", "rpmbuilder-images.json")
+        self.lock_file = os.path.join(tmp, "rpmbuilder.lock.json")
+        with open(self.matrix_file, "w") as f:
+            json.dump(
+                {
+                    "distros": {
+                        "rhel": {"dist": "el", "versions": [9]},
+                        "fedora": {"dist": "fc", "versions": [44]},
+                    }
+                },
+                f,
+            )
+        self.state = {
+            "registry": {
+                "el9": {"manifest": "m-el9-1", "digest": digest("el9-1")},
+                "fc44": {"manifest": "m-fc44-1", "digest": digest("fc44-1")},
+            },
+            "local": {},
+            "broken": [],
+        }
+        self.save()
+
+    def save(self):
+        with open(self.state_file, "w") as f:
+            json.dump(self.state, f)
+
+    def load(self):
+        with open(self.state_file) as f:
+            self.state = json.load(f)
+
+    def run(self, *args):
+        """(exit status, output, docker calls) of one pull_images.py run."""
+        if os.path.exists(self.state_file + ".log"):
+            os.unlink(self.state_file + ".log")
+        env = {key: value for key, value in os.environ.items() if key != "DOCKER"}
+        env.update(
+            PATH=self.bin_dir + os.pathsep + os.environ["PATH"],
+            FAKE_DOCKER_STATE=self.state_file,
+        )
+        result = subprocess.run(
+            [
+                sys.executable,
+                os.path.join(here, "pull_images.py"),
+                "--matrix",
+                self.matrix_file,
+                "--index-file",
+                self.index_file,
+                "--lock-file",
+                self.lock_file,
+                *args,
+            ],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        try:
+            with open(self.state_file + ".log") as f:
+                calls = f.read().splitlines()
+        except FileNotFoundError:
+            calls = []
+        self.load()
+        return result.returncode, result.stdout + result.stderr, calls
+
+    def lock(self):
+        with open(self.lock_file) as f:
+            return json.load(f)
+
+
+def pulls(calls):
+    return sorted(call.split(":")[-1] for call in calls if call.startswith("pull"))
+
+
+def check_pull_and_skip():
+    """A first run pulls every dist; a second one finds them up to date."""
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        docker = FakeDocker(tmp)
+        status, output, calls = docker.run()
+        if status != 0 or pulls(calls) != ["el9", "fc44"]:
+            problems.append(f"first run: expected el9 and fc44 pulled, got {status} {calls!r}")
+        if docker.lock() != {"el9": digest("el9-1"), "fc44": digest("fc44-1")}:
+            problems.append(f"first run: lock {docker.lock()!r}")
+
+        mtime = os.stat(docker.lock_file).st_mtime_ns
+        status, output, calls = docker.run()
+        if status != 0 or pulls(calls):
+            problems.append(f"second run: expected no pulls, got {status} {calls!r}")
+        if output.count("unchanged") != 2:
+            problems.append(f"second run: expected both unchanged:\n{output}")
+        if os.stat(docker.lock_file).st_mtime_ns != mtime:
+            problems.append("second run: the unchanged lock was rewritten")
+
+        status, output, calls = docker.run("--force")
+        if pulls(calls) != ["el9", "fc44"]:
+            problems.append(f"--force: expected both pulled, got {calls!r}")
+    return problems
+
+
+def check_moved_tag():
+    """A tag whose manifest changed is pulled again and its new digest locked."""
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        docker = FakeDocker(tmp)
+        docker.run()
+        docker.state["registry"]["el9"] = {"manifest": "m-el9-2", "digest": digest("el9-2")}
+        docker.save()
+        status, output, calls = docker.run()
+        if status != 0 or pulls(calls) != ["el9"]:
+            problems.append(f"expected only el9 pulled, got {status} {calls!r}")
+        if docker.lock() != {"el9": digest("el9-2"), "fc44": digest("fc44-1")}:
+            problems.append(f"lock: {docker.lock()!r}")
+        if "Updated" not in output:
+            problems.append(f"the lock update wasn't reported:\n{output}")
+
+        # Removed locally (docker image prune): pulled again despite the manifest
+        docker.state["local"].pop("fc44")
+        docker.save()
+        status, output, calls = docker.run()
+        if pulls(calls) != ["fc44"]:
+            problems.append(f"missing local image: expected fc44 pulled, got {calls!r}")
+
+        # Replaced locally by another image (a local build tagged the same)
+        docker.state["local"]["el9"] = digest("local-build")
+        docker.save()
+        status, output, calls = docker.run()
+        if pulls(calls) != ["el9"]:
+            problems.append(f"replaced local image: expected el9 pulled, got {calls!r}")
+    return problems
+
+
+def check_failed_pull_keeps_lock():
+    """A dist that fails to pull keeps its previous lock entry; the run exits 1."""
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        docker = FakeDocker(tmp)
+        docker.run()
+        docker.state["registry"]["fc44"] = {"manifest": "m-fc44-2", "digest": digest("fc44-2")}
+        docker.state["registry"]["el9"] = {"manifest": "m-el9-2", "digest": digest("el9-2")}
+        docker.state["broken"] = ["fc44"]
+        docker.save()
+        status, output, calls = docker.run()
+        if status != 1 or "FAILED getpagespeed/rpmbuilder:fc44" not in output:
+            problems.append(f"expected exit 1 and fc44 reported:\n{output}")
+        if docker.lock() != {"el9": digest("el9-2"), "fc44": digest("fc44-1")}:
+            problems.append(f"lock: {docker.lock()!r}")
+
+        # The next run retries it
+        docker.state["broken"] = []
+        docker.save()
+        status, output, calls = docker.run()
+        if status != 0 or pulls(calls) != ["fc44"]:
+            problems.append(f"retry: expected fc44 pulled, got {status} {calls!r}")
+    return problems
+
+
+def check_lock_pins_builds():
+    """The generator pins a `pin_images: true` project's builds by the written lock."""
+    with tempfile.TemporaryDirectory() as tmp:
+        docker = FakeDocker(tmp)
+        docker.run()
+        image_lock = generate_circleci_config.load_image_lock(docker.lock_file)
+    circleci_config = generate_circleci_config.generate(
+        pin_images_fixture,
+        generate_circleci_config.load_matrix(fixtures_matrix_file),
+        image_lock=image_lock,
+    )
+    pinned = {}
+    for workflow in circleci_config["workflows"].values():
+        for job in workflow["jobs"]:
+            build = job.get("build") if isinstance(job, dict) else None
+            if build and "image_digest" in build:
+                pinned[build["dist"]] = build["image_digest"]
+    expected = {"el9": "@" + digest("el9-1"), "fc44": "@" + digest("fc44-1")}
+    if pinned != expected:
+        return [f"expected the builds pinned to {expected!r}, got {pinned!r}"]
+    return []
+
+
+checks = {
+    "pull-and-skip": check_pull_and_skip,
+    "moved-tag": check_moved_tag,
+    "failed-pull-keeps-lock": check_failed_pull_keeps_lock,
+    "lock-pins-builds": check_lock_pins_builds,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(checkrun.main(checks, "Check pull_images.py with a fake docker."))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Local checks of rpm-dedupe.sh, the content-addressed deploy helper.
+
+The "build server" is a temporary HOME; RPMs are files of random bytes.
+Besides rpm-dedupe.sh's own `check` / `store`, the deploy step the generator
+emits for settings.yml `deploy: {dedupe: true}` is run as CircleCI would run
+it, with a fake `ssh` on PATH executing the remote command locally:
+
+    ./check_rpm_dedupe.py          # run every check, exit 1 on any failure
+    ./check_rpm_dedupe.py store    # only the checks whose name contains "store"
+
+The deploy step check writes /tmp/rpm-dedupe.sh, /tmp/rpm-manifest and
+/tmp/rpm-upload, like the deploy job does. Run it after touching
+rpm-dedupe.sh or command_dedupe_check().
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+import checkrun
+import generate_circleci_config
+
+rpm_dedupe_script = generate_circleci_config.rpm_dedupe_script
+
+# Runs the remote command of `ssh [options] user@host "command"` locally
+fake_ssh = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o) shift 2 ;;
+        -*) shift ;;
+        *) shift; break ;;
+    esac
+done
+exec sh -c "$*"
+"""
+
+
+def write_rpms(directory, names):
+    """Files of random bytes named like RPMs; {name: content}."""
+    os.makedirs(directory, exist_ok=True)
+    rpms = {}
+    for name in names:
+        rpms[name] = os.urandom(256)
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(rpms[name])
+    return rpms
+
+
+def manifest(directory):
+    return subprocess.run(
+        "sha256sum *.rpm", shell=True, cwd=directory, capture_output=True, text=True, check=True
+    ).stdout
+
+
+def dedupe(home, *args, stdin=""):
+    """(exit status, stdout lines) of rpm-dedupe.sh with `home` as HOME."""
+    result = subprocess.run(
+        ["sh", rpm_dedupe_script, *args],
+        input=stdin,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "HOME": home},
+    )
+    return result.returncode, result.stdout.splitlines()
+
+
+def check_store_and_check():
+    """Unknown RPMs are listed for upload; stored ones are hard-linked instead."""
+    problems = []
+    with tempfile.TemporaryDirectory() as home:
+        build = os.path.join(home, "build")
+        write_rpms(build, ["foo-1.0-1.el9.x86_64.rpm", "foo-devel-1.0-1.el9.x86_64.rpm"])
+        first = os.path.join(home, "incoming", "foo", "el9", "x86_64", "master")
+
+        status, missing = dedupe(home, "check", first, stdin=manifest(build))
+        if status != 0 or sorted(missing) != sorted(os.listdir(build)):
+            problems.append(f"empty store: expected every RPM listed, got {status} {missing!r}")
+
+        # The upload, then `store`
+        for name in os.listdir(build):
+            os.link(os.path.join(build, name), os.path.join(first, name))
+        status, _ = dedupe(home, "store", first)
+        objects = os.path.join(home, "incoming", ".objects")
+        if status != 0 or len(os.listdir(objects)) != 2:
+            problems.append(f"store: expected 2 objects, got {status} {os.listdir(objects)!r}")
+
+        # A rebuild with one changed RPM
+        write_rpms(build, ["foo-devel-1.0-1.el9.x86_64.rpm"])
+        second = os.path.join(home, "incoming", "foo", "el9", "x86_64", "stable")
+        status, missing = dedupe(home, "check", second, stdin=manifest(build))
+        if status != 0 or missing != ["foo-devel-1.0-1.el9.x86_64.rpm"]:
+            problems.append(f"rebuild: expected only foo-devel listed, got {status} {missing!r}")
+        linked = os.path.join(second, "foo-1.0-1.el9.x86_64.rpm")
+        if not os.path.exists(linked):
+            problems.append("rebuild: the known RPM wasn't linked into the incoming directory")
+        elif os.stat(linked).st_nlink < 2:
+            problems.append("rebuild: the known RPM was copied, not hard-linked")
+    return problems
+
+
+def check_usage():
+    """An unknown command fails with EX_USAGE."""
+    with tempfile.TemporaryDirectory() as home:
+        status, _ = dedupe(home, "nosuch")
+    if status != 64:
+        return [f"expected exit status 64, got {status}"]
+    return []
+
+
+def check_deploy_step():
+    """The generated deploy step ships the script over ssh and lists what to upload."""
+    problems = []
+    with tempfile.TemporaryDirectory() as home:
+        bin_dir = os.path.join(home, "bin")
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, "ssh"), "w") as f:
+            f.write(fake_ssh)
+        os.chmod(os.path.join(bin_dir, "ssh"), 0o755)
+
+        build = os.path.join(home, "build")
+        write_rpms(build, ["bar-2.0-1.el9.x86_64.rpm", "bar-debuginfo-2.0-1.el9.x86_64.rpm"])
+        known = os.path.join(home, "known")
+        os.makedirs(known)
+        os.link(
+            os.path.join(build, "bar-2.0-1.el9.x86_64.rpm"),
+            os.path.join(known, "bar-2.0-1.el9.x86_64.rpm"),
+        )
+        dedupe(home, "store", known)
+
+        command = generate_circleci_config.command_dedupe_check(
+            "~/incoming/${CIRCLE_PROJECT_REPONAME}/${DISTRO}/${ARCH}/${CIRCLE_BRANCH}",
+            "sha256sum *.rpm",
+        )
+        env = {
+            **os.environ,
+            "HOME": home,
+            "PATH": bin_dir + os.pathsep + os.environ["PATH"],
+            "GPS_BUILD_USER": "builder",
+            "GPS_BUILD_SERVER": "build.example.com",
+            "CIRCLE_PROJECT_REPONAME": "bar",
+            "DISTRO": "el9",
+            "ARCH": "x86_64",
+            "CIRCLE_BRANCH": "master",
+        }
+        result = subprocess.run(
+            ["bash", "-eo", "pipefail", "-c", str(command)],
+            cwd=build,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            return [f"the step failed ({result.returncode}): {result.stderr.strip()}"]
+        with open("/tmp/rpm-upload") as f:
+            upload = f.read().split()
+        if upload != ["bar-debuginfo-2.0-1.el9.x86_64.rpm"]:
+            problems.append(f"expected only the debuginfo RPM to upload, got {upload!r}")
+        installed = os.path.join(home, ".buildstrap", "rpm-dedupe.sh")
+        with open(rpm_dedupe_script, "rb") as f, open(installed, "rb") as g:
+            if f.read() != g.read():
+                problems.append("the script installed on the server differs from rpm-dedupe.sh")
+        if not os.path.exists(
+            os.path.join(home, "incoming", "bar", "el9", "x86_64", "master", "bar-2.0-1.el9.x86_64.rpm")
+        ):
+            problems.append("the known RPM wasn't linked into the incoming directory")
+    return problems
+
+
+checks = {
+    "store-and-check": check_store_and_check,
+    "usage": check_usage,
+    "deploy-step": check_deploy_step,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(checkrun.main(checks, "Check rpm-dedupe.sh locally."))
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Local checks of trigger_pipelines.py against a stub CircleCI API.
+
+A threaded http.server on 127.0.0.1 answers the pipeline POSTs from a
+per-repository script (201, 429 with Retry-After, 5xx, 404, a dropped
+connection), so retries, backoff, unknown outcomes, rate limiting,
+keep-alive reuse and the journal resume are exercised without touching
+circleci.com:
+
+    ./check_trigger_pipelines.py           # run every check, exit 1 on any failure
+    ./check_trigger_pipelines.py journal   # only the checks whose name contains "journal"
+
+Run it after touching trigger_pipelines.py.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import checkrun
+import trigger_pipelines
+
+# Closes the connection without answering
+DROP = "drop"
+
+
+class StubAPI:
+    """POST /api/v2/project/gh/<org>/<repo>/pipeline answered from `script`.
+
+    `script` maps repo names to a list of answers, (status, headers) or
+    DROP, given in turn; the last one repeats. Every request is recorded as
+    {"repo", "headers", "body", "port", "at"}.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.requests = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                repo = self.path.split("/")[-2]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stub.lock:
+                    answers = stub.script.get(repo, [(201, {})])
+                    attempt = sum(1 for request in stub.requests if request["repo"] == repo)
+                    stub.requests.append(
+                        {
+                            "repo": repo,
+                            "headers": dict(self.headers),
+                            "body": json.loads(body or b"{}"),
+                            "port": self.client_address[1],
+                            "at": time.monotonic(),
+                        }
+                    )
+                answer = answers[min(attempt, len(answers) - 1)]
+                if answer == DROP:
+                    self.close_connection = True
+                    return
+                status, headers = answer
+                if 200 <= status < 300:
+                    payload = {"number": attempt + 1, "id": f"{repo}-{attempt + 1}"}
+                else:
+                    payload = {"message": f"stub {status}"}
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        ).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def attempts(self, repo):
+        return [request for request in self.requests if request["repo"] == repo]
+
+
+def repos(*names):
+    return [(f"gh/GetPageSpeed/{name}", None) for name in names]
+
+
+def outcome(outcomes, name):
+    return outcomes[(f"gh/GetPageSpeed/{name}", None)]
+
+
+def trigger(stub, entries, **kwargs):
+    kwargs = {
+        "base_url": stub.base_url,
+        "token": "stub-token",
+        "rate": 1000.0,
+        "backoff": 0.01,
+        "report": lambda line: None,
+        **kwargs,
+    }
+    return trigger_pipelines.trigger_all(entries, **kwargs)
+
+
+def check_request():
+    """The POST carries the token, branch and parameters."""
+    with StubAPI({}) as stub:
+        outcomes = trigger(
+            stub, [("gh/GetPageSpeed/foo-rpm", "stable")], parameters={"build_dists": "fc44"}
+        )
+    problems = []
+    if outcomes[("gh/GetPageSpeed/foo-rpm", "stable")]["status"] != "triggered":
+        problems.append(f"expected triggered, got {outcomes!r}")
+    request = stub.requests[0]
+    if request["headers"].get("Circle-Token") != "stub-token":
+        problems.append(f"Circle-Token header: {request['headers'].get('Circle-Token')!r}")
+    if request["body"] != {"branch": "stable", "parameters": {"build_dists": "fc44"}}:
+        problems.append(f"body: {request['body']!r}")
+    return problems
+
+
+def check_retries():
+    """429/5xx are retried, other errors aren't; lost answers are "unknown"."""
+    script = {
+        "throttled": [(429, {"Retry-After": "0.2"}), (201, {})],
+        "flaky": [(503, {}), (502, {}), (201, {})],
+        "dropped": [DROP, (201, {})],
+        "gateway": [(504, {}), (201, {})],
+        "missing": [(404, {})],
+        "down": [(500, {})],
+    }
+    with StubAPI(script) as stub:
+        outcomes = trigger(stub, repos(*script), retries=3, concurrency=6)
+    problems = []
+    for name, status, attempts in (
+        ("throttled", "triggered", 2),
+        ("flaky", "triggered", 3),
+        ("dropped", "unknown", 1),
+        ("gateway", "unknown", 1),
+        ("missing", "failed", 1),
+        ("down", "failed", 4),
+    ):
+        result = outcome(outcomes, name)
+        if result["status"] != status or result["attempts"] != attempts:
+            problems.append(f"{name}: expected {status} after {attempts} attempts, got {result!r}")
+        if len(stub.attempts(name)) != attempts:
+            problems.append(f"{name}: the stub got {len(stub.attempts(name))} requests")
+    throttled = stub.attempts("throttled")
+    if len(throttled) == 2 and throttled[1]["at"] - throttled[0]["at"] < 0.2:
+        problems.append("throttled: retried before its Retry-After (0.2s)")
+    return problems
+
+
+def check_unsent():
+    """A request that never went out (connection refused) is retried."""
+    with socket.socket() as sock:
+        # A port nobody listens on once it's closed
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    outcomes = trigger_pipelines.trigger_all(
+        repos("foo-rpm"),
+        base_url=f"http://127.0.0.1:{port}",
+        token="stub-token",
+        retries=2,
+        backoff=0.01,
+        report=lambda line: None,
+    )
+    result = outcome(outcomes, "foo-rpm")
+    if result["status"] != "failed" or result["attempts"] != 3:
+        return [f"expected failed after 3 attempts, got {result!r}"]
+    return []
+
+
+def check_rate_limit():
+    """The token bucket paces requests: 10 at 20/s with a burst of 1 take ~0.45s."""
+    with StubAPI({}) as stub:
+        start = time.monotonic()
+        trigger(stub, repos(*(f"repo{i}" for i in range(10))), rate=20.0, burst=1, concurrency=5)
+        elapsed = time.monotonic() - start
+    if elapsed < 0.4:
+        return [f"10 requests at 20/s took only {elapsed:.2f}s"]
+    return []
+
+
+def check_keep_alive():
+    """Each worker thread reuses its connection."""
+    with StubAPI({}) as stub:
+        trigger(stub, repos(*(f"repo{i}" for i in range(20))), concurrency=2)
+    ports = {request["port"] for request in stub.requests}
+    if len(ports) > 2:
+        return [f"20 requests on 2 workers used {len(ports)} connections"]
+    return []
+
+
+def check_journal():
+    """A rerun skips what the journal has as triggered or unknown and retries the rest."""
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        journal_file = os.path.join(tmp, "trigger-pipelines.jsonl")
+        with StubAPI({"broken": [(500, {})], "dropped": [DROP]}) as stub:
+            trigger(
+                stub, repos("foo-rpm", "broken", "dropped"), retries=0, journal_file=journal_file
+            )
+        with StubAPI({}) as stub:
+            outcomes = trigger(
+                stub, repos("foo-rpm", "broken", "dropped"), journal_file=journal_file
+            )
+        if outcome(outcomes, "foo-rpm")["status"] != "skipped" or stub.attempts("foo-rpm"):
+            problems.append(f"rerun: foo-rpm wasn't skipped: {outcome(outcomes, 'foo-rpm')!r}")
+        if outcome(outcomes, "broken")["status"] != "triggered":
+            problems.append(f"rerun: broken wasn't retried: {outcome(outcomes, 'broken')!r}")
+        if outcome(outcomes, "dropped") != {"status": "skipped", "journal": "unknown"}:
+            problems.append(
+                f"rerun: dropped (unknown) wasn't skipped: {outcome(outcomes, 'dropped')!r}"
+            )
+
+        with StubAPI({}) as stub:
+            outcomes = trigger(
+                stub,
+                repos("foo-rpm"),
+                parameters={"build_dists": "fc44"},
+                journal_file=journal_file,
+            )
+        if outcome(outcomes, "foo-rpm")["status"] != "triggered":
+            problems.append("other parameters: foo-rpm was skipped")
+
+        with StubAPI({}) as stub:
+            outcomes = trigger(stub, repos("foo-rpm"), journal_file=journal_file, force=True)
+        if outcome(outcomes, "foo-rpm")["status"] != "triggered":
+            problems.append("--force: foo-rpm was skipped")
+
+        # A line cut short by an interrupted run doesn't break the resume
+        with open(journal_file, "a") as f:
+            f.write('{"repo": "gh/GetPageSpeed/fo')
+        if ("gh/GetPageSpeed/broken", trigger_pipelines.request_key(None, {})) not in (
+            trigger_pipelines.load_journal(journal_file)
+        ):
+            problems.append("a truncated last line lost the journal")
+    return problems
+
+
+def check_parameters():
+    """NAME=VALUE is a string, NAME:=JSON a boolean or integer."""
+    problems = []
+    for value, expected in (
+        ("build_dists=8", ("build_dists", "8")),
+        ("build_dists=fc44|el9", ("build_dists", "fc44|el9")),
+        ("run_tests:=false", ("run_tests", False)),
+        ("jobs:=4", ("jobs", 4)),
+    ):
+        parsed = trigger_pipelines.parse_parameter(value)
+        if parsed != expected:
+            problems.append(f"{value}: expected {expected!r}, got {parsed!r}")
+    for value in ("build_dists", "=fc44", "jobs:=[4]"):
+        try:
+            trigger_pipelines.parse_parameter(value)
+        except argparse.ArgumentTypeError:
+            continue
+        problems.append(f"{value}: accepted")
+    return problems
+
+
+checks = {
+    "request": check_request,
+    "retries": check_retries,
+    "unsent": check_unsent,
+    "rate-limit": check_rate_limit,
+    "keep-alive": check_keep_alive,
+    "journal": check_journal,
+    "parameters": check_parameters,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(checkrun.main(checks, "Check trigger_pipelines.py against a stub API."))
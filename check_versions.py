@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Offline checks of generate_config.py's lastversion polling.
+
+A fake `latest` callable stands in for lastversion, so the concurrency,
+per-distro timeouts, the TTL cache and the last-known-good fallback are
+exercised without any network access:
+
+    ./check_versions.py           # run every check, exit 1 on any failure
+    ./check_versions.py timeout   # only the checks whose name contains "timeout"
+
+Run it after touching the polling, caching or fallback code.
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import checkrun
+import generate_config
+
+
+class FakeLatest:
+    """Stands in for latest_release(): {distro: version, exception or seconds to hang}.
+
+    Records every distro it was asked about.
+    """
+
+    def __init__(self, answers, delay=0.0):
+        self.answers = answers
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, distro):
+        with self.lock:
+            self.calls.append(distro)
+        time.sleep(self.delay)
+        answer = self.answers[distro]
+        if isinstance(answer, Exception):
+            raise answer
+        if isinstance(answer, float):
+            # Hangs (well past any timeout the checks use)
+            time.sleep(answer)
+            return 0
+        return answer
+
+
+def check_poll_timeout():
+    """A hung and a failing poll come back as exceptions, the others as versions."""
+    latest = FakeLatest({"fedora": 44, "hung": 5.0, "broken": RuntimeError("HTTP 500")})
+    start = time.monotonic()
+    results = generate_config.poll_latest_versions(
+        ["fedora", "hung", "broken"], latest=latest, workers=3, timeout=0.5
+    )
+    elapsed = time.monotonic() - start
+    problems = []
+    if results["fedora"] != 44:
+        problems.append(f"fedora: expected 44, got {results['fedora']!r}")
+    if not isinstance(results["hung"], TimeoutError):
+        problems.append(f"hung: expected a TimeoutError, got {results['hung']!r}")
+    if not isinstance(results["broken"], RuntimeError):
+        problems.append(f"broken: expected the RuntimeError, got {results['broken']!r}")
+    if elapsed > 2:
+        problems.append(f"a hung poll held the run for {elapsed:.1f}s (timeout 0.5s)")
+    return problems
+
+
+def check_poll_concurrency():
+    """Polls run on the worker pool, not one after the other."""
+    distros = ["fedora", "amazonlinux", "opensuse-leap", "sles"]
+    latest = FakeLatest({distro: 1 for distro in distros}, delay=0.3)
+    start = time.monotonic()
+    generate_config.poll_latest_versions(distros, latest=latest, workers=4, timeout=5)
+    elapsed = time.monotonic() - start
+    if elapsed > 0.9:
+        return [f"4 polls of 0.3s on 4 workers took {elapsed:.1f}s"]
+    return []
+
+
+def check_cache_ttl():
+    """Fresh cache entries aren't polled again; a failed poll keeps the cached entry."""
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_file = os.path.join(tmp, "lastversion.json")
+
+        latest = FakeLatest({"fedora": 44, "amazonlinux": 2023})
+        versions, failures = generate_config.resolve_latest_versions(
+            ["fedora", "amazonlinux"], cache_file=cache_file, ttl=3600, latest=latest
+        )
+        if versions != {"fedora": 44, "amazonlinux": 2023} or failures:
+            problems.append(f"first run: got {versions!r}, failures {failures!r}")
+
+        latest = FakeLatest({"fedora": 45, "amazonlinux": 2025})
+        versions, _ = generate_config.resolve_latest_versions(
+            ["fedora", "amazonlinux"], cache_file=cache_file, ttl=3600, latest=latest
+        )
+        if latest.calls or versions != {"fedora": 44, "amazonlinux": 2023}:
+            problems.append(
+                f"within the TTL: polled {latest.calls!r}, got {versions!r} instead of the cache"
+            )
+
+        latest = FakeLatest({"fedora": 45, "amazonlinux": RuntimeError("HTTP 503")})
+        versions, failures = generate_config.resolve_latest_versions(
+            ["fedora", "amazonlinux"], cache_file=cache_file, ttl=0, latest=latest
+        )
+        if versions != {"fedora": 45} or list(failures) != ["amazonlinux"]:
+            problems.append(f"expired: got {versions!r}, failures {failures!r}")
+        cached = generate_config.load_version_cache(cache_file)
+        if cached.get("amazonlinux", {}).get("version") != 2023:
+            problems.append(f"a failed poll replaced the cached entry: {cached!r}")
+        if cached.get("fedora", {}).get("version") != 45:
+            problems.append(f"a new version wasn't cached: {cached!r}")
+    return problems
+
+
+def check_last_known_good():
+    """A failed distro keeps the previous matrix.json's versions, or stops the run."""
+    distros_config = {
+        "distro_defaults": {"os_versions": 2},
+        "distros": {
+            "fedora": {"dist": "fc", "include_rolling_release": True},
+            "amazonlinux": {"dist": "amzn"},
+            "sles": {"dist": "sles"},
+            "rhel": {"dist": "el", "versions_check": False, "versions": [8, 9]},
+        },
+    }
+    previous_distros = {"amazonlinux": {"versions": [2023, 2]}}
+    failures = {"amazonlinux": TimeoutError("no answer"), "sles": TimeoutError("no answer")}
+    with contextlib.redirect_stdout(io.StringIO()):
+        missing = generate_config.apply_latest_versions(
+            distros_config, {"fedora": 44}, failures, previous_distros
+        )
+    distros = distros_config["distros"]
+    problems = []
+    if distros["fedora"].get("versions") != [44, 43, 45]:
+        problems.append(f"fedora: expected [44, 43, 45], got {distros['fedora'].get('versions')!r}")
+    if distros["amazonlinux"].get("versions") != [2023, 2]:
+        problems.append(
+            f"amazonlinux: expected the previous [2023, 2], got "
+            f"{distros['amazonlinux'].get('versions')!r}"
+        )
+    if distros["rhel"]["versions"] != [8, 9]:
+        problems.append(f"rhel (versions_check: false) changed: {distros['rhel']['versions']!r}")
+    if missing != ["sles"]:
+        problems.append(f"expected sles (no previous versions) to be missing, got {missing!r}")
+    return problems
+
+
+checks = {
+    "poll-timeout": check_poll_timeout,
+    "poll-concurrency": check_poll_concurrency,
+    "cache-ttl": check_cache_ttl,
+    "last-known-good": check_last_known_good,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(checkrun.main(checks, "Check lastversion polling against a fake."))
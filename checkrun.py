@@ -0,0 +1,43 @@
+"""
+The runner shared by the check_*.py scripts.
+
+A check is a function returning a list of problems (strings, empty when it
+passes). run_checks() runs them in order and prints an ok/FAIL line per
+check, with the problems of a failed one indented above its line, and a
+summary when anything failed; main() is the `./check_x.py [names]` command
+line of the scripts.
+"""
+import argparse
+import textwrap
+
+
+def run_checks(checks, names=()):
+    """Run `checks` ({name: check}); returns the names of the failed ones.
+
+    Only the checks whose name contains one of `names` run (all of them when
+    `names` is empty).
+    """
+    selected = [
+        name for name in checks if not names or any(part in name for part in names)
+    ]
+    failed = []
+    for name in selected:
+        problems = checks[name]()
+        for problem in problems:
+            print(textwrap.indent(str(problem).rstrip("\n"), "  "))
+        print(f"{'FAIL' if problems else 'ok'} {name}")
+        if problems:
+            failed.append(name)
+    if failed:
+        print(f"{len(failed)} of {len(selected)} checks failed: {', '.join(failed)}")
+    return failed
+
+
+def main(checks, description, argv=None):
+    """Parse `[names]` from `argv` and run the checks; the exit status."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "names", nargs="*", help="Only run checks whose name contains these."
+    )
+    args = parser.parse_args(argv)
+    return 1 if run_checks(checks, args.names) else 0
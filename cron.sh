@@ -8,17 +8,26 @@ git pull >/dev/null
 git clean -fX >/dev/null
 
 git checkout main
-./generate_config.py
-git add --all .
-git commit -m "Updated matrix.json from lastversion poll [skip ci]"
+# artifacts the run changed, one path per line (../rpmbuilder/... for the
+# rpmbuilder project); nothing to commit or push on days nothing changed
+changed=$(mktemp)
+trap 'rm -f "$changed"' EXIT
+./generate_config.py --changed-list "$changed" || exit 1
 
-# push all branches
-git push --force --all origin
-git checkout main
+if grep -qv '^\.\./rpmbuilder/' "$changed"; then
+  git add --all .
+  git commit -m "Updated matrix.json from lastversion poll [skip ci]"
+
+  # push all branches
+  git push --force --all origin
+  git checkout main
+fi
 
 # navigate to ../rpmbuilder and commit any changes
-cd ../rpmbuilder || exit 1
-git pull --quiet
-git add --all .
-git commit -m "Updated from buildstrap"
-git push --force --all origin
+if grep -q '^\.\./rpmbuilder/' "$changed"; then
+  cd ../rpmbuilder || exit 1
+  git pull --quiet
+  git add --all .
+  git commit -m "Updated from buildstrap"
+  git push --force --all origin
+fi
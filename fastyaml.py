@@ -0,0 +1,704 @@
+"""
+Fast YAML emitter for the configs generate_circleci_config.py writes.
+
+ruamel's round-trip dumper builds a representer node graph, serializes it to
+an event stream and runs every event through a general-purpose emitter state
+machine; for collection configs (thousands of lines) that is by far the most
+expensive part of a run. The configs only ever hold block mappings and
+sequences of str/int/float/bool/None, plus block scalars for the shell
+commands (LiteralString/FoldedString below, or ruamel's LiteralScalarString
+and FoldedScalarString), so this module walks them directly and writes the
+text in one pass. It imports nothing heavy: most runs never load ruamel.
+
+The output must be byte-identical to what
+
+    yaml = YAML()
+    yaml.default_flow_style = False
+    yaml.representer.ignore_aliases = lambda *args: True
+    yaml.dump(data, stream)
+
+writes, so the scalar analysis, style choice, line folding and indentation
+below are ports of ruamel.yaml's emitter (emitter.py, resolver.py) for that
+configuration: best width 80, 2-space indents, block sequences not indented
+under their key, allow_unicode, YAML 1.2 implicit resolvers. Anything outside
+that shape (tuples, anything loaded from settings.yml as CommentedMap,
+ScalarInt & co., other scalar styles, keys that would need `? `) raises UnsupportedValue and the
+caller falls back to ruamel. check_golden.py --cross-check compares the two.
+"""
+import re
+from functools import lru_cache
+
+best_width = 80
+best_indent = 2
+max_simple_key_length = 128
+
+line_breaks = "\n\x85\u2028\u2029"
+whitespace_chars = "\0 \t\r\n\x85\u2028\u2029"
+
+# YAML 1.2 implicit resolvers (ruamel.yaml resolver.py): a plain scalar that
+# matches one of these would not load back as a string. (tag, pattern (re.X),
+# first characters); compiled on first use, see resolvers()
+implicit_resolvers = [
+    ("bool", r"^(?:true|True|TRUE|false|False|FALSE)$", "tTfF"),
+    (
+        "float",
+        r"""^(?:
+             [-+]?(?:[0-9][0-9_]*)\.[0-9_]*(?:[eE][-+]?[0-9]+)?
+            |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
+            |[-+]?\.[0-9_]+(?:[eE][-+][0-9]+)?
+            |[-+]?\.(?:inf|Inf|INF)
+            |\.(?:nan|NaN|NAN))$""",
+        "-+0123456789.",
+    ),
+    (
+        "int",
+        r"""^(?:[-+]?0b[0-1_]+
+            |[-+]?0o?[0-7_]+
+            |[-+]?[0-9_]+
+            |[-+]?0x[0-9a-fA-F_]+)$""",
+        "-+0123456789",
+    ),
+    ("merge", r"^(?:<<)$", "<"),
+    ("null", r"^(?: ~ |null|Null|NULL | )$", "~nN"),
+    (
+        "timestamp",
+        r"""^(?:[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]
+            |[0-9][0-9][0-9][0-9] -[0-9][0-9]? -[0-9][0-9]?
+            (?:[Tt]|[ \t]+)[0-9][0-9]?
+            :[0-9][0-9] :[0-9][0-9] (?:\.[0-9]*)?
+            (?:[ \t]*(?:Z|[-+][0-9][0-9]?(?::[0-9][0-9])?))?)$""",
+        "0123456789",
+    ),
+    ("value", r"^(?:=)$", "="),
+    ("yaml", r"^(?:!|&|\*)$", "!&*"),
+]
+
+escape_replacements = {
+    "\0": "0",
+    "\x07": "a",
+    "\x08": "b",
+    "\x09": "t",
+    "\x0A": "n",
+    "\x0B": "v",
+    "\x0C": "f",
+    "\x0D": "r",
+    "\x1B": "e",
+    '"': '"',
+    "\\": "\\",
+    "\x85": "N",
+    "\xA0": "_",
+    "\u2028": "L",
+    "\u2029": "P",
+}
+
+
+class UnsupportedValue(ValueError):
+    """The data holds something only ruamel knows how to emit."""
+
+
+class LiteralString(str):
+    """A str written as a literal block scalar (`|`), like ruamel's
+    LiteralScalarString, without having to import ruamel to build one."""
+
+    __slots__ = ()
+
+
+class FoldedString(str):
+    """A str written as a folded block scalar (`>`), like ruamel's
+    FoldedScalarString."""
+
+    __slots__ = ()
+
+
+@lru_cache(maxsize=None)
+def resolvers():
+    """implicit_resolvers, compiled."""
+    return [(tag, re.compile(pattern, re.X), first) for tag, pattern, first in implicit_resolvers]
+
+
+def resolve(value):
+    """The tag a plain scalar `value` would load as."""
+    if value == "":
+        return "null"
+    for tag, regexp, first in resolvers():
+        if value[0] in first and regexp.match(value):
+            return tag
+    return "str"
+
+
+def is_ruamel_type(data, *names):
+    """Whether data is exactly one of ruamel.yaml's classes `names` (checked
+    by name, so that emitting doesn't need ruamel imported)."""
+    cls = type(data)
+    return cls.__name__ in names and cls.__module__.startswith("ruamel.yaml.")
+
+
+def represent_scalar(data):
+    """(tag, text, style) of a scalar, as ruamel's RoundTripRepresenter has it."""
+    cls = type(data)
+    if cls is str:
+        return "str", data, None
+    if cls is LiteralString:
+        return "str", str(data), "|"
+    if cls is FoldedString:
+        return "str", str(data), ">"
+    if is_ruamel_type(data, "LiteralScalarString", "FoldedScalarString"):
+        if getattr(data, "fold_pos", None) or getattr(data, "comment", None):
+            raise UnsupportedValue("folded or commented block scalars")
+        if data.yaml_anchor(any=True) is not None:
+            raise UnsupportedValue("anchored scalars")
+        return "str", str(data), "|" if cls.__name__ == "LiteralScalarString" else ">"
+    if cls is bool:
+        return "bool", "true" if data else "false", None
+    if cls is int:
+        return "int", str(data), None
+    if cls is float:
+        if data != data:
+            text = ".nan"
+        elif data in (float("inf"), float("-inf")):
+            text = ".inf" if data > 0 else "-.inf"
+        else:
+            text = repr(data).lower()
+        return "float", text, None
+    if data is None:
+        # ruamel writes "" only for nodes it has seen before, which never
+        # happens with aliases ignored
+        return "null", "null", None
+    # tuples, ScalarInt & co. (formatting kept from settings.yml), quoted strings...
+    raise UnsupportedValue(f"{cls.__name__} values")
+
+
+class ScalarAnalysis:
+    __slots__ = ("empty", "multiline", "allow_block_plain", "allow_single_quoted")
+
+
+def analyze_scalar(scalar):
+    """ruamel Emitter.analyze_scalar() for allow_unicode=True, block context."""
+    analysis = ScalarAnalysis()
+    if not scalar:
+        analysis.empty = True
+        analysis.multiline = False
+        analysis.allow_block_plain = True
+        analysis.allow_single_quoted = True
+        return analysis
+
+    block_indicators = False
+    has_line_breaks = False
+    special_characters = False
+    leading_space = leading_break = False
+    trailing_space = trailing_break = False
+    break_space = space_break = False
+
+    if scalar.startswith("---") or scalar.startswith("..."):
+        block_indicators = True
+
+    preceded_by_whitespace = True
+    followed_by_whitespace = len(scalar) == 1 or scalar[1] in whitespace_chars
+    previous_space = False
+    previous_break = False
+    last = len(scalar) - 1
+
+    for index, ch in enumerate(scalar):
+        if index == 0:
+            if ch in "#,[]{}&*!|>'\"%@`":
+                block_indicators = True
+            if ch in "?:" and followed_by_whitespace:
+                block_indicators = True
+            if ch == "-" and followed_by_whitespace:
+                block_indicators = True
+        else:
+            if ch == ":" and followed_by_whitespace:
+                block_indicators = True
+            if ch == "#" and preceded_by_whitespace:
+                block_indicators = True
+
+        if ch in line_breaks:
+            has_line_breaks = True
+        if not (ch == "\n" or "\x20" <= ch <= "\x7E"):
+            if not (
+                (
+                    ch == "\x85"
+                    or "\xA0" <= ch <= "\uD7FF"
+                    or "\uE000" <= ch <= "\uFFFD"
+                    or "\U00010000" <= ch <= "\U0010FFFF"
+                )
+                and ch != "\uFEFF"
+            ):
+                special_characters = True
+
+        if ch == " ":
+            if index == 0:
+                leading_space = True
+            if index == last:
+                trailing_space = True
+            if previous_break:
+                break_space = True
+            previous_space = True
+            previous_break = False
+        elif ch in line_breaks:
+            if index == 0:
+                leading_break = True
+            if index == last:
+                trailing_break = True
+            if previous_space:
+                space_break = True
+            previous_space = False
+            previous_break = True
+        else:
+            previous_space = False
+            previous_break = False
+
+        preceded_by_whitespace = ch in whitespace_chars
+        followed_by_whitespace = index + 2 >= len(scalar) or scalar[index + 2] in whitespace_chars
+
+    # (block scalars are only ever chosen explicitly, so their restrictions
+    # don't matter; double quotes are always allowed)
+    allow_block_plain = allow_single_quoted = True
+    if leading_space or leading_break or trailing_space or trailing_break:
+        allow_block_plain = False
+    if break_space or special_characters or space_break:
+        allow_block_plain = allow_single_quoted = False
+    if has_line_breaks:
+        allow_block_plain = False
+    if block_indicators:
+        allow_block_plain = False
+
+    analysis.empty = False
+    analysis.multiline = has_line_breaks
+    analysis.allow_block_plain = allow_block_plain
+    analysis.allow_single_quoted = allow_single_quoted
+    return analysis
+
+
+# Job names, keys and commands repeat across every workflow of a config: the
+# analysis of each distinct scalar is done once
+@lru_cache(maxsize=65536)
+def scalar_style(tag, text, style, simple_key):
+    """ruamel Emitter.choose_scalar_style(): "" (plain), "'", '"', "|" or ">"."""
+    analysis = analyze_scalar(text)
+    if simple_key:
+        # ruamel counts the key's "!!<tag>" against the limit, even if not written
+        if len(text) + len(tag) + 2 >= max_simple_key_length or analysis.multiline:
+            raise UnsupportedValue("complex mapping keys")
+    if not style and resolve(text) == tag:
+        if not (simple_key and (analysis.empty or analysis.multiline)) and (
+            analysis.allow_block_plain
+        ):
+            return ""
+    if style and not simple_key:
+        return style
+    if not style and ("'" in text or "\n" in text):
+        return '"'
+    if not style and analysis.allow_single_quoted and not (simple_key and analysis.multiline):
+        return "'"
+    return '"'
+
+
+class Emitter:
+    """Writes one document; the state mirrors ruamel's Emitter attributes."""
+
+    def __init__(self):
+        self.chunks = []
+        self.indents = []  # (previous indent, is a sequence)
+        self.indent = None
+        self.column = 0
+        self.whitespace = True
+        self.indention = True
+        self.no_newline = None
+        self.open_ended = False
+
+    # Indentation
+
+    def increase_indent(self, sequence=False, indentless=False, flow=False):
+        self.indents.append((self.indent, sequence))
+        if self.indent is None:
+            self.indent = None if flow else 0
+        elif not indentless:
+            self.indent += best_indent
+
+    def seq_seq(self):
+        return len(self.indents) >= 2 and self.indents[-2][1] and self.indents[-1][1]
+
+    def seq_flow_align(self):
+        if len(self.indents) < 2 or not self.indents[-1][1]:
+            return 0
+        base = self.indents[-1][0] if self.indents[-1][0] is not None else 0
+        return base + best_indent - self.column - 1
+
+    # Writers
+
+    def write_indicator(self, indicator, need_whitespace, whitespace=False, indention=False):
+        if self.whitespace or not need_whitespace:
+            data = indicator
+        else:
+            data = " " + indicator
+        self.whitespace = whitespace
+        self.indention = self.indention and indention
+        self.column += len(data)
+        self.open_ended = False
+        self.chunks.append(data)
+
+    def write_indent(self):
+        indent = self.indent or 0
+        if (
+            not self.indention
+            or self.column > indent
+            or (self.column == indent and not self.whitespace)
+        ):
+            if self.no_newline:
+                self.no_newline = False
+            else:
+                self.write_line_break()
+        if self.column < indent:
+            self.whitespace = True
+            self.chunks.append(" " * (indent - self.column))
+            self.column = indent
+
+    def write_line_break(self, data="\n"):
+        self.whitespace = True
+        self.indention = True
+        self.column = 0
+        self.chunks.append(data)
+
+    def write_breaks(self, text):
+        for br in text:
+            self.write_line_break(br)
+
+    def write_plain(self, text, split):
+        if not text:
+            return
+        if not self.whitespace:
+            self.column += 1
+            self.chunks.append(" ")
+        self.whitespace = False
+        self.indention = False
+        if self.column + len(text) <= best_width:
+            # fits: no folding (plain scalars never contain line breaks)
+            self.column += len(text)
+            self.chunks.append(text)
+            return
+        spaces = breaks = False
+        start = end = 0
+        while end <= len(text):
+            ch = text[end] if end < len(text) else None
+            if spaces:
+                if ch != " ":
+                    if start + 1 == end and self.column >= best_width and split:
+                        self.write_indent()
+                        self.whitespace = False
+                        self.indention = False
+                    else:
+                        data = text[start:end]
+                        self.column += len(data)
+                        self.chunks.append(data)
+                    start = end
+            elif breaks:
+                if ch not in line_breaks:
+                    if text[start] == "\n":
+                        self.write_line_break()
+                    self.write_breaks(text[start:end])
+                    self.write_indent()
+                    self.whitespace = False
+                    self.indention = False
+                    start = end
+            elif ch is None or ch in " " + line_breaks:
+                data = text[start:end]
+                if (
+                    len(data) + self.column > best_width
+                    and self.indent is not None
+                    and self.column > self.indent
+                ):
+                    # words longer than line length get a line of their own
+                    self.write_indent()
+                self.column += len(data)
+                self.chunks.append(data)
+                start = end
+            if ch is not None:
+                spaces = ch == " "
+                breaks = ch in line_breaks
+            end += 1
+
+    def write_single_quoted(self, text, split):
+        self.write_indicator("'", True)
+        spaces = breaks = False
+        start = end = 0
+        while end <= len(text):
+            ch = text[end] if end < len(text) else None
+            if spaces:
+                if ch is None or ch != " ":
+                    if (
+                        start + 1 == end
+                        and self.column > best_width
+                        and split
+                        and start != 0
+                        and end != len(text)
+                    ):
+                        self.write_indent()
+                    else:
+                        data = text[start:end]
+                        self.column += len(data)
+                        self.chunks.append(data)
+                    start = end
+            elif breaks:
+                if ch is None or ch not in line_breaks:
+                    if text[start] == "\n":
+                        self.write_line_break()
+                    self.write_breaks(text[start:end])
+                    self.write_indent()
+                    start = end
+            elif ch is None or ch in " " + line_breaks or ch == "'":
+                if start < end:
+                    data = text[start:end]
+                    self.column += len(data)
+                    self.chunks.append(data)
+                    start = end
+            if ch == "'":
+                self.column += 2
+                self.chunks.append("''")
+                start = end + 1
+            if ch is not None:
+                spaces = ch == " "
+                breaks = ch in line_breaks
+            end += 1
+        self.write_indicator("'", False)
+
+    def write_double_quoted(self, text, split):
+        self.write_indicator('"', True)
+        start = end = 0
+        while end <= len(text):
+            ch = text[end] if end < len(text) else None
+            if (
+                ch is None
+                or ch in '"\\\x85\u2028\u2029\uFEFF'
+                or not (
+                    "\x20" <= ch <= "\x7E"
+                    or "\xA0" <= ch <= "\uD7FF"
+                    or "\uE000" <= ch <= "\uFFFD"
+                    or "\U00010000" <= ch <= "\U0010FFFF"
+                )
+            ):
+                if start < end:
+                    data = text[start:end]
+                    self.column += len(data)
+                    self.chunks.append(data)
+                    start = end
+                if ch is not None:
+                    if ch in escape_replacements:
+                        data = "\\" + escape_replacements[ch]
+                    elif ch <= "\xFF":
+                        data = "\\x%02X" % ord(ch)
+                    elif ch <= "\uFFFF":
+                        data = "\\u%04X" % ord(ch)
+                    else:
+                        data = "\\U%08X" % ord(ch)
+                    self.column += len(data)
+                    self.chunks.append(data)
+                    start = end + 1
+            if (
+                0 < end < len(text) - 1
+                and (ch == " " or start >= end)
+                and self.column + (end - start) > best_width
+                and split
+            ):
+                need_backslash = True
+                try:
+                    space_pos = text.index(" ", end)
+                    try:
+                        space_pos = text.index("\n", end, space_pos)
+                    except (ValueError, IndexError):
+                        pass
+                    if text[space_pos] == "\n" and text[space_pos + 1] != " ":
+                        pass
+                    elif (
+                        '"' not in text[end:space_pos]
+                        and "'" not in text[end:space_pos]
+                        and text[space_pos + 1] not in " \n"
+                        and text[end - 1 : end + 1] != "  "
+                        and start != end
+                    ):
+                        need_backslash = False
+                except (ValueError, IndexError):
+                    pass
+                data = text[start:end] + ("\\" if need_backslash else "")
+                if start < end:
+                    start = end
+                self.column += len(data)
+                self.chunks.append(data)
+                self.write_indent()
+                self.whitespace = False
+                self.indention = False
+                if text[start] == " ":
+                    if not need_backslash:
+                        # remove leading space it will load from the newline
+                        start += 1
+                    data = "\\" if need_backslash else ""
+                    self.column += len(data)
+                    self.chunks.append(data)
+            end += 1
+        self.write_indicator('"', False)
+
+    def block_hints(self, text):
+        hints = indicator = ""
+        if text:
+            if text[0] in " " + line_breaks:
+                hints += str(best_indent)
+            if text[-1] not in line_breaks:
+                indicator = "-"
+            elif len(text) == 1 or text[-2] in line_breaks:
+                indicator = "+"
+        return hints + indicator, indicator
+
+    def write_folded(self, text):
+        hints, indicator = self.block_hints(text)
+        self.write_indicator(">" + hints, True)
+        if indicator == "+":
+            self.open_ended = True
+        self.write_line_break()
+        leading_space = True
+        spaces = False
+        breaks = True
+        start = end = 0
+        while end <= len(text):
+            ch = text[end] if end < len(text) else None
+            if breaks:
+                if ch is None or ch not in line_breaks + "\a":
+                    if not leading_space and ch is not None and ch != " " and text[start] == "\n":
+                        self.write_line_break()
+                    leading_space = ch == " "
+                    self.write_breaks(text[start:end])
+                    if ch is not None:
+                        self.write_indent()
+                    start = end
+            elif spaces:
+                if ch != " ":
+                    if start + 1 == end and self.column > best_width:
+                        self.write_indent()
+                    else:
+                        data = text[start:end]
+                        self.column += len(data)
+                        self.chunks.append(data)
+                    start = end
+            elif ch is None or ch in " " + line_breaks + "\a":
+                if ch == "\a":
+                    raise UnsupportedValue("fold indicators in folded scalars")
+                data = text[start:end]
+                self.column += len(data)
+                self.chunks.append(data)
+                if ch is None:
+                    self.write_line_break()
+                start = end
+            if ch is not None:
+                breaks = ch in line_breaks
+                spaces = ch == " "
+            end += 1
+
+    def write_literal(self, text):
+        hints, indicator = self.block_hints(text)
+        self.write_indicator("|" + hints, True)
+        if indicator == "+":
+            self.open_ended = True
+        self.write_line_break()
+        breaks = True
+        start = end = 0
+        while end <= len(text):
+            ch = text[end] if end < len(text) else None
+            if breaks:
+                if ch is None or ch not in line_breaks:
+                    self.write_breaks(text[start:end])
+                    if ch is not None:
+                        self.write_indent()
+                    start = end
+            elif ch is None or ch in line_breaks:
+                self.chunks.append(text[start:end])
+                if ch is None:
+                    self.write_line_break()
+                start = end
+            if ch is not None:
+                breaks = ch in line_breaks
+            end += 1
+
+    # Nodes
+
+    def node(self, data, sequence=False, mapping=False, simple_key=False):
+        cls = type(data)
+        if cls is dict:
+            if not data:
+                self.flow_empty("{}", sequence=False)
+            else:
+                self.block_mapping(data)
+        elif cls is list:
+            if not data:
+                self.flow_empty("[]", sequence=True)
+            else:
+                self.block_sequence(data, mapping)
+        else:
+            self.scalar(data, sequence, simple_key)
+
+    def flow_empty(self, brackets, sequence):
+        self.write_indicator(" " * self.seq_flow_align() + brackets[0], True, whitespace=True)
+        self.increase_indent(sequence=sequence, flow=True)
+        if self.seq_seq():
+            # - -
+            self.indention = True
+            self.no_newline = False
+        self.indent = self.indents.pop()[0]
+        self.write_indicator(brackets[1], False)
+        self.write_line_break()
+
+    def scalar(self, data, sequence, simple_key):
+        tag, text, style = represent_scalar(data)
+        style = scalar_style(tag, text, style, simple_key)
+        self.increase_indent(flow=True)
+        split = not simple_key
+        if sequence:
+            self.write_indent()
+        if style == '"':
+            self.write_double_quoted(text, split)
+        elif style == "'":
+            self.write_single_quoted(text, split)
+        elif style == ">":
+            self.write_folded(text)
+        elif style == "|":
+            self.write_literal(text)
+        else:
+            self.write_plain(text, split)
+        self.indent = self.indents.pop()[0]
+
+    def block_mapping(self, data):
+        self.increase_indent()
+        for key, value in data.items():
+            self.write_indent()
+            self.node(key, mapping=True, simple_key=True)
+            self.write_indicator(":", False)
+            self.node(value, mapping=True)
+        self.indent = self.indents.pop()[0]
+
+    def block_sequence(self, data, mapping):
+        self.increase_indent(sequence=True, indentless=mapping and not self.indention)
+        if self.seq_seq():
+            # - -
+            self.indention = True
+            self.no_newline = False
+        for item in data:
+            nonl = self.no_newline if self.column == 0 else False
+            self.write_indent()
+            self.write_indicator("-", True, indention=True)
+            if nonl:
+                self.no_newline = True
+            self.node(item, sequence=True)
+        self.indent = self.indents.pop()[0]
+        self.no_newline = False
+
+
+def dump(data):
+    """YAML text of a config (a non-empty mapping), as ruamel would dump it."""
+    if type(data) is not dict or not data:
+        raise UnsupportedValue("only non-empty mappings are emitted")
+    emitter = Emitter()
+    emitter.block_mapping(data)
+    # document end
+    emitter.write_indent()
+    if emitter.open_ended:
+        emitter.write_indicator("...", True)
+        emitter.write_indent()
+    return "".join(emitter.chunks)
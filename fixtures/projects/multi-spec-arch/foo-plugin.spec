@@ -0,0 +1,16 @@
+Name: foo-plugin
+Version: 1.0.0
+Release: 1%{?dist}
+Summary: Golden fixture
+License: MIT
+Source0: https://example.com/%{name}-%{version}.tar.gz
+%if 0%{?rhel} >= 9
+BuildRequires: foo-devel
+%endif
+%ifarch aarch64
+# upstream doesn't support ARM yet
+ExcludeArch: aarch64
+%endif
+
+%description
+Golden fixture.
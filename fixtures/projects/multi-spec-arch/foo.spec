@@ -0,0 +1,19 @@
+%global foo_arches %{ix86} x86_64 %{arm}
+
+Name: foo
+Version: 1.0.0
+Release: 1%{?dist}
+Summary: Golden fixture
+License: MIT
+Source0: https://example.com/%{name}-%{version}.tar.gz
+ExclusiveArch: %{foo_arches}
+
+%description
+Golden fixture.
+
+%package doc
+Summary: Golden fixture documentation
+BuildArch: noarch
+
+%description doc
+Golden fixture documentation.
@@ -0,0 +1,10 @@
+Name: nginx-module-bar
+Version: 1.0.0
+Release: 1%{?dist}
+Summary: Golden fixture
+License: MIT
+Source0: https://example.com/%{name}-%{version}.tar.gz
+
+
+%description
+Golden fixture.
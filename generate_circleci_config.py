@@ -1,173 +1,125 @@
 #!/usr/bin/env python3
-import fnmatch
+"""
+Generate .circleci/config.yml for RPM spec projects from their settings.yml
+and the shared matrix.json.
+
+Usable both as a script and as a module:
+
+    import generate_circleci_config as gcc
+    matrix = gcc.load_matrix()
+    config = gcc.generate("/rpm/foo-rpm", matrix)
+
+Batch mode (`--project-dirs`) parses matrix.json once and regenerates the whole
+fleet in a single process, optionally fanned out over a process pool
+(`--jobs`), instead of paying interpreter + ruamel startup per spec repo.
+
+Regeneration is incremental: a fingerprint of everything that can affect the
+output (settings.yml, the archs scanned from the specs, matrix.json and
+the generator itself) is kept in a cache file, so unchanged projects are
+skipped without emitting YAML. When YAML is emitted, config.yml is replaced
+atomically and only if its bytes differ (no mtime churn, no no-op commits).
+"""
+import glob
+import hashlib
+import io
 import os
 import argparse
 import json
 import re
+import shlex
+import sys
+from functools import lru_cache, partial
+
+import buildfiles
+import buildmatrix
+import fastyaml
+import sizing
+import specscan
+from buildfiles import (
+    default_image_lock_file,
+    default_matrix_file,
+    load_image_lock,
+    load_matrix,
+    write_if_changed,
+)
+from fastyaml import FoldedString, LiteralString
 
-from ruamel.yaml import YAML
-from ruamel.yaml.comments import CommentedMap
-from ruamel.yaml.scalarstring import LiteralScalarString, FoldedScalarString
+# Heavy modules (ruamel.yaml, tempfile, the process pool) are imported on the
+# code paths that need them, not here: hooks and batch loops call this script
+# constantly and mostly find nothing to regenerate (see benchmark.py --only
+# startup).
 
-# Initialize YAML handler
-yaml = YAML()
-yaml.default_flow_style = False
-# Instruct the representer to ignore aliases
-yaml.representer.ignore_aliases = lambda *args: True
+# Exit status of --output when no cell matches the requested dists/archs/
+# branches (and no config was written)
+no_cells_status = 3
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description="Generate CircleCI configuration.")
-parser.add_argument("--project-dir", default=".", help="Root directory of the project.")
-args = parser.parse_args()
+# Fingerprint cache for incremental regeneration (see regenerate())
+default_cache_file = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "buildstrap",
+    "circleci-fingerprints.json",
+)
 
-# Determine the project directory
-project_dir = os.path.abspath(args.project_dir)
+# Source files whose content determines the generator's output. Their hash is
+# the "generator version" folded into every project fingerprint, so editing
+# the generator invalidates the whole cache without a manual version bump.
+generator_sources = [
+    os.path.abspath(__file__),
+    os.path.abspath(buildfiles.__file__),
+    os.path.abspath(buildmatrix.__file__),
+    os.path.abspath(fastyaml.__file__),
+    os.path.abspath(sizing.__file__),
+    os.path.abspath(specscan.__file__),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "rpm-dedupe.sh"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan-cells.sh"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "build-timings.sh"),
+]
 
-# Read settings.yml from the project directory
-settings_file = os.path.join(project_dir, "settings.yml")
-if os.path.exists(settings_file):
-    with open(settings_file, "r") as f:
-        project_settings = yaml.load(f)
-    if project_settings is None:
-        project_settings = {}
-else:
-    project_settings = {}
+# Files under .circleci/ the generator owns. continue_config.json only exists
+# with a setup stage (settings.yml `plan:` / `changes:`) and is removed again
+# when a project opts out.
+generated_files = [".circleci/config.yml", ".circleci/continue_config.json"]
 
 # Default architectures
 default_archs = ["x86_64", "aarch64"]
 
-# Get architectures from settings.yml or default to the default_archs
-archs = project_settings.get("archs", default_archs)
-exclude_patterns = project_settings.get("exclude", [])
-# `dists:` is an allowlist (symmetric to `archs:`) over dist / dist-version /
-# dist-version-arch fnmatch patterns. Empty list / unset = no allowlist (build
-# everywhere except `exclude`). Use this when a repo is intrinsically scoped to
-# a subset of the matrix (e.g. libseccomp-rpm is el7-only because newer distros
-# already ship libseccomp >= 2.5.x); future new distros are excluded by default
-# instead of silently joining the build matrix.
-dists_allowlist = project_settings.get("dists", [])
-
-# Self mode: tag-triggered release builds (ngm, fds, stack-scripts).
-# Replaces the verbatim generated_config_self.yml template — single boolean
-# `self: true` in settings.yml flips the generator to:
-#   - no collection / no branch-axis (per-distro × per-arch × single workflow)
-#   - build command `./utils/version-from-tag.sh && build`
-#   - tag filters (build: /.*/, deploy: /^v.*/ branches ignored)
-#   - small resource_class default
-#   - no enable_repos / no nginx-collection plumbing
-# Any settings.yml knob (e.g. explicit `archs:`) still wins.
-self_mode = bool(project_settings.get("self", False))
-# if there is only one .spec file in the directory, look for "BuildArch:      noarch" in it
-# if found, set only "noarch" to the list of archs
-# An explicit `archs:` in settings.yml wins over spec sniffing.
-if "archs" not in project_settings and len(
-    [f for f in os.listdir(project_dir) if f.endswith(".spec")]
-) == 1:
-    spec_file = os.path.join(
-        project_dir, [f for f in os.listdir(project_dir) if f.endswith(".spec")][0]
-    )
-    # scan and split the spec file by lines
-    with open(spec_file, "r") as f:
-        spec_lines = f.readlines()
-        # look for "BuildArch: noarch" in the spec file
-        for line in spec_lines:
-            # replace duplicate spaces/tabs with a single space
-            line = re.sub(r"\s+", " ", line.strip())
-            # look for BuildArch: noarch in the spec file
-            if line.startswith("BuildArch:"):
-                build_arch = line.split(":", maxsplit=1)[1].strip()
-                if build_arch == "noarch":
-                    archs = ["noarch"]
-                    break
-            # look for ExclusiveArch: x86_64 in the spec file
-            if line.startswith("ExclusiveArch:"):
-                exclusive_archs = line.split(":", maxsplit=1)[1].strip()
-                exclusive_archs = exclusive_archs.split(" ")
-                # Specs may list RPM macros (%{arm}, %{?go_arches:...}) or
-                # arches we don't build for (i686). Keep only CI-buildable
-                # arches; if nothing survives (pure-macro list), keep the
-                # default matrix.
-                sanitized = [a for a in exclusive_archs if a in default_archs]
-                if sanitized:
-                    archs = sanitized
-                break
-exclude_archs = project_settings.get("exclude_archs", [])
-
-# Exclude architectures
-archs = [arch for arch in archs if arch not in exclude_archs]
-
-# Read matrix.json
-matrix_file = os.path.join(os.path.dirname(__file__), "matrix.json")
-with open(matrix_file, "r") as f:
-    matrix_config = json.load(f)
-
-# Get the branches from matrix.json "collections": { "nginx": { "branches": {
-# what branches depends on detected collection, e.g. "nginx"
-if self_mode:
-    # Tag-triggered: no branch axis. Sentinel single-branch keeps the existing
-    # distros × branches × archs loop intact while emitting workflow names
-    # without a branch suffix (per get_workflow_name's len(branches) == 1
-    # short-circuit). collection_name forced None so nginx-only blocks below
-    # (custom setup steps, plesk/mod/failure_tolerance params, enable_repos
-    # default) all stay dormant.
-    branches = {"__self__": {"description": "tag-triggered self build"}}
-    collection_name = None
-else:
-    branches = {
-        "master": {
-            "description": "Main release branch",
-        }
-    }
-    collection_name = None
-    # if project diredtory nqme starts with "nginx-", set collection_name to "nginx"
-    # get base name of the directory
-    project_dir_base = os.path.basename(project_dir)
-    if project_dir_base.startswith("nginx-"):
-        collection_name = "nginx"
-    # settings can specify collection name explicitly
-    collection_name = project_settings.get("collection", collection_name)
-    if collection_name:
-        branches = matrix_config["collections"][collection_name]["branches"]
-    # project can override branches or specify 'all'
-    branches = project_settings.get("branches", branches)
-    # project can explicitly specify a set of branches to reduce, using branch:
-    # then filter out branches that are not in the list
-    if "branch" in project_settings:
-        branches = {k: v for k, v in branches.items() if k in project_settings["branch"]}
-    # project can exclude branches, e.g. plesk, by specifying exclude_branches:
-    if "exclude_branches" in project_settings:
-        branches = {
-            k: v
-            for k, v in branches.items()
-            if k not in project_settings["exclude_branches"]
-        }
+# Cell-scoped pipeline parameters (settings.yml `cell_parameters: true`):
+# regexes a triggered pipeline can limit its workflows to, e.g.
+# {"build_dists": "fc44"}. The defaults build everything.
+cell_pipeline_parameters = {
+    "build_dists": {
+        "description": "Regex of the dist versions to build, e.g. fc44 or el10|fc44",
+        "type": "string",
+        "default": ".*",
+    },
+    "build_archs": {
+        "description": "Regex of the architectures to build",
+        "type": "string",
+        "default": ".*",
+    },
+    "build_branches": {
+        "description": "Regex of the matrix branches to build, e.g. mainline",
+        "type": "string",
+        "default": ".*",
+    },
+}
+
+# The pipeline parameters of the config.yml setup template. CircleCI hands
+# those a pipeline was triggered with on to the config the setup job
+# continues with (--output), which has to declare them all as well.
+setup_template_parameters = {
+    "run_workflow_setup": {"type": "boolean", "default": True},
+    "buildstrap_ref": {
+        "description": "buildstrap revision this config was generated with",
+        "type": "string",
+        "default": "main",
+    },
+    **cell_pipeline_parameters,
+}
 
-resource_class = "medium"
-# Self mode default is small (verbatim template parity).
-if self_mode:
-    resource_class = "small"
-# if only noarch, fine with small
-if len(archs) == 1 and "noarch" in archs:
-    resource_class = "small"
-# projects may override resource class
-resource_class = project_settings.get("resource_class", resource_class)
 arm_resource_class_mappings = {"small": "medium"}
-arm_resource_class = "arm." + arm_resource_class_mappings.get(
-    resource_class, resource_class
-)
-
-# Opt-in post-deploy smoke install jobs. Shape (per-project settings.yml):
-#   post_deploy_smoke:
-#     <branch>:
-#       dists: [el9, ...]
-#       archs: [x86_64, aarch64]
-# Absent / empty → no smoke jobs emitted (default-off; consumers not opting in
-# regenerate a byte-identical .circleci/config.yml). Smoke body lives in the
-# consumer repo at scripts/smoke.sh; the generated job just `checkout`s and
-# runs that script under the rpmbuilder executor.
-post_deploy_smoke = project_settings.get("post_deploy_smoke") or {}
-
-command_set_nginx_macros = LiteralScalarString(
+
+command_set_nginx_macros = LiteralString(
     r"""[ -z ${PLESK+x} ] || echo "%plesk ${PLESK}" >> rpmmacros
 # we generate both nginx-module-<foo> and sw-nginx-module-<foo> from a single spec file, so:
 [ -z ${PLESK+x} ] || (echo >> rpmlint.config && echo 'addFilter ("E: invalid-spec-name")' >> rpmlint.config)
@@ -176,11 +128,114 @@ command_set_nginx_macros = LiteralScalarString(
 """
 )
 
-command_spec_files_cleanup = LiteralScalarString(
+command_spec_files_cleanup = LiteralString(
     r"""[[ ! -f ./cleanup.sh ]] || BRANCH="${CIRCLE_BRANCH}" ./cleanup.sh"""
 )
 
-command_check_rpm_files_halt = LiteralScalarString(
+# Build caches (settings.yml `cache:` block). The key files are written after
+# cleanup.sh so they only cover the specs that are actually built: the specs
+# themselves (ccache key) and their expanded Source lines (SOURCES key).
+command_write_cache_keys = LiteralString(
+    r"""cat *.spec > /tmp/cache-spec 2> /dev/null || true
+for spec in *.spec; do
+  rpmspec -P "$spec" 2> /dev/null || cat "$spec"
+done | grep -iE '^[[:space:]]*Source[0-9]*[[:space:]]*:' | sort -u > /tmp/cache-sources || true"""
+)
+
+command_enable_ccache = LiteralString(
+    r"""command -v ccache > /dev/null 2>&1 || dnf -y -q install ccache || yum -y -q install ccache || zypper -n -q install ccache || true
+if command -v ccache > /dev/null 2>&1; then
+  mkdir -p /tmp/ccache
+  echo 'export PATH="/usr/lib64/ccache:/usr/lib/ccache:$PATH"' >> "$BASH_ENV"
+  echo 'export CCACHE_DIR=/tmp/ccache CCACHE_MAXSIZE=2G' >> "$BASH_ENV"
+  CCACHE_DIR=/tmp/ccache ccache -z
+else
+  echo "ccache is not available for this dist. Building without it."
+fi"""
+)
+
+# Package cache (`cache: {packages: true}`): the packager keeps its metadata
+# and, with KEEPCACHE=1, the downloaded BuildRequires in its cache directory,
+# which is restored/saved per dist, arch, enable_repos and day. dnf gets an
+# explicit cachedir so dnf4 and dnf5 share /var/cache/dnf.
+command_configure_package_cache = LiteralString(
+    r"""date -u +%F > /tmp/cache-day
+set_main() {
+  if grep -q "^$2=" "$1"; then
+    sed -i --follow-symlinks "s|^$2=.*|$2=$3|" "$1"
+  else
+    sed -i --follow-symlinks "/^\[main\]/a $2=$3" "$1"
+  fi
+}
+if [ -f /etc/dnf/dnf.conf ]; then
+  set_main /etc/dnf/dnf.conf cachedir /var/cache/dnf
+  set_main /etc/dnf/dnf.conf keepcache "$KEEPCACHE"
+fi
+[ ! -f /etc/yum.conf ] || set_main /etc/yum.conf keepcache "$KEEPCACHE"
+if [ "$KEEPCACHE" = 1 ] && command -v zypper > /dev/null 2>&1; then
+  zypper -n -q modifyrepo --all --keep-packages || true
+fi"""
+)
+
+# Cache directory of each matrix.yml `packager`
+package_cache_dirs = {
+    "dnf": "/var/cache/dnf",
+    "yum": "/var/cache/yum",
+    "zypper": "/var/cache/zypp",
+}
+
+command_ccache_stats = LiteralString(
+    r"""! command -v ccache > /dev/null 2>&1 || ccache -s"""
+)
+
+# Downloaded sources are seeded into the checkout, where the build looks for
+# them before downloading; tracked files (local Source files) are left alone.
+command_seed_sources = LiteralString(
+    r"""mkdir -p /tmp/sources-cache
+for file in /tmp/sources-cache/*; do
+  [ -f "$file" ] && [ ! -e "$(basename "$file")" ] && cp -p "$file" . || true
+done"""
+)
+
+command_collect_sources = LiteralString(
+    r"""mkdir -p /tmp/sources-cache
+sed -E 's/^[^:]*:[[:space:]]*//; s|.*#/||; s|.*/||' /tmp/cache-sources | while read -r name; do
+  [ -f "$name" ] || continue
+  git ls-files --error-unmatch "$name" > /dev/null 2>&1 || cp -p "$name" /tmp/sources-cache/
+done
+ls -al /tmp/sources-cache"""
+)
+
+# Source prefetch (settings.yml `prefetch: true`): one job per branch workflow
+# downloads the specs' Source files once and hands them to every build cell
+# through the workspace.
+command_prefetch_sources = LiteralString(
+    r"""mkdir -p /tmp/workspace/prefetch
+for spec in *.spec; do
+  [ -f "$spec" ] || continue
+  spectool -g -S -C /tmp/workspace/prefetch --define "nginx_branch ${CIRCLE_BRANCH}" "$spec"
+done
+# Fedora-style `sources` checksum file, if the project carries one
+if [ -f sources ]; then
+  sed -nE 's/^SHA512 \((.*)\) = ([0-9a-f]+)$/\2  \1/p' sources > /tmp/sources.sha512
+  (cd /tmp/workspace/prefetch && sha512sum -c /tmp/sources.sha512)
+fi
+for file in /tmp/workspace/prefetch/*; do
+  case "$file" in
+    *.tar|*.tar.*|*.tgz|*.tbz2|*.txz) tar -tf "$file" > /dev/null ;;
+    *.zip) unzip -tq "$file" ;;
+  esac
+done
+ls -al /tmp/workspace/prefetch"""
+)
+
+command_use_prefetched_sources = LiteralString(
+    r"""for file in /tmp/workspace/prefetch/*; do
+  [ -f "$file" ] && [ ! -e "$(basename "$file")" ] && cp -p "$file" . || true
+done"""
+)
+
+command_check_rpm_files_halt = LiteralString(
     r"""if ls /output/*.rpm 1> /dev/null 2>&1; then
   echo "RPM files found. Proceeding with persistence to workspace."
   ls -al /output/*.rpm
@@ -191,166 +246,1327 @@ else
 fi"""
 )
 
-command_incoming_mkdir = FoldedScalarString(
+# Per-branch workflows (compact layout) share one workflow between all cells
+# of a branch: an empty cell must only stop itself, not cancel its siblings.
+command_check_rpm_files_halt_job = LiteralString(
+    r"""if ls /output/*.rpm 1> /dev/null 2>&1; then
+  echo "RPM files found. Proceeding with persistence to workspace."
+  ls -al /output/*.rpm
+else
+  echo "No RPM files found. Halting the job."
+  circleci-agent step halt
+fi"""
+)
+
+command_deploy_halt_without_rpms = LiteralString(
+    r"""if ! ls /output/*.rpm 1> /dev/null 2>&1; then
+  echo "No RPM files in workspace. Nothing to deploy."
+  circleci-agent step halt
+fi"""
+)
+
+# Fan-in deploy: every build stages its RPMs under <dist>/<arch>/ in the
+# workspace so one deploy job per branch can collect all cells without
+# file-name collisions (e.g. noarch subpackages built on both arches).
+command_stage_rpms_by_cell = LiteralString(
+    r"""mkdir -p /output/<< parameters.dist >>/<< parameters.arch >>
+mv /output/*.rpm /output/<< parameters.dist >>/<< parameters.arch >>/"""
+)
+
+# Sharded builds (settings.yml `shards:`): every node of a build job keeps its
+# share of the specs left after cleanup.sh. Each node deals the same
+# longest-first (LPT) split from the spec weights: heaviest spec first, onto
+# the least loaded node. A node left without specs halts.
+def command_select_shard_specs(weights, default_weight):
+    """Remove the specs other nodes of this build job build."""
+    return LiteralString(
+        "cat > /tmp/spec-weights <<'SPEC_WEIGHTS'\n"
+        + "".join(f"{spec} {seconds:g}\n" for spec, seconds in sorted(weights.items()))
+        + "SPEC_WEIGHTS\n"
+        + f"ls *.spec 2> /dev/null | awk -v fallback={default_weight:g} '\n"
+        + r"""  FILENAME == "/tmp/spec-weights" { weight[$1] = $2; next }
+  { print $1, (($1 in weight) ? weight[$1] : fallback) }' /tmp/spec-weights - \
+  | sort -k2,2nr -k1,1 | awk -v node="$CIRCLE_NODE_INDEX" -v nodes="$CIRCLE_NODE_TOTAL" '
+  {
+    least = 0
+    for (i = 1; i < nodes; i++) if (load[i] < load[least]) least = i
+    load[least] += $2
+    if (least != node) print $1
+  }' | xargs -r rm -f --
+if ! ls *.spec 1> /dev/null 2>&1; then
+  echo "No specs left for node $CIRCLE_NODE_INDEX. Halting the job."
+  circleci-agent step halt
+  exit 0
+fi
+echo "Node $CIRCLE_NODE_INDEX of $CIRCLE_NODE_TOTAL builds:" *.spec"""
+    )
+
+
+def command_stage_shard_rpms(cell_dir):
+    """Move the node's RPMs (under /output/<cell_dir>) below shards/<node>/."""
+    source = f"/output/{cell_dir}" if cell_dir else "/output"
+    target = "/output/shards/$CIRCLE_NODE_INDEX" + (f"/{cell_dir}" if cell_dir else "")
+    return LiteralString(f"mkdir -p {target}\nmv {source}/*.rpm {target}/")
+
+
+# Sharded builds: the deploy job flattens shards/<node>/ back into /output
+command_collect_shard_rpms = LiteralString(
+    r"""for shard in /output/shards/*/; do
+  [ -d "$shard" ] || continue
+  (cd "$shard" && find . -name '*.rpm' -type f) | while read -r rpm; do
+    mkdir -p "/output/$(dirname "$rpm")"
+    mv "$shard$rpm" "/output/$rpm"
+  done
+done
+rm -rf /output/shards"""
+)
+
+# Fan-in deploy: lay the attached RPMs out as <dist>/<arch>/<branch>/ under
+# /tmp/deploy; /tmp/rpm-upload lists what to upload, /tmp/deploy-cells the
+# cell directories to fire incoming.sh for.
+command_stage_branch_rpms = LiteralString(
+    r"""rm -rf /tmp/deploy && mkdir -p /tmp/deploy
+for rpm in /output/*/*/*.rpm; do
+  [ -e "$rpm" ] || continue
+  cell=$(dirname "${rpm#/output/}")
+  mkdir -p "/tmp/deploy/$cell/$CIRCLE_BRANCH"
+  cp "$rpm" "/tmp/deploy/$cell/$CIRCLE_BRANCH/"
+done
+cells=$(cd /tmp/deploy && echo */*/"$CIRCLE_BRANCH")
+if [ "$cells" = "*/*/$CIRCLE_BRANCH" ]; then
+  echo "No RPM files in workspace. Nothing to deploy."
+  circleci-agent step halt
+  exit 0
+fi
+(cd /tmp/deploy && find . -name '*.rpm' | sed 's|^\./||') > /tmp/rpm-upload
+echo "$cells" > /tmp/deploy-cells
+echo Deploying: $cells"""
+)
+
+# Fan-in deploy: stream the RPMs listed in /tmp/rpm-upload with tar into
+# ~/incoming/<repo>/ over a single SSH session, which then also fires
+# incoming.sh for every cell directory (and, with dedupe, records the
+# uploads in the build server's content store first).
+command_deploy_branch_rpms = LiteralString(
+    r"""cells=$(cat /tmp/deploy-cells)
+store=""
+[ ! -f /tmp/rpm-manifest ] || store="sh ~/.buildstrap/rpm-dedupe.sh store $cells &&"
+if [ -s /tmp/rpm-upload ]; then
+  tar -C /tmp/deploy -cf - -T /tmp/rpm-upload
+fi | ssh -o StrictHostKeyChecking=no -q $GPS_BUILD_USER@$GPS_BUILD_SERVER "
+  mkdir -p ~/incoming/$CIRCLE_PROJECT_REPONAME && cd ~/incoming/$CIRCLE_PROJECT_REPONAME || exit 1
+  [ $(wc -l < /tmp/rpm-upload) -eq 0 ] || tar -xf - || exit 1
+  $store true
+  for cell in $cells; do
+    nohup ~/scripts/incoming.sh $CIRCLE_PROJECT_REPONAME/\$cell/ > ~/incoming/$CIRCLE_PROJECT_REPONAME/\$cell/process.log 2>&1 < /dev/null &
+  done"
+echo Deployed and triggered Deploy Hooks for: $cells"""
+)
+
+# Content-addressed deploy (settings.yml `deploy: {dedupe: true}`): the
+# server-side half is rpm-dedupe.sh, shipped inline by the deploy job.
+rpm_dedupe_script = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "rpm-dedupe.sh"
+)
+
+
+def command_dedupe_check(remote_root, manifest_command):
+    """Send a sha256 manifest, link what the server has, list what it lacks.
+
+    Installs rpm-dedupe.sh as ~/.buildstrap/rpm-dedupe.sh on the build server
+    and runs its `check` in the same SSH session; the relpaths it still
+    needs end up in /tmp/rpm-upload.
+    """
+    with open(rpm_dedupe_script, "r") as f:
+        script = f.read()
+    return LiteralString(
+        "cat > /tmp/rpm-dedupe.sh <<'RPM_DEDUPE'\n"
+        + script
+        + "RPM_DEDUPE\n"
+        + f"{manifest_command} > /tmp/rpm-manifest\n"
+        + "ssh -o StrictHostKeyChecking=no -q $GPS_BUILD_USER@$GPS_BUILD_SERVER \\\n"
+        + '  "mkdir -p ~/.buildstrap'
+        + " && echo $(base64 < /tmp/rpm-dedupe.sh | tr -d '\\n') | base64 -d > ~/.buildstrap/rpm-dedupe.sh"
+        + f' && sh ~/.buildstrap/rpm-dedupe.sh check {remote_root}" \\\n'
+        + "  < /tmp/rpm-manifest > /tmp/rpm-upload\n"
+        + 'echo "$(wc -l < /tmp/rpm-upload) of $(wc -l < /tmp/rpm-manifest) RPMs need uploading"'
+    )
+
+
+command_upload_missing_rpms = LiteralString(
+    r"""if [ -s /tmp/rpm-upload ]; then
+  scp -o StrictHostKeyChecking=no -q $(cat /tmp/rpm-upload) $GPS_BUILD_USER@$GPS_BUILD_SERVER:~/incoming/${CIRCLE_PROJECT_REPONAME}/${DISTRO}/${ARCH}/${CIRCLE_BRANCH}/
+fi"""
+)
+
+command_store_and_trigger_incoming_hook = FoldedString(
+    "ssh -o StrictHostKeyChecking=no -q $GPS_BUILD_USER@$GPS_BUILD_SERVER"
+    ' "sh ~/.buildstrap/rpm-dedupe.sh store ~/incoming/${CIRCLE_PROJECT_REPONAME}/${DISTRO}/${ARCH}/${CIRCLE_BRANCH}/'
+    ' && nohup ~/scripts/incoming.sh ${CIRCLE_PROJECT_REPONAME}/${DISTRO}/${ARCH}/${CIRCLE_BRANCH}/ > ~/incoming/$CIRCLE_PROJECT_REPONAME/$DISTRO/${ARCH}/${CIRCLE_BRANCH}/process.log 2>&1 < /dev/null &"'
+)
+
+command_incoming_mkdir = FoldedString(
     "ssh -o StrictHostKeyChecking=no "
     "$GPS_BUILD_USER@$GPS_BUILD_SERVER "
     '"mkdir -p ~/incoming/${CIRCLE_PROJECT_REPONAME}/${DISTRO}/${ARCH}/${CIRCLE_BRANCH}"'  # this way quotoing is important otherwise ~ resolves on local machine to /root
 )
 
-command_deploy_all_rpms = FoldedScalarString(
+command_deploy_all_rpms = FoldedString(
     "scp -o StrictHostKeyChecking=no -q -r *.rpm "
     "$GPS_BUILD_USER@$GPS_BUILD_SERVER:~/incoming/${CIRCLE_PROJECT_REPONAME}/${DISTRO}/${ARCH}/${CIRCLE_BRANCH}/"
 )
 
-command_trigger_incoming_hook = FoldedScalarString(
+command_trigger_incoming_hook = FoldedString(
     "ssh -o StrictHostKeyChecking=no -q $GPS_BUILD_USER@$GPS_BUILD_SERVER"
     ' "nohup ~/scripts/incoming.sh ${CIRCLE_PROJECT_REPONAME}/${DISTRO}/${ARCH}/${CIRCLE_BRANCH}/ > ~/incoming/$CIRCLE_PROJECT_REPONAME/$DISTRO/${ARCH}/${CIRCLE_BRANCH}/process.log 2>&1&"'
 )
 
-build_steps = [
-    "checkout",
-]
 
-# TODO migrate to custom_steps_after_checkout: from matrix.yml
-if collection_name == "nginx":
-    build_steps += [
+# Split debug lane (settings.yml `deploy: {split_debug: true}`): builds move
+# their debuginfo/debugsource RPMs out of the workspace into a cache entry of
+# their own, which a deploy_debug job uploads after the runtime deploy.
+command_set_aside_debug_rpms = LiteralString(
+    r"""mkdir -p /tmp/debug-rpms
+find /output -maxdepth 1 -type f \( -name '*-debuginfo-*.rpm' -o -name '*-debugsource-*.rpm' \) \
+  -exec mv -t /tmp/debug-rpms/ {} +
+ls -al /tmp/debug-rpms"""
+)
+
+command_deploy_halt_without_debug_rpms = LiteralString(
+    r"""if ! ls /tmp/debug-rpms/*.rpm 1> /dev/null 2>&1; then
+  echo "No debug RPMs to deploy."
+  circleci-agent step halt
+fi"""
+)
+
+command_deploy_debug_rpms = FoldedString(
+    "scp -o StrictHostKeyChecking=no -q /tmp/debug-rpms/*.rpm "
+    "$GPS_BUILD_USER@$GPS_BUILD_SERVER:~/incoming/${CIRCLE_PROJECT_REPONAME}/${DISTRO}/${ARCH}/${CIRCLE_BRANCH}/"
+)
+
+
+def debug_rpms_cache_key(build_job, node):
+    """Cache key of a build node's debug RPMs.
+
+    The workspace ID survives "rerun from failed", the build job's name
+    tells the cells (and matrix instances) apart; the trailing "-rpms" keeps
+    restore_cache's prefix match from picking another cell's or node's entry.
+    """
+    return (
+        "debug-rpms-v1-{{ .Environment.CIRCLE_WORKFLOW_WORKSPACE_ID }}-"
+        f"{build_job}-{node}-rpms"
+    )
+
+
+# Pre-flight plan (settings.yml `plan: true`): the per-cell published-NVR
+# check is plan-cells.sh, shipped inline by the plan job.
+plan_cells_script = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "plan-cells.sh"
+)
+
+
+def command_plan_cells():
+    """Decide skip/build for every cell of the plan job's dist."""
+    with open(plan_cells_script, "r") as f:
+        script = f.read()
+    return LiteralString(
+        "mkdir -p /tmp/plan\n"
+        + "cat > /tmp/plan-cells.sh <<'PLAN_CELLS'\n"
+        + script
+        + "PLAN_CELLS\n"
+        + "sh /tmp/plan-cells.sh /tmp/plan/<< parameters.dist >>.plan << parameters.cells >>"
+    )
+
+
+# Setup stage: every filter step appends the names of the workflows it rules
+# out to /tmp/skip-workflows; they are dropped from the continuation config
+# in one go at the end.
+command_filter_planned_workflows = LiteralString(
+    r"""cat /tmp/plan/*.plan | awk '
+  $2 == "build" { build[$1] = 1 }
+  $2 == "skip" { skip[$1] = 1 }
+  END { for (w in skip) if (!(w in build)) print w }' > /tmp/published-workflows
+echo "Already published, not scheduled: $(tr '\n' ' ' < /tmp/published-workflows)"
+cat /tmp/published-workflows >> /tmp/skip-workflows"""
+)
+
+command_drop_skipped_workflows = LiteralString(
+    r"""touch /tmp/skip-workflows
+jq --argjson skip "$(jq -R . < /tmp/skip-workflows | jq -s .)" \
+  'reduce $skip[] as $w (.; del(.workflows[$w]))' \
+  .circleci/continue_config.json > /tmp/continue_config.json
+if [ "$(jq '.workflows | length' /tmp/continue_config.json)" -eq 0 ]; then
+  echo "No workflow left to run. Nothing to build."
+  circleci-agent step halt
+fi"""
+)
+
+
+def case_pattern(pattern):
+    """A path glob as a shell `case` pattern.
+
+    `*`, `?` and bracket expressions stay globs, everything else is quoted,
+    so whitespace, `)`, `;`, `|` or `$` in settings.yml globs match
+    literally instead of breaking the setup script. Bracket expressions may
+    only hold letters, digits and `._+/-` (`[^...]` becomes `[!...]`);
+    ValueError otherwise.
+    """
+    parts = []
+    # Odd items are the glob tokens, even ones the literal text around them
+    for i, token in enumerate(re.split(r"(\*|\?|\[[^]]+\])", pattern)):
+        if i % 2 == 0:
+            if token:
+                parts.append(shlex.quote(token))
+        elif token.startswith("["):
+            if not re.fullmatch(r"\[[!^]?[\w.+/-]+\]", token):
+                raise ValueError(f"unsupported bracket expression {token!r} in glob {pattern!r}")
+            parts.append("[!" + token[2:] if token[1] == "^" else token)
+        else:
+            parts.append(token)
+    return "".join(parts)
+
+
+def command_filter_unchanged_workflows(change_rules):
+    """Rule out the workflows no path changed since the last push affects.
+
+    `change_rules` is [(case pattern, [workflow names])], first match wins; a
+    changed path matching no rule affects every workflow, as does a push
+    without a usable base revision (new branch, force push).
+    """
+    cases = "".join(
+        f"    {pattern}) echo {' '.join(workflows) or ':'} ;;\n"
+        for pattern, workflows in change_rules
+    )
+    return LiteralString(
+        'base="<< pipeline.git.base_revision >>"\n'
+        + 'if [ -z "$base" ] || ! git cat-file -e "$base^{commit}" 2> /dev/null; then\n'
+        + '  echo "No base revision to compare with. Building everything."\n'
+        + "  exit 0\n"
+        + "fi\n"
+        + 'git diff --name-only "$base" "<< pipeline.git.revision >>" > /tmp/changed-paths\n'
+        + "while read -r path; do\n"
+        + '  case "$path" in\n'
+        + cases
+        + "    *) echo '*' ;;\n"
+        + "  esac\n"
+        + "done < /tmp/changed-paths | tr ' ' '\\n' | grep -vx : | sort -u > /tmp/affected-workflows || true\n"
+        + "if grep -qxF '*' /tmp/affected-workflows; then\n"
+        + '  echo "Changes affect every workflow."\n'
+        + "  exit 0\n"
+        + "fi\n"
+        + "jq -r '.workflows | keys[]' .circleci/continue_config.json \\\n"
+        + "  | grep -vxF -f /tmp/affected-workflows > /tmp/unchanged-workflows || true\n"
+        + 'echo "Not affected by the changes, not scheduled: $(tr \'\\n\' \' \' < /tmp/unchanged-workflows)"\n'
+        + "cat /tmp/unchanged-workflows >> /tmp/skip-workflows"
+    )
+
+
+def command_filter_unrequested_workflows(workflow_cells):
+    """Rule out the workflows outside the pipeline's build_* parameters.
+
+    `workflow_cells` maps workflow names to (dist version, arch, branch).
+    """
+    table = "".join(
+        f"{name} {dist_version} {arch} {branch}\n"
+        for name, (dist_version, arch, branch) in workflow_cells.items()
+    )
+    return LiteralString(
+        "cat > /tmp/workflow-cells <<'WORKFLOW_CELLS'\n"
+        + table
+        + "WORKFLOW_CELLS\n"
+        + r"""DISTS='<< pipeline.parameters.build_dists >>' ARCHS='<< pipeline.parameters.build_archs >>' \
+  BRANCHES='<< pipeline.parameters.build_branches >>' awk '
+  function outside(value, pattern) { return value !~ ("^(" pattern ")$") }
+  outside($2, ENVIRON["DISTS"]) || outside($3, ENVIRON["ARCHS"]) || outside($4, ENVIRON["BRANCHES"]) {
+    print $1
+  }' /tmp/workflow-cells > /tmp/unrequested-workflows
+echo "Not requested by the pipeline parameters, not scheduled: $(tr '\n' ' ' < /tmp/unrequested-workflows)"
+cat /tmp/unrequested-workflows >> /tmp/skip-workflows"""
+    )
+
+
+def cell_condition(dist_version, arch, branch):
+    """Workflow `when:` matching the cell against the build_* pipeline parameters."""
+    return {
+        "and": [
+            {"matches": {"pattern": f"<< pipeline.parameters.build_{key} >>", "value": value}}
+            for key, value in (("dists", dist_version), ("archs", arch), ("branches", branch))
+        ]
+    }
+
+
+# Build phase timings (settings.yml `instrument: true`): the recording half is
+# build-timings.sh, shipped inline by the build job; timings_report.py merges
+# the resulting build-timings.json artifacts.
+build_timings_script = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "build-timings.sh"
+)
+
+command_build_timings_report = LiteralString(
+    r"""sh /tmp/build-timings.sh report /output/build-timings \
+  repo="$CIRCLE_PROJECT_REPONAME" job="$CIRCLE_JOB" build_num="$CIRCLE_BUILD_NUM" \
+  workflow_id="$CIRCLE_WORKFLOW_ID" dist=<< parameters.dist >> arch=<< parameters.arch >> \
+  branch=<< parameters.branch >> resource_class=<< parameters.resource_class >>"""
+)
+
+
+def command_mark_phase(phase):
+    return f"sh /tmp/build-timings.sh mark {phase}"
+
+
+def instrument_build_steps(build_steps):
+    """Wrap the build job's steps with phase marks and a timings report.
+
+    Phases: checkout, setup (everything up to the build), the build's own
+    rpmbuild stages and rpmlint (marked from its output), results (test
+    results, RPM check, staging), persist. The report lands in
+    /output/build-timings (JSON + JUnit) and is stored as artifact and
+    test results.
+    """
+    with open(build_timings_script, "r") as f:
+        script = f.read()
+
+    def mark(phase):
+        return {"run": {"name": f"Build phase: {phase}", "command": command_mark_phase(phase)}}
+
+    steps = [
         {
             "run": {
-                "name": "Set up RPM macro reflecting the NGINX branch",
-                "command": 'echo "%nginx_branch ${CIRCLE_BRANCH}" >> rpmmacros',
+                "name": "Start build phase timings",
+                "command": LiteralString(
+                    "cat > /tmp/build-timings.sh <<'BUILD_TIMINGS'\n"
+                    + script
+                    + "BUILD_TIMINGS\n"
+                    + command_mark_phase("checkout")
+                ),
             }
         },
+    ]
+    for step in build_steps:
+        if isinstance(step, dict) and step.get("run", {}).get("name", "").startswith(
+            "Run the build itself"
+        ):
+            steps.append(mark("deps"))
+            steps.append(
+                {
+                    "run": {
+                        **step["run"],
+                        "command": f"({step['run']['command']}) 2>&1 | sh /tmp/build-timings.sh filter",
+                    }
+                }
+            )
+            steps.append(mark("results"))
+            continue
+        if isinstance(step, dict) and "persist_to_workspace" in step:
+            steps.append(mark("persist"))
+        steps.append(step)
+        if step == "checkout":
+            steps.append(mark("setup"))
+    return steps + [
         {
             "run": {
-                "name": "Set up %plesk macro if passed by a job",
-                "command": command_set_nginx_macros,
+                "name": "Write build phase timings report",
+                "command": command_build_timings_report,
+                "when": "always",
             }
         },
+        {"store_artifacts": {"path": "/output/build-timings"}},
+        {"store_test_results": {"path": "/output/build-timings"}},
+    ]
+
+
+@lru_cache(maxsize=None)
+def ruamel_yaml():
+    """The ruamel YAML handler (round-trip settings.yml loads, emitter fallback)."""
+    from ruamel.yaml import YAML
+
+    yaml = YAML()
+    yaml.default_flow_style = False
+    # Instruct the representer to ignore aliases
+    yaml.representer.ignore_aliases = lambda *args: True
+    # The command block scalars, as ruamel writes LiteralScalarString/FoldedScalarString
+    for cls, style in ((LiteralString, "|"), (FoldedString, ">")):
+        yaml.representer.add_representer(
+            cls,
+            lambda representer, data, style=style: representer.represent_scalar(
+                "tag:yaml.org,2002:str", str(data), style=style
+            ),
+        )
+    return yaml
+
+
+def load_project_settings(project_dir):
+    """Read settings.yml from the project directory; missing/empty → {}."""
+    settings_file = os.path.join(project_dir, "settings.yml")
+    if not os.path.exists(settings_file):
+        return {}
+    with open(settings_file, "r") as f:
+        project_settings = ruamel_yaml().load(f)
+    if project_settings is None:
+        project_settings = {}
+    return project_settings
+
+
+def spec_paths(project_dir):
+    return [
+        os.path.join(project_dir, f) for f in sorted(os.listdir(project_dir)) if f.endswith(".spec")
+    ]
+
+
+def detect_archs(project_dir, project_settings):
+    # Get architectures from settings.yml or default to the default_archs
+    archs = project_settings.get("archs", default_archs)
+    # An explicit `archs:` in settings.yml wins over spec sniffing. Otherwise the
+    # specs' headers decide (see specscan.py): ["noarch"] if every spec is
+    # noarch, else the default archs at least one spec can be built on (a
+    # spec's ExclusiveArch/ExcludeArch, macros and %ifarch blocks included).
+    # If no spec says anything usable, keep the default matrix.
+    if "archs" not in project_settings:
+        archs = specscan.project_archs(spec_paths(project_dir), default_archs) or archs
+    exclude_archs = project_settings.get("exclude_archs", [])
+
+    # Exclude architectures
+    return [arch for arch in archs if arch not in exclude_archs]
+
+
+def resolve_branches(project_name, project_settings, matrix_config, self_mode):
+    """Return (branches, collection_name) for the project."""
+    # Get the branches from matrix.json "collections": { "nginx": { "branches": {
+    # what branches depends on detected collection, e.g. "nginx"
+    if self_mode:
+        # Tag-triggered: no branch axis. Sentinel single-branch keeps the existing
+        # distros × branches × archs loop intact while emitting workflow names
+        # without a branch suffix (per get_workflow_name's len(branches) == 1
+        # short-circuit). collection_name forced None so nginx-only blocks below
+        # (custom setup steps, plesk/mod/failure_tolerance params, enable_repos
+        # default) all stay dormant.
+        return {"__self__": {"description": "tag-triggered self build"}}, None
+    branches = {
+        "master": {
+            "description": "Main release branch",
+        }
+    }
+    collection_name = None
+    # if the project (directory) name starts with "nginx-", set collection_name to "nginx"
+    if project_name.startswith("nginx-"):
+        collection_name = "nginx"
+    # settings can specify collection name explicitly
+    collection_name = project_settings.get("collection", collection_name)
+    if collection_name:
+        branches = matrix_config["collections"][collection_name]["branches"]
+    # project can override branches or specify 'all'
+    branches = project_settings.get("branches", branches)
+    # project can explicitly specify a set of branches to reduce, using branch:
+    # then filter out branches that are not in the list
+    if "branch" in project_settings:
+        branches = {k: v for k, v in branches.items() if k in project_settings["branch"]}
+    # project can exclude branches, e.g. plesk, by specifying exclude_branches:
+    if "exclude_branches" in project_settings:
+        branches = {
+            k: v
+            for k, v in branches.items()
+            if k not in project_settings["exclude_branches"]
+        }
+    return branches, collection_name
+
+
+# Function to generate workflow names
+def get_workflow_name(dist, version, branch, arch, branches):
+    # if this is the only branch, don't include it in the workflow name
+    # note that brandh is a dictionary, so we need to get the key count
+    if len(branches) == 1:
+        return f"build-deploy-{dist}{version}-{arch}"
+    return f"build-deploy-{dist}{version}-{branch}-{arch}"
+
+
+def get_build_job_name(dist, version, branch, arch, branches):
+    # if this is the only branch, don't include it in the job name
+    if len(branches) == 1:
+        return f"build-{dist}{version}-{arch}"
+    return f"build-{dist}{version}-{branch}-{arch}"
+
+
+def get_deploy_job_name(dist, version, branch, arch, branches):
+    # if this is the only branch, don't include it in the job name
+    if len(branches) == 1:
+        return f"deploy-{dist}{version}-{arch}"
+    return f"deploy-{dist}{version}-{branch}-{arch}"
+
+
+def get_debug_deploy_job_name(dist, version, branch, arch, branches):
+    # split debug lane: one per cell, after the cell's deploy
+    if len(branches) == 1:
+        return f"deploy-debug-{dist}{version}-{arch}"
+    return f"deploy-debug-{dist}{version}-{branch}-{arch}"
+
+
+def get_branch_deploy_job_name(branch, branches):
+    # fan-in deploy: one per branch workflow
+    if len(branches) == 1:
+        return "deploy"
+    return f"deploy-{branch}"
+
+
+def get_branch_workflow_name(branch, branches):
+    # compact / fan-in layouts: one workflow per branch
+    if len(branches) == 1:
+        return "build-deploy"
+    return f"build-deploy-{branch}"
+
+
+def get_prefetch_job_name(branch, branches):
+    # source prefetch: one per branch workflow
+    if len(branches) == 1:
+        return "prefetch"
+    return f"prefetch-{branch}"
+
+
+def branch_workflows(cell_workflows, branches, use_matrix=True, fan_in=False, prefetch=False):
+    """Fold per-cell workflows into one workflow per branch.
+
+    With `use_matrix` (settings.yml `compact: true`), cells whose build/deploy
+    jobs differ only by dist become a single `matrix: {parameters: {dist:
+    [...]}}` job pair, so the projected job names (build-el9-x86_64,
+    deploy-el9-x86_64, ...) and therefore deploy paths and status checks stay
+    the same. With `fan_in` the per-cell deploy jobs are replaced by a single
+    `deploy_branch` job per branch that requires all of the branch's builds.
+    With `prefetch` every workflow starts with a `prefetch` job (run on the
+    branch's first dist) that the builds require. Workflows are named `build-deploy` (single branch) or
+    `build-deploy-<branch>`.
+    """
+    dist_placeholder = "<< matrix.dist >>"
+    grouped = {}
+    for cell, _, jobs in cell_workflows:
+        branch_groups, extra_jobs = grouped.setdefault(cell.branch, ({}, []))
+        build_job, deploy_job = jobs[0]["build"], jobs[1]["deploy"]
+        build_params = {k: v for k, v in build_job.items() if k not in ("name", "dist")}
+        deploy_params = {
+            k: v for k, v in deploy_job.items() if k not in ("name", "dist", "requires")
+        }
+        key = json.dumps([cell.arch, cell.axes, build_params, deploy_params], sort_keys=True)
+        if not use_matrix:
+            key += cell.dist_version
+        group = branch_groups.setdefault(
+            key,
+            {
+                "cell": cell,
+                "dists": [],
+                "names": [],
+                "jobs": jobs[:2],
+                "build": build_params,
+                "deploy": deploy_params,
+            },
+        )
+        group["dists"].append(cell.dist_version)
+        group["names"].append(build_job["name"])
+        # Smoke and debug deploy jobs are opt-in per cell; keep them as plain jobs
+        extra_jobs.extend(jobs[2:])
+
+    workflows = {}
+    for branch, (branch_groups, extra_jobs) in grouped.items():
+        workflow_jobs = []
+        build_names = []
+        if prefetch:
+            first_group = next(iter(branch_groups.values()))
+            workflow_jobs.append(
+                {
+                    "prefetch": {
+                        "name": get_prefetch_job_name(branch, branches),
+                        "context": "org-global",
+                        "dist": first_group["dists"][0],
+                        "filters": first_group["build"]["filters"],
+                    }
+                }
+            )
+        for group in branch_groups.values():
+            build_names += group["names"]
+            if len(group["dists"]) == 1:
+                workflow_jobs += group["jobs"][:1] if fan_in else group["jobs"]
+                continue
+            cell = group["cell"]
+            build_name = get_build_job_name(
+                dist_placeholder, "", branch, cell.arch, branches
+            ) + cell.suffix
+            deploy_name = get_deploy_job_name(
+                dist_placeholder, "", branch, cell.arch, branches
+            ) + cell.suffix
+            matrix = {"parameters": {"dist": group["dists"]}}
+            workflow_jobs.append(
+                {"build": {"name": build_name, "matrix": matrix, **group["build"]}}
+            )
+            if fan_in:
+                continue
+            workflow_jobs.append(
+                {
+                    "deploy": {
+                        "name": deploy_name,
+                        "matrix": matrix,
+                        **group["deploy"],
+                        "requires": [build_name],
+                    }
+                }
+            )
+        if fan_in:
+            first_deploy = next(iter(branch_groups.values()))["deploy"]
+            fan_in_name = get_branch_deploy_job_name(branch, branches)
+            workflow_jobs.append(
+                {
+                    "deploy_branch": {
+                        "name": fan_in_name,
+                        "context": first_deploy["context"],
+                        "filters": first_deploy["filters"],
+                        "requires": build_names,
+                    }
+                }
+            )
+            # Smoke and debug deploy jobs chain after the branch deploy
+            # instead of the cell's
+            extra_jobs = [
+                {name: {**params, "requires": [fan_in_name]}}
+                for job in extra_jobs
+                for name, params in job.items()
+            ]
+        workflows[get_branch_workflow_name(branch, branches)] = {"jobs": workflow_jobs + extra_jobs}
+    return workflows
+
+
+def generate(
+    project_dir, matrix_config, history=None, project_name=None, restrict=None, image_lock=None
+):
+    """Build the CircleCI config (a plain dict) for one project directory.
+
+    `history` is a sizing.load_history() index; cells with history get the
+    cheapest resource_class that fits them. `project_name` is the repository
+    name (nginx-* collection detection, history lookups), by default the
+    directory's name. `image_lock` is a load_image_lock() map, used by
+    projects with settings.yml `pin_images: true`.
+
+    With a setup stage this is the continuation config (what ends up in
+    .circleci/continue_config.json), see generate_files().
+    """
+    return _generate(
+        project_dir, matrix_config, history, project_name, restrict, image_lock
+    )[0]
+
+
+def template_continuation(circleci_config):
+    """generate()'s config as the config.yml setup template continues with it
+    (--output): declaring every parameter of the template, see
+    setup_template_parameters."""
+    circleci_config = dict(circleci_config)
+    circleci_config.pop("parameters", None)
+    return {
+        "version": circleci_config.pop("version"),
+        "parameters": setup_template_parameters,
+        **circleci_config,
+    }
+
+
+def _generate(
+    project_dir, matrix_config, history=None, project_name=None, restrict=None, image_lock=None
+):
+    """generate(), plus the setup stage's inputs ({} without a setup stage)."""
+    # Determine the project directory
+    project_dir = os.path.abspath(project_dir)
+    # History records are keyed by repo name, i.e. the project directory's
+    # (a CI checkout lives in ~/project: pass the name explicitly there)
+    project_name = project_name or os.path.basename(project_dir)
+    project_settings = load_project_settings(project_dir)
+
+    exclude_patterns = project_settings.get("exclude", [])
+    # `dists:` is an allowlist (symmetric to `archs:`) over dist / dist-version /
+    # dist-version-arch fnmatch patterns. Empty list / unset = no allowlist (build
+    # everywhere except `exclude`). Use this when a repo is intrinsically scoped to
+    # a subset of the matrix (e.g. libseccomp-rpm is el7-only because newer distros
+    # already ship libseccomp >= 2.5.x); future new distros are excluded by default
+    # instead of silently joining the build matrix.
+    dists_allowlist = project_settings.get("dists", [])
+
+    # Self mode: tag-triggered release builds (ngm, fds, stack-scripts).
+    # Replaces the verbatim generated_config_self.yml template — single boolean
+    # `self: true` in settings.yml flips the generator to:
+    #   - no collection / no branch-axis (per-distro × per-arch × single workflow)
+    #   - build command `./utils/version-from-tag.sh && build`
+    #   - tag filters (build: /.*/, deploy: /^v.*/ branches ignored)
+    #   - small resource_class default
+    #   - no enable_repos / no nginx-collection plumbing
+    # Any settings.yml knob (e.g. explicit `archs:`) still wins.
+    self_mode = bool(project_settings.get("self", False))
+    archs = detect_archs(project_dir, project_settings)
+    branches, collection_name = resolve_branches(
+        project_name, project_settings, matrix_config, self_mode
+    )
+    # Extra matrix axes (matrix.yml `axes:`) enabled for this project, e.g. an
+    # OpenSSL flavour. Each becomes a build job parameter + executor env var
+    # and a suffix on the cell's workflow/job names.
+    axes = buildmatrix.resolve_axes(matrix_config, collection_name, project_settings)
+
+    resource_class = "medium"
+    # Self mode default is small (verbatim template parity).
+    if self_mode:
+        resource_class = "small"
+    # if only noarch, fine with small
+    if len(archs) == 1 and "noarch" in archs:
+        resource_class = "small"
+    # projects may override resource class
+    resource_class = project_settings.get("resource_class", resource_class)
+    arm_resource_class = "arm." + arm_resource_class_mappings.get(
+        resource_class, resource_class
+    )
+
+    # Opt-in post-deploy smoke install jobs. Shape (per-project settings.yml):
+    #   post_deploy_smoke:
+    #     <branch>:
+    #       dists: [el9, ...]
+    #       archs: [x86_64, aarch64]
+    # Absent / empty → no smoke jobs emitted (default-off; consumers not opting in
+    # regenerate a byte-identical .circleci/config.yml). Smoke body lives in the
+    # consumer repo at scripts/smoke.sh; the generated job just `checkout`s and
+    # runs that script under the rpmbuilder executor.
+    post_deploy_smoke = project_settings.get("post_deploy_smoke") or {}
+
+    # Opt-in compact layout (settings.yml `compact: true`): one workflow per
+    # branch with CircleCI `matrix:` jobs instead of one workflow per cell.
+    compact = bool(project_settings.get("compact"))
+    # Opt-in deploy tuning (settings.yml `deploy:` block). `fan_in: true`
+    # replaces the per-cell deploy jobs (one container + three SSH handshakes
+    # each) with one deploy job per branch uploading over a single SSH session.
+    deploy_settings = project_settings.get("deploy") or {}
+    fan_in = bool(deploy_settings.get("fan_in"))
+    # `dedupe: true` uploads only RPMs whose sha256 the build server's content
+    # store (rpm-dedupe.sh) doesn't have yet; the rest are hard-linked there.
+    dedupe = bool(deploy_settings.get("dedupe"))
+    # `split_debug: true` keeps debuginfo/debugsource RPMs out of the
+    # workspace: they go to a cache entry per build node and a deploy_debug
+    # job per cell uploads them after the runtime RPMs were deployed, without
+    # holding anything up.
+    split_debug = bool(deploy_settings.get("split_debug"))
+    # Opt-in source prefetch (settings.yml `prefetch: true`): one job per
+    # branch downloads and verifies the sources once, the builds pick them up
+    # from the workspace instead of each hitting upstream on its own.
+    prefetch = bool(project_settings.get("prefetch")) and not self_mode
+    # Opt-in build phase timings (settings.yml `instrument: true`), see
+    # instrument_build_steps() and timings_report.py
+    instrument = bool(project_settings.get("instrument"))
+    # These layouts put all cells of a branch into a single workflow
+    per_branch = compact or fan_in or prefetch
+    # Opt-in build caches (settings.yml `cache:` block): `ccache: true` keeps
+    # a ccache directory per dist/arch/axes/branch/specs, `sources: true` the
+    # downloaded Source files per set of (expanded) Source lines, `packages:
+    # true` the packager's metadata and BuildRequires per dist/arch/
+    # enable_repos/day (`keepcache: false`: metadata only).
+    cache_settings = project_settings.get("cache") or {}
+    # Opt-in pre-flight plan stage (settings.yml `plan: true`): a setup
+    # workflow of small per-dist jobs checks which cells' NVRs are already
+    # published and only continues with the workflows that have work left,
+    # so no build executor is allocated for a no-op cell. Tag-triggered
+    # self builds always build.
+    plan = bool(project_settings.get("plan")) and not self_mode
+    # Opt-in change-aware builds (settings.yml `changes:`): the setup stage
+    # diffs the push against the previous one and only continues with the
+    # workflows whose cells a changed path can affect (see change_rules()).
+    # `changes: true` only maps per-branch directories, a mapping adds rules.
+    changes_settings = project_settings.get("changes")
+    changes = bool(changes_settings) and not self_mode
+    # Opt-in sharded builds (settings.yml `shards: <nodes>`): the build job
+    # runs with that `parallelism`, every node builds its share of the specs
+    # (split by their build times from --history) and persists its RPMs under
+    # shards/<node>/ for the deploy to collect.
+    shards = int(project_settings.get("shards") or 1)
+    sharded = shards > 1
+    # Opt-in cell-scoped pipeline parameters (settings.yml `cell_parameters:
+    # true`): a triggered pipeline can limit its workflows to dist versions /
+    # archs / branches (see cell_pipeline_parameters), e.g. to build a newly
+    # added distro only. Workflows carry `when:` conditions, or the setup
+    # stage drops the unrequested ones when there is one. A per-branch
+    # layout's workflow holds every dist and arch of its branch, so it can't
+    # honour build_dists / build_archs: those projects are refused rather
+    # than quietly building everything.
+    cell_parameters = bool(project_settings.get("cell_parameters"))
+    # Opt-in image pinning (settings.yml `pin_images: true`): builds run on
+    # the rpmbuilder image digest recorded for their dist in the image lock
+    # (pull_images.py), so every cell of a pipeline - and a rerun of it -
+    # gets the same image even if the tag moves meanwhile. Dists missing
+    # from the lock use the tag.
+    pin_images = bool(project_settings.get("pin_images"))
+    image_lock = (image_lock or {}) if pin_images else {}
+
+    if cell_parameters and per_branch:
+        raise ValueError(
+            "settings.yml cell_parameters can't be combined with compact, deploy.fan_in "
+            "or prefetch: their per-branch workflows can't skip single dists or archs"
+        )
+
+    build_steps = [
+        "checkout",
+    ]
+
+    # TODO migrate to custom_steps_after_checkout: from matrix.yml
+    if collection_name == "nginx":
+        build_steps += [
+            {
+                "run": {
+                    "name": "Set up RPM macro reflecting the NGINX branch",
+                    "command": 'echo "%nginx_branch ${CIRCLE_BRANCH}" >> rpmmacros',
+                }
+            },
+            {
+                "run": {
+                    "name": "Set up %plesk macro if passed by a job",
+                    "command": command_set_nginx_macros,
+                }
+            },
+            {
+                "run": {
+                    "name": "Run script to cleanup spec files that don't need rebuilding",
+                    "command": command_spec_files_cleanup,
+                }
+            },
+        ]
+
+    if sharded:
+        weights = sizing.spec_weights(sizing.project_history(history, project_name))
+        build_steps += [
+            {
+                "run": {
+                    "name": "Keep only the specs of this node",
+                    "command": command_select_shard_specs(
+                        weights, sizing.median(weights.values()) if weights else 1
+                    ),
+                }
+            },
+        ]
+
+    if prefetch:
+        build_steps += [
+            {"attach_workspace": {"at": "/tmp/workspace"}},
+            {
+                "run": {
+                    "name": "Use prefetched sources",
+                    "command": command_use_prefetched_sources,
+                }
+            },
+        ]
+
+    # Cache keys: extra axes change the compiler flags, keep their objects apart
+    ccache_key_prefix = "ccache-v1-<< parameters.dist >>-{{ arch }}" + "".join(
+        f"-<< parameters.{axis_name} >>" for axis_name, _ in axes
+    )
+    # Keyed by the cell's matrix branch, not the git branch ({{ .Branch }}):
+    # several matrix branches (e.g. nginx stable and mainline) build from the
+    # same git branch
+    ccache_key = ccache_key_prefix + '-<< parameters.branch >>-{{ checksum "/tmp/cache-spec" }}'
+    sources_key = 'sources-v1-{{ checksum "/tmp/cache-sources" }}'
+    # Packages depend on the repos enabled next to the dist's own; a new day
+    # starts a new entry, falling back to the previous one
+    packages_key_prefix = "packages-v1-<< parameters.dist >>-{{ arch }}" + (
+        "" if self_mode else "-<< parameters.enable_repos >>"
+    )
+    packages_key = packages_key_prefix + '-{{ checksum "/tmp/cache-day" }}'
+    if cache_settings.get("ccache") or cache_settings.get("sources"):
+        build_steps += [
+            {
+                "run": {
+                    "name": "Write build cache keys",
+                    "command": command_write_cache_keys,
+                }
+            },
+        ]
+    if cache_settings.get("ccache"):
+        build_steps += [
+            {
+                "restore_cache": {
+                    "keys": [
+                        ccache_key,
+                        ccache_key_prefix + "-<< parameters.branch >>-",
+                        ccache_key_prefix + "-",
+                    ]
+                }
+            },
+            {
+                "run": {
+                    "name": "Enable ccache",
+                    "command": command_enable_ccache,
+                }
+            },
+        ]
+    if cache_settings.get("sources"):
+        build_steps += [
+            {"restore_cache": {"keys": [sources_key]}},
+            {
+                "run": {
+                    "name": "Seed cached sources",
+                    "command": command_seed_sources,
+                }
+            },
+        ]
+    if cache_settings.get("packages"):
+        build_steps += [
+            {
+                "run": {
+                    "name": "Configure the package cache",
+                    "command": command_configure_package_cache,
+                }
+            },
+            {"restore_cache": {"keys": [packages_key, packages_key_prefix + "-"]}},
+        ]
+
+    build_steps += [
         {
             "run": {
-                "name": "Run script to cleanup spec files that don't need rebuilding",
-                "command": command_spec_files_cleanup,
+                "name": "Run the build itself: this will do rpmlint and check RPMs existence among other things.",
+                "command": "./utils/version-from-tag.sh && build" if self_mode else "build",
             }
         },
     ]
-
-build_steps += [
-    {
-        "run": {
-            "name": "Run the build itself: this will do rpmlint and check RPMs existence among other things.",
-            "command": "./utils/version-from-tag.sh && build" if self_mode else "build",
-        }
-    },
-]
-# Self mode skips store_test_results — verbatim template parity (no JUnit XML
-# expected for single-spec tag-triggered builds).
-if not self_mode:
+    # Saved right after the build: the RPM check below may halt the job, and
+    # objects of a failed build still speed up the next attempt.
+    if cache_settings.get("ccache"):
+        build_steps += [
+            {
+                "run": {
+                    "name": "Show ccache statistics",
+                    "command": command_ccache_stats,
+                    "when": "always",
+                }
+            },
+            {
+                "save_cache": {
+                    "key": ccache_key,
+                    "paths": ["/tmp/ccache"],
+                    "when": "always",
+                }
+            },
+        ]
+    if cache_settings.get("sources"):
+        build_steps += [
+            {
+                "run": {
+                    "name": "Collect downloaded sources",
+                    "command": command_collect_sources,
+                    "when": "always",
+                }
+            },
+            {
+                "save_cache": {
+                    "key": sources_key,
+                    "paths": ["/tmp/sources-cache"],
+                    "when": "always",
+                }
+            },
+        ]
+    if cache_settings.get("packages"):
+        build_steps += [
+            {
+                "save_cache": {
+                    "key": packages_key,
+                    "paths": ["<< parameters.package_cache >>"],
+                    "when": "always",
+                }
+            },
+        ]
+    # Self mode skips store_test_results — verbatim template parity (no JUnit XML
+    # expected for single-spec tag-triggered builds).
+    if not self_mode:
+        build_steps += [
+            {
+                "store_test_results": {
+                    "path": "/output/test-results",
+                }
+            },
+        ]
     build_steps += [
         {
-            "store_test_results": {
-                "path": "/output/test-results",
+            "run": {
+                "name": "Check for RPM files and halt if none exist",
+                "command": (
+                    command_check_rpm_files_halt_job
+                    if per_branch or sharded
+                    else command_check_rpm_files_halt
+                ),
+            }
+        },
+    ]
+    if split_debug:
+        build_steps += [
+            {
+                "run": {
+                    "name": "Set debug RPMs aside for the debug deploy",
+                    "command": command_set_aside_debug_rpms,
+                }
+            },
+            {
+                "save_cache": {
+                    "key": debug_rpms_cache_key(
+                        "{{ .Environment.CIRCLE_JOB }}", "{{ .Environment.CIRCLE_NODE_INDEX }}"
+                    ),
+                    "paths": ["/tmp/debug-rpms"],
+                }
+            },
+        ]
+    if fan_in:
+        build_steps += [
+            {
+                "run": {
+                    "name": "Stage RPMs under their dist/arch workspace path",
+                    "command": command_stage_rpms_by_cell,
+                }
+            },
+        ]
+    # Workspace path of the job's RPMs below /output
+    rpm_dir = "<< parameters.dist >>/<< parameters.arch >>" if fan_in else ""
+    if sharded:
+        build_steps += [
+            {
+                "run": {
+                    "name": "Stage RPMs under this node's shard workspace path",
+                    "command": command_stage_shard_rpms(rpm_dir),
+                }
+            },
+        ]
+        rpm_dir = "/".join(filter(None, ["shards/*", rpm_dir]))
+    build_steps += [
+        {
+            "persist_to_workspace": {
+                "root": "/output",
+                "paths": ["/".join(filter(None, [rpm_dir, "*.rpm"]))],
             }
         },
     ]
-build_steps += [
-    {
-        "run": {
-            "name": "Check for RPM files and halt if none exist",
-            "command": command_check_rpm_files_halt,
-        }
-    },
-    {"persist_to_workspace": {"root": "/output", "paths": ["*.rpm"]}},
-]
-
-build_job_parameters = {
-    "dist": {
-        "description": "The dist tag of OS to build for",
-        "type": "string",
-    },
-    "resource_class": {
-        "description": "The resource class to use for the build",
-        "type": "string",
-        "default": resource_class,
-    },
-}
 
-build_job_executor_parameters = {
-    "name": "rpmbuilder",
-    "dist": "<< parameters.dist >>",
-}
+    if instrument:
+        build_steps = instrument_build_steps(build_steps)
 
-rpmbuilder_executor_parameters = {
-    "dist": {"type": "string"},
-    "rpmlint": {"type": "integer", "default": 1},
-}
+    build_job_parameters = {
+        "dist": {
+            "description": "The dist tag of OS to build for",
+            "type": "string",
+        },
+        "resource_class": {
+            "description": "The resource class to use for the build",
+            "type": "string",
+            "default": resource_class,
+        },
+    }
 
-rpmbuilder_executor_environment = {
-    "RPMLINT": "<< parameters.rpmlint >>",
-}
+    build_job_executor_parameters = {
+        "name": "rpmbuilder",
+        "dist": "<< parameters.dist >>",
+    }
 
-# Self mode omits enable_repos entirely (verbatim template parity); non-self
-# repos always wire the standard enable_repos param/executor/env trio so that
-# the existing per-branch overrides + check_packages_in_repo short-circuit work.
-if not self_mode:
-    build_job_parameters["enable_repos"] = {"type": "string", "default": ""}
-    build_job_executor_parameters["enable_repos"] = "<< parameters.enable_repos >>"
-    rpmbuilder_executor_parameters["enable_repos"] = {"type": "string", "default": ""}
-    rpmbuilder_executor_environment["ENABLE_REPOS"] = "<< parameters.enable_repos >>"
-
-if collection_name == "nginx":
-    build_job_parameters["plesk"] = {
-        "description": "Plesk major release version number, e.g. 18",
-        "type": "integer",
-        "default": 0,
+    rpmbuilder_executor_parameters = {
+        "dist": {"type": "string"},
+        "rpmlint": {"type": "integer", "default": 1},
     }
-    build_job_parameters["mod"] = {
-        "description": "Set to 1 to build NGINX-MOD-specific module as well",
-        "type": "integer",
-        "default": 0,
+
+    rpmbuilder_executor_environment = {
+        "RPMLINT": "<< parameters.rpmlint >>",
     }
-    build_job_parameters["failure_tolerance"] = {
-        "description": "Per-build failure tolerance fraction passed to rpmbuilder (e.g. '1.0' for ea4 to keep going through known-broken specs).",
-        "type": "string",
-        "default": "0.1",
+
+    # Self mode omits enable_repos entirely (verbatim template parity); non-self
+    # repos always wire the standard enable_repos param/executor/env trio so that
+    # the existing per-branch overrides + check_packages_in_repo short-circuit work.
+    if not self_mode:
+        build_job_parameters["enable_repos"] = {"type": "string", "default": ""}
+        build_job_executor_parameters["enable_repos"] = "<< parameters.enable_repos >>"
+        rpmbuilder_executor_parameters["enable_repos"] = {"type": "string", "default": ""}
+        rpmbuilder_executor_environment["ENABLE_REPOS"] = "<< parameters.enable_repos >>"
+
+    if fan_in or instrument:
+        build_job_parameters["arch"] = {
+            "description": "The architecture the RPMs are deployed for (workspace path)",
+            "type": "string",
+        }
+    if instrument or cache_settings.get("ccache"):
+        build_job_parameters["branch"] = {
+            "description": "The matrix branch of the cell (timings report, ccache key)",
+            "type": "string",
+        }
+
+    if collection_name == "nginx":
+        build_job_parameters["plesk"] = {
+            "description": "Plesk major release version number, e.g. 18",
+            "type": "integer",
+            "default": 0,
+        }
+        build_job_parameters["mod"] = {
+            "description": "Set to 1 to build NGINX-MOD-specific module as well",
+            "type": "integer",
+            "default": 0,
+        }
+        build_job_parameters["failure_tolerance"] = {
+            "description": "Per-build failure tolerance fraction passed to rpmbuilder (e.g. '1.0' for ea4 to keep going through known-broken specs).",
+            "type": "string",
+            "default": "0.1",
+        }
+        build_job_executor_parameters["plesk"] = "<< parameters.plesk >>"
+        build_job_executor_parameters["mod"] = "<< parameters.mod >>"
+        build_job_executor_parameters["failure_tolerance"] = "<< parameters.failure_tolerance >>"
+        rpmbuilder_executor_parameters["plesk"] = {"type": "integer", "default": 0}
+        rpmbuilder_executor_parameters["mod"] = {"type": "integer", "default": 0}
+        rpmbuilder_executor_parameters["failure_tolerance"] = {"type": "string", "default": "0.1"}
+        rpmbuilder_executor_environment["PLESK"] = "<< parameters.plesk >>"
+        rpmbuilder_executor_environment["MOD"] = "<< parameters.mod >>"
+        rpmbuilder_executor_environment["FAILURE_TOLERANCE"] = "<< parameters.failure_tolerance >>"
+
+    for axis_name, _ in axes:
+        axis_description = matrix_config["axes"][axis_name].get("description", axis_name)
+        build_job_parameters[axis_name] = {
+            "description": axis_description,
+            "type": "string",
+            "default": "",
+        }
+        build_job_executor_parameters[axis_name] = f"<< parameters.{axis_name} >>"
+        rpmbuilder_executor_parameters[axis_name] = {"type": "string", "default": ""}
+        rpmbuilder_executor_environment[axis_name.upper().replace("-", "_")] = (
+            f"<< parameters.{axis_name} >>"
+        )
+
+    # The package cache directory follows each cell's packager; cells pass
+    # it when theirs differs from the distro_defaults one
+    default_package_cache = package_cache_dirs.get(
+        matrix_config.get("distro_defaults", {}).get("packager", "dnf")
+    )
+    if cache_settings.get("packages"):
+        build_job_parameters["package_cache"] = {
+            "description": "The packager's cache directory (matrix.yml packager)",
+            "type": "string",
+            "default": default_package_cache,
+        }
+        # `keepcache: false` caches the repo metadata only
+        build_job_executor_parameters["keepcache"] = int(cache_settings.get("keepcache", True))
+        rpmbuilder_executor_parameters["keepcache"] = {"type": "integer", "default": 1}
+        rpmbuilder_executor_environment["KEEPCACHE"] = "<< parameters.keepcache >>"
+
+    rpmbuilder_image = "getpagespeed/rpmbuilder:<< parameters.dist >>"
+    if pin_images:
+        build_job_parameters["image_digest"] = {
+            "description": "@sha256:... digest pinning the rpmbuilder image (empty: the tag)",
+            "type": "string",
+            "default": "",
+        }
+        build_job_executor_parameters["image_digest"] = "<< parameters.image_digest >>"
+        rpmbuilder_executor_parameters["image_digest"] = {"type": "string", "default": ""}
+        rpmbuilder_image += "<< parameters.image_digest >>"
+
+    circleci_config = {
+        "version": 2.1,
+        "executors": {
+            "deploy": {
+                "parameters": {"dist": {"type": "string"}, "arch": {"type": "string"}},
+                "docker": [{"image": "kroniak/ssh-client"}],
+                "working_directory": "/output",
+                "environment": {
+                    "DISTRO": "<< parameters.dist >>",
+                    "ARCH": "<< parameters.arch >>",
+                },
+            },
+            "rpmbuilder": {
+                "parameters": rpmbuilder_executor_parameters,
+                "docker": [{"image": rpmbuilder_image}],
+                "working_directory": "/sources",
+                "environment": rpmbuilder_executor_environment,
+            },
+        },
+        "jobs": {
+            "build": {
+                "parameters": build_job_parameters,
+                "resource_class": "<< parameters.resource_class >>",
+                "executor": build_job_executor_parameters,
+                "steps": build_steps,
+            },
+            "deploy": {
+                "parallelism": 1,
+                "parameters": {
+                    "dist": {
+                        "description": "The dist tag of OS to deploy for",
+                        "type": "string",
+                    },
+                    "arch": {
+                        "description": "The architecture to deploy for",
+                        "type": "string",
+                    },
+                },
+                "executor": {
+                    "name": "deploy",
+                    "dist": "<< parameters.dist >>",
+                    "arch": "<< parameters.arch >>",
+                },
+                "steps": [
+                    {"attach_workspace": {"at": "/output"}},
+                    {
+                        "add_ssh_keys": {
+                            "fingerprints": [
+                                "8c:a4:dd:2c:47:4c:63:aa:90:0b:e0:d6:15:be:87:82"
+                            ]
+                        }
+                    },
+                    {
+                        "run": {
+                            "name": "Ensure project specific upload directory to avoid deploy collisions",
+                            "command": command_incoming_mkdir,
+                        }
+                    },
+                    {
+                        "run": {
+                            "name": "Deploy all RPMs to GetPageSpeed repo.",
+                            "command": command_deploy_all_rpms,
+                        }
+                    },
+                    {
+                        "run": {
+                            "name": "Trigger Deploy Hook.",
+                            "command": command_trigger_incoming_hook,
+                        }
+                    },
+                ],
+            },
+        },
+        "workflows": {},
     }
-    build_job_executor_parameters["plesk"] = "<< parameters.plesk >>"
-    build_job_executor_parameters["mod"] = "<< parameters.mod >>"
-    build_job_executor_parameters["failure_tolerance"] = "<< parameters.failure_tolerance >>"
-    rpmbuilder_executor_parameters["plesk"] = {"type": "integer", "default": 0}
-    rpmbuilder_executor_parameters["mod"] = {"type": "integer", "default": 0}
-    rpmbuilder_executor_parameters["failure_tolerance"] = {"type": "string", "default": "0.1"}
-    rpmbuilder_executor_environment["PLESK"] = "<< parameters.plesk >>"
-    rpmbuilder_executor_environment["MOD"] = "<< parameters.mod >>"
-    rpmbuilder_executor_environment["FAILURE_TOLERANCE"] = "<< parameters.failure_tolerance >>"
-
-
-circleci_config = {
-    "version": 2.1,
-    "executors": {
-        "deploy": {
-            "parameters": {"dist": {"type": "string"}, "arch": {"type": "string"}},
-            "docker": [{"image": "kroniak/ssh-client"}],
-            "working_directory": "/output",
-            "environment": {
-                "DISTRO": "<< parameters.dist >>",
-                "ARCH": "<< parameters.arch >>",
+
+    # A halted (empty) build no longer cancels its workflow in the per-branch
+    # layouts (nor does a node of a sharded build), so its deploy must notice
+    # the empty workspace by itself.
+    if per_branch or sharded:
+        circleci_config["jobs"]["deploy"]["steps"].insert(
+            1,
+            {
+                "run": {
+                    "name": "Halt if there are no RPMs to deploy",
+                    "command": command_deploy_halt_without_rpms,
+                }
+            },
+        )
+
+    if dedupe:
+        deploy_steps = circleci_config["jobs"]["deploy"]["steps"]
+        deploy_steps[-3:] = [
+            {
+                "run": {
+                    "name": "Send RPM manifest and link RPMs the build server already has",
+                    "command": command_dedupe_check(
+                        "~/incoming/${CIRCLE_PROJECT_REPONAME}/${DISTRO}/${ARCH}/${CIRCLE_BRANCH}",
+                        "sha256sum *.rpm",
+                    ),
+                }
+            },
+            {
+                "run": {
+                    "name": "Deploy missing RPMs to GetPageSpeed repo.",
+                    "command": command_upload_missing_rpms,
+                }
             },
-        },
-        "rpmbuilder": {
-            "parameters": rpmbuilder_executor_parameters,
-            "docker": [{"image": "getpagespeed/rpmbuilder:<< parameters.dist >>"}],
-            "working_directory": "/sources",
-            "environment": rpmbuilder_executor_environment,
-        },
-    },
-    "jobs": {
-        "build": {
-            "parameters": build_job_parameters,
-            "resource_class": "<< parameters.resource_class >>",
-            "executor": build_job_executor_parameters,
-            "steps": build_steps,
-        },
-        "deploy": {
+            {
+                "run": {
+                    "name": "Record uploaded RPMs and trigger Deploy Hook.",
+                    "command": command_store_and_trigger_incoming_hook,
+                }
+            },
+        ]
+
+    if split_debug:
+        circleci_config["jobs"]["deploy_debug"] = {
             "parallelism": 1,
             "parameters": {
                 "dist": {
@@ -361,6 +1577,10 @@ circleci_config = {
                     "description": "The architecture to deploy for",
                     "type": "string",
                 },
+                "build_job": {
+                    "description": "The build job whose debug RPMs to deploy",
+                    "type": "string",
+                },
             },
             "executor": {
                 "name": "deploy",
@@ -368,7 +1588,21 @@ circleci_config = {
                 "arch": "<< parameters.arch >>",
             },
             "steps": [
-                {"attach_workspace": {"at": "/output"}},
+                # One cache entry per build node
+                {
+                    "restore_cache": {
+                        "keys": [debug_rpms_cache_key("<< parameters.build_job >>", node)]
+                    }
+                }
+                for node in range(shards)
+            ]
+            + [
+                {
+                    "run": {
+                        "name": "Halt if there are no debug RPMs to deploy",
+                        "command": command_deploy_halt_without_debug_rpms,
+                    }
+                },
                 {
                     "add_ssh_keys": {
                         "fingerprints": [
@@ -384,8 +1618,8 @@ circleci_config = {
                 },
                 {
                     "run": {
-                        "name": "Deploy all RPMs to GetPageSpeed repo.",
-                        "command": command_deploy_all_rpms,
+                        "name": "Deploy debug RPMs to GetPageSpeed repo.",
+                        "command": command_deploy_debug_rpms,
                     }
                 },
                 {
@@ -395,282 +1629,880 @@ circleci_config = {
                     }
                 },
             ],
-        },
-    },
-    "workflows": {},
-}
+        }
+
+    if fan_in:
+        # deploy_debug still runs per cell on the deploy executor
+        if not split_debug:
+            del circleci_config["executors"]["deploy"]
+        del circleci_config["jobs"]["deploy"]
+        circleci_config["jobs"]["deploy_branch"] = {
+            "parallelism": 1,
+            "docker": [{"image": "kroniak/ssh-client"}],
+            "working_directory": "/output",
+            "steps": [
+                {"attach_workspace": {"at": "/output"}},
+                {
+                    "add_ssh_keys": {
+                        "fingerprints": [
+                            "8c:a4:dd:2c:47:4c:63:aa:90:0b:e0:d6:15:be:87:82"
+                        ]
+                    }
+                },
+                {
+                    "run": {
+                        "name": "Stage RPMs of the branch by dist/arch/branch",
+                        "command": command_stage_branch_rpms,
+                    }
+                },
+                {
+                    "run": {
+                        "name": "Deploy all RPMs of the branch and trigger Deploy Hooks over a single SSH session.",
+                        "command": command_deploy_branch_rpms,
+                    }
+                },
+            ],
+        }
+        if dedupe:
+            circleci_config["jobs"]["deploy_branch"]["steps"].insert(
+                -1,
+                {
+                    "run": {
+                        "name": "Send RPM manifest and link RPMs the build server already has",
+                        "command": command_dedupe_check(
+                            "~/incoming/${CIRCLE_PROJECT_REPONAME}",
+                            "(cd /tmp/deploy && xargs sha256sum < /tmp/rpm-upload)",
+                        ),
+                    }
+                },
+            )
+
+    if sharded:
+        circleci_config["jobs"]["build"] = {
+            "parallelism": shards,
+            **circleci_config["jobs"]["build"],
+        }
+        circleci_config["jobs"]["deploy_branch" if fan_in else "deploy"]["steps"].insert(
+            1,
+            {
+                "run": {
+                    "name": "Collect the RPMs of all build nodes",
+                    "command": command_collect_shard_rpms,
+                }
+            },
+        )
+
+    if prefetch:
+        circleci_config["jobs"]["prefetch"] = {
+            "parameters": {
+                "dist": {
+                    "description": "The dist tag of OS whose tools download the sources",
+                    "type": "string",
+                },
+            },
+            "resource_class": "small",
+            "executor": {
+                "name": "rpmbuilder",
+                "dist": "<< parameters.dist >>",
+            },
+            "steps": [
+                "checkout",
+                {
+                    "run": {
+                        "name": "Download and verify sources",
+                        "command": command_prefetch_sources,
+                    }
+                },
+                {"persist_to_workspace": {"root": "/tmp/workspace", "paths": ["prefetch"]}},
+            ],
+        }
+
+    # Opt-in smoke job template. Only emitted into `jobs:` when the project's
+    # settings.yml carries a non-empty `post_deploy_smoke:` block. Keeps
+    # non-opting consumers' generated config byte-identical.
+    if post_deploy_smoke:
+        circleci_config["jobs"]["smoke"] = {
+            "parameters": {
+                "dist": {
+                    "description": "The dist tag of OS to smoke-install on",
+                    "type": "string",
+                },
+                "arch": {
+                    "description": "Architecture (informational; surfaces in job name)",
+                    "type": "string",
+                },
+                "resource_class": {
+                    "description": "Resource class for the smoke runner",
+                    "type": "string",
+                    "default": "medium",
+                },
+            },
+            "resource_class": "<< parameters.resource_class >>",
+            "executor": {
+                "name": "rpmbuilder",
+                "dist": "<< parameters.dist >>",
+            },
+            "environment": {
+                "DISTRO": "<< parameters.dist >>",
+                "ARCH": "<< parameters.arch >>",
+            },
+            "steps": [
+                "checkout",
+                {
+                    "run": {
+                        "name": "Post-deploy install smoke + crash probe",
+                        "command": "bash scripts/smoke.sh",
+                    }
+                },
+            ],
+        }
+
+    # Prepare workflows: (cell, workflow name, jobs) per cell, laid out below
+    cell_workflows = []
+    # Pre-flight plan: {dist: [plan-cells.sh cell spec, ...]}
+    plan_cells = {}
+    # Change-aware builds: (workflow name, names the cell answers to) per cell
+    change_cells = []
+    # Cell-scoped parameters: {workflow name: (dist version, arch, branch)},
+    # dist version and arch None for the per-branch layouts' workflows
+    workflow_cells = {}
+
+    # Generate workflows
+    distros = matrix_config.get("distros", {})
+
+    for cell in buildmatrix.expand_cells(
+        distros, branches, archs, exclude_patterns, dists_allowlist, axes, restrict
+    ):
+        dist, version, branch, arch = cell.dist, cell.version, cell.branch, cell.arch
+        branch_config = branches[branch]
+        # Per-branch resource_class overrides (opt-in, default-off).
+        # Apply to the BUILD job only — smoke keeps its current hard-coded
+        # medium/arm.medium so this contributes zero diff to consumers that
+        # do not set these keys. When unset, branch_config.get returns
+        # None and the existing emit path is preserved exactly.
+        branch_rc = branch_config.get("resource_class")           # x86_64 build override
+        branch_arm_rc = branch_config.get("arm_resource_class")   # aarch64 build override
+        # Telemetry sizing (--history) replaces the default class for cells
+        # with history, from its peak memory and build durations; an explicit
+        # settings.yml `resource_class` wins over it, as do the per-branch
+        # overrides.
+        sized_rc = None
+        if "resource_class" not in project_settings:
+            sized_rc = sizing.pick_resource_class(
+                (history or {}).get((project_name, f"{dist}{version}", arch, branch), []), arch
+            )
+
+        workflow_name = get_workflow_name(dist, version, branch, arch, branches) + cell.suffix
+        build_job_name = get_build_job_name(dist, version, branch, arch, branches) + cell.suffix
+        deploy_job_name = get_deploy_job_name(dist, version, branch, arch, branches) + cell.suffix
+
+        # The branch filter and `git_branch` mapping in matrix.json are
+        # not always the same (e.g. nginx "stable" → master, varnish
+        # "varnish60" → master). Filter on the actual git branch name.
+        git_branch = branch_config.get("git_branch", branch)
+        only_branches = [git_branch]
+        # if git branch is "master", "main", or "stable", treat them
+        # as interchangeable so the workflow fires from any of them.
+        main_branches = ["main", "master", "stable"]
+        if git_branch in main_branches:
+            only_branches = main_branches
+
+        # Build job parameters
+        build_job = {
+            "build": {
+                "name": build_job_name,
+                "context": "org-global",
+                "dist": f"{dist}{version}",
+                "filters": {"branches": {"only": only_branches}},
+            }
+        }
+        # Set enable_repos so check_packages_in_repo (in rpmbuilder image)
+        # can see prior builds in the channel where the artifact lives,
+        # and short-circuit re-builds of an already-published NVR.
+        # Convention: matrix.yml `collections.<X>.branches.<Y>` key is
+        # both the sub-channel suffix and (unless `git_branch:` overrides)
+        # the git branch name. "stable" is the canonical no-sub-channel case.
+        # A branch may carry `enable_repos:` to override the conventional
+        # repo id (e.g. freenginx-mainline ships as
+        # [getpagespeed-freenginx-mainline]); null suppresses emission.
+        if collection_name and branch != "stable":
+            enable_repos = branch_config.get(
+                "enable_repos", f"getpagespeed-extras-{branch}"
+            )
+            if enable_repos:
+                build_job["build"]["enable_repos"] = enable_repos
+
+        # nginx collection: per-branch job-param overrides from matrix.json.
+        # plesk_version → `plesk: <ver>` (verbatim parity for the plesk branch).
+        # failure_tolerance → `failure_tolerance: '<frac>'` (e.g. ea4 = '1.0').
+        # `mod` intentionally not surfaced per-job: nginx-mod cohort retired
+        # (ABI-compatible with stable); standalone variant repos inherit
+        # the executor default 0 via param wiring above.
+        if collection_name == "nginx":
+            if "plesk_version" in branch_config:
+                build_job["build"]["plesk"] = branch_config["plesk_version"]
+            if "failure_tolerance" in branch_config:
+                build_job["build"]["failure_tolerance"] = branch_config["failure_tolerance"]
+
+        # Fan-in builds stage their RPMs under <dist>/<arch>/ in the workspace
+        if fan_in or instrument:
+            build_job["build"]["arch"] = arch
+        if instrument or cache_settings.get("ccache"):
+            build_job["build"]["branch"] = branch
+
+        # Builds wait for their branch's source prefetch
+        if prefetch:
+            build_job["build"]["requires"] = [get_prefetch_job_name(branch, branches)]
+
+        # Extra matrix axes: pass this cell's value of each axis to the build
+        for axis_name, axis_value in cell.axes:
+            build_job["build"][axis_name] = axis_value
+
+        if cache_settings.get("packages"):
+            packager = buildmatrix.distro_setting(
+                distros[cell.distro], version, "packager", matrix_config.get("distro_defaults")
+            )
+            package_cache = package_cache_dirs.get(packager, default_package_cache)
+            if package_cache != default_package_cache:
+                build_job["build"]["package_cache"] = package_cache
+
+        # Pinned image (compact layouts then group the dists separately)
+        if f"{dist}{version}" in image_lock:
+            build_job["build"]["image_digest"] = "@" + image_lock[f"{dist}{version}"]
+
+        # Add extra parameters for 'aarch64'
+        if arch == "aarch64":
+            build_job["build"]["resource_class"] = branch_arm_rc or sized_rc or arm_resource_class
+        elif (branch_rc or sized_rc) and (branch_rc or sized_rc) != resource_class:
+            # x86_64 normally inherits via the job parameter default;
+            # only emit an inline override when the branch differs
+            # from project-wide. Keeps non-opting branches byte-identical.
+            build_job["build"]["resource_class"] = branch_rc or sized_rc
+
+        deploy_job = {
+            "deploy": {
+                "name": deploy_job_name,
+                "context": "org-global",
+                "dist": f"{dist}{version}",
+                "arch": arch,
+                "filters": {"branches": {"only": only_branches}},
+                "requires": [build_job_name],
+            }
+        }
+
+        # if branch is "master", add "main" as well
+        if branch == "master":
+            deploy_job["deploy"]["filters"]["branches"]["only"].append("main")
+
+        # Self mode replaces branch-based filters with tag-based ones:
+        # build fires for any tag, deploy only for /^v.*/ tags and never
+        # for plain branch pushes. Verbatim parity with the retired
+        # generated_config_self.yml template.
+        if self_mode:
+            build_job["build"]["filters"] = {"tags": {"only": "/.*/"}}
+            deploy_job["deploy"]["filters"] = {
+                "branches": {"ignore": "/.*/"},
+                "tags": {"only": "/^v.*/"},
+            }
+
+        # Construct the workflow
+        workflow_jobs = [build_job, deploy_job]
+
+        # Debug RPMs follow the runtime deploy in a job nothing waits for
+        if split_debug:
+            workflow_jobs.append(
+                {
+                    "deploy_debug": {
+                        "name": get_debug_deploy_job_name(dist, version, branch, arch, branches)
+                        + cell.suffix,
+                        "context": "org-global",
+                        "dist": f"{dist}{version}",
+                        "arch": arch,
+                        "build_job": build_job_name,
+                        "filters": deploy_job["deploy"]["filters"],
+                        "requires": [deploy_job_name],
+                    }
+                }
+            )
+        cell_workflows.append((cell, workflow_name, workflow_jobs))
+
+        layout_workflow_name = (
+            get_branch_workflow_name(branch, branches) if per_branch else workflow_name
+        )
+        if cell_parameters:
+            workflow_cells[workflow_name] = (f"{dist}{version}", arch, branch)
+        if changes:
+            change_cells.append(
+                (
+                    layout_workflow_name,
+                    {
+                        branch,
+                        git_branch,
+                        dist,
+                        f"{dist}{version}",
+                        f"{dist}{version}-{arch}",
+                        workflow_name,
+                    },
+                )
+            )
+
+        # Pre-flight plan cell: <workflow>:<arch>:<repo>:<git branches>[:<macros>]
+        # (see plan-cells.sh), checked against the channel the build's own
+        # check_packages_in_repo would look at.
+        if plan:
+            plan_spec = ":".join(
+                [
+                    layout_workflow_name,
+                    arch,
+                    build_job["build"].get("enable_repos") or "getpagespeed-extras",
+                    "+".join(only_branches),
+                ]
+            )
+            if "plesk" in build_job["build"]:
+                plan_spec += f":plesk={build_job['build']['plesk']}"
+            plan_cells.setdefault(f"{dist}{version}", []).append(plan_spec)
+
+        # Opt-in post-deploy smoke job. Default-off: if the project's
+        # settings.yml has no post_deploy_smoke block, nothing is
+        # appended and the workflow stays byte-identical for that
+        # consumer. When opted in for this (branch, dist, arch), chain
+        # a smoke job after deploy so it pulls the just-published RPM
+        # from the channel and exercises a real install + crash probe
+        # (see consumer-repo scripts/smoke.sh for the body).
+        smoke_for_branch = post_deploy_smoke.get(branch)
+        if smoke_for_branch:
+            smoke_dists = smoke_for_branch.get("dists", [])
+            smoke_archs = smoke_for_branch.get("archs", [])
+            if f"{dist}{version}" in smoke_dists and arch in smoke_archs:
+                if len(branches) == 1:
+                    smoke_job_name = f"smoke-{dist}{version}-{arch}"
+                else:
+                    smoke_job_name = (
+                        f"smoke-{dist}{version}-{branch}-{arch}"
+                    )
+                smoke_job_name += cell.suffix
+                smoke_rc = (
+                    arm_resource_class if arch == "aarch64" else "medium"
+                )
+                smoke_job = {
+                    "smoke": {
+                        "name": smoke_job_name,
+                        "context": "org-global",
+                        "dist": f"{dist}{version}",
+                        "arch": arch,
+                        "resource_class": smoke_rc,
+                        "filters": {"branches": {"only": only_branches}},
+                        "requires": [deploy_job_name],
+                    }
+                }
+                workflow_jobs.append(smoke_job)
+
+    if per_branch:
+        workflows = branch_workflows(
+            cell_workflows, branches, use_matrix=compact, fan_in=fan_in, prefetch=prefetch
+        )
+    else:
+        workflows = {name: {"jobs": jobs} for _, name, jobs in cell_workflows}
+
+    # Declared by the setup config too when there is one: CircleCI passes the
+    # pipeline parameters on to the continuation, which has to take them
+    if cell_parameters:
+        circleci_config = {
+            "version": circleci_config.pop("version"),
+            "parameters": cell_pipeline_parameters,
+            **circleci_config,
+        }
+    # Without a setup stage, the workflows check them themselves
+    if cell_parameters and not (plan or changes):
+        workflows = {
+            name: {"when": cell_condition(*workflow_cells[name]), **workflow}
+            for name, workflow in workflows.items()
+        }
+
+    # Add the generated workflows to the CircleCI config
+    circleci_config["workflows"].update(workflows)
+
+    # Inputs of the setup stage (see setup_config()), empty without one
+    setup = {}
+    if plan:
+        setup["plan_cells"] = plan_cells
+    if changes:
+        setup["change_rules"] = change_rules(
+            {} if changes_settings is True else changes_settings, change_cells, branches
+        )
+    if setup and cell_parameters:
+        setup["workflow_cells"] = workflow_cells
+    return circleci_config, setup
+
+
+def change_rules(changes_settings, change_cells, branches):
+    """Map changed-path globs (as case_pattern()s) to the workflows they affect.
+
+    settings.yml `changes: {paths: {<glob>: [<cell pattern>, ...]}}` rules
+    come first, in order; a cell pattern is an fnmatch pattern over the
+    cell's branch, git branch, dist, dist-version, dist-version-arch or
+    workflow name, and an empty list means "affects nothing" (docs, CI
+    helpers). Multi-branch projects also get one rule per branch for
+    `<branch>/*` paths (e.g. per-branch patch directories).
+    """
+    rules = []
+    for pattern, cell_patterns in (changes_settings.get("paths") or {}).items():
+        cell_re = buildmatrix.compile_patterns([str(p) for p in cell_patterns])
+        workflows = [
+            name
+            for name, cell_names in change_cells
+            if cell_re and buildmatrix.matches_any(cell_re, cell_names)
+        ]
+        rules.append((case_pattern(str(pattern)), list(dict.fromkeys(workflows))))
+    if len(branches) > 1:
+        for branch in branches:
+            workflows = [name for name, cell_names in change_cells if branch in cell_names]
+            rules.append((case_pattern(f"{branch}/*"), list(dict.fromkeys(workflows))))
+    return rules
+
 
-# Opt-in smoke job template. Only emitted into `jobs:` when the project's
-# settings.yml carries a non-empty `post_deploy_smoke:` block. Keeps
-# non-opting consumers' generated config byte-identical.
-if post_deploy_smoke:
-    circleci_config["jobs"]["smoke"] = {
+def setup_config(plan_cells=None, change_rules=None, workflow_cells=None):
+    """Setup config narrowing down the workflows before continuing.
+
+    With `plan_cells`, one small `plan` job per dist checks its cells with
+    plan-cells.sh and the workflows whose cells are all published are
+    dropped. With `change_rules`, the workflows no changed path affects are
+    dropped. With `workflow_cells`, the config takes the cell-scoped
+    pipeline parameters and drops the workflows outside them. The `continue`
+    job then continues with what is left of .circleci/continue_config.json.
+    """
+    continue_steps = ["checkout"]
+    if workflow_cells is not None:
+        continue_steps.append(
+            {
+                "run": {
+                    "name": "Find workflows the pipeline parameters leave out",
+                    "command": command_filter_unrequested_workflows(workflow_cells),
+                }
+            }
+        )
+    if change_rules is not None:
+        continue_steps.append(
+            {
+                "run": {
+                    "name": "Find workflows affected by the pushed changes",
+                    "command": command_filter_unchanged_workflows(change_rules),
+                }
+            }
+        )
+    if plan_cells is not None:
+        continue_steps += [
+            {"attach_workspace": {"at": "/tmp/plan"}},
+            {
+                "run": {
+                    "name": "Find workflows whose cells are all published",
+                    "command": command_filter_planned_workflows,
+                }
+            },
+        ]
+    continue_steps += [
+        {
+            "run": {
+                "name": "Drop workflows with nothing to build",
+                "command": command_drop_skipped_workflows,
+            }
+        },
+        {
+            "continuation/continue": {
+                "configuration_path": "/tmp/continue_config.json",
+            }
+        },
+    ]
+    config = {
+        "version": 2.1,
+        "setup": True,
+        "orbs": {"continuation": "circleci/continuation@0.1.2"},
+        "jobs": {
+            "continue": {
+                "executor": "continuation/default",
+                "steps": continue_steps,
+            },
+        },
+        "workflows": {"setup": {"jobs": ["continue"]}},
+    }
+    if workflow_cells is not None:
+        config = {"version": 2.1, "parameters": cell_pipeline_parameters, **config}
+    if plan_cells is None:
+        return config
+    plan_job_names = [f"plan-{dist}" for dist in plan_cells]
+    config["jobs"]["plan"] = {
         "parameters": {
             "dist": {
-                "description": "The dist tag of OS to smoke-install on",
+                "description": "The dist tag of OS to plan for",
                 "type": "string",
             },
-            "arch": {
-                "description": "Architecture (informational; surfaces in job name)",
+            "cells": {
+                "description": "Space-separated plan-cells.sh cell specs",
                 "type": "string",
             },
-            "resource_class": {
-                "description": "Resource class for the smoke runner",
-                "type": "string",
-                "default": "medium",
-            },
-        },
-        "resource_class": "<< parameters.resource_class >>",
-        "executor": {
-            "name": "rpmbuilder",
-            "dist": "<< parameters.dist >>",
-        },
-        "environment": {
-            "DISTRO": "<< parameters.dist >>",
-            "ARCH": "<< parameters.arch >>",
         },
+        "docker": [{"image": "getpagespeed/rpmbuilder:<< parameters.dist >>"}],
+        "resource_class": "small",
+        "working_directory": "/sources",
         "steps": [
             "checkout",
             {
                 "run": {
-                    "name": "Post-deploy install smoke + crash probe",
-                    "command": "bash scripts/smoke.sh",
+                    "name": "Check which cells are already published",
+                    "command": command_plan_cells(),
                 }
             },
+            {"persist_to_workspace": {"root": "/tmp/plan", "paths": ["*.plan"]}},
         ],
     }
+    config["workflows"]["setup"]["jobs"] = [
+        {"plan": {"name": name, "dist": dist, "cells": " ".join(cells)}}
+        for name, (dist, cells) in zip(plan_job_names, plan_cells.items())
+    ] + [{"continue": {"requires": plan_job_names}}]
+    return config
 
-# Prepare workflows
-workflows = {}
 
+def render_config(circleci_config):
+    """Serialize the config exactly as it is written to config.yml.
 
-# Function to generate workflow names
-def get_workflow_name(dist, version, branch, arch):
-    # if this is the only branch, don't include it in the workflow name
-    # note that brandh is a dictionary, so we need to get the key count
-    if len(branches) == 1:
-        return f"build-deploy-{dist}{version}-{arch}"
-    return f"build-deploy-{dist}{version}-{branch}-{arch}"
+    fastyaml writes the generator's plain dict/list/str output directly, byte
+    for byte what ruamel would; ruamel only handles what fastyaml refuses
+    (e.g. commented nodes carried over from settings.yml).
+    """
+    try:
+        return fastyaml.dump(circleci_config).encode("utf-8")
+    except fastyaml.UnsupportedValue:
+        return render_config_ruamel(circleci_config)
 
 
-# Generate workflows
-distros = matrix_config.get("distros", {})
+def render_config_ruamel(circleci_config):
+    """render_config() through ruamel's emitter (the reference output)."""
+    stream = io.StringIO()
+    ruamel_yaml().dump(circleci_config, stream)
+    return stream.getvalue().encode("utf-8")
 
 
-def get_build_job_name(dist, version, branch, arch):
-    # if this is the only branch, don't include it in the job name
-    if len(branches) == 1:
-        return f"build-{dist}{version}-{arch}"
-    return f"build-{dist}{version}-{branch}-{arch}"
+def generate_files(project_dir, matrix_config, history=None, image_lock=None):
+    """Render every generated file of a project: {relative path: bytes}."""
+    circleci_config, setup = _generate(
+        project_dir, matrix_config, history, image_lock=image_lock
+    )
+    if not setup:
+        return {".circleci/config.yml": render_config(circleci_config)}
+    return {
+        ".circleci/config.yml": render_config(setup_config(**setup)),
+        # JSON is valid YAML; jq edits it in the setup stage's continue job
+        ".circleci/continue_config.json": (
+            json.dumps(circleci_config, indent=2) + "\n"
+        ).encode("utf-8"),
+    }
 
 
-def get_deploy_job_name(dist, version, branch, arch):
-    # if this is the only branch, don't include it in the job name
-    if len(branches) == 1:
-        return f"deploy-{dist}{version}-{arch}"
-    return f"deploy-{dist}{version}-{branch}-{arch}"
+def files_digest(files):
+    """Digest of a project's generated files ({relative path: bytes})."""
+    digest = hashlib.sha256()
+    for name in sorted(files):
+        digest.update(name.encode("utf-8") + b"\0" + files[name] + b"\0")
+    return digest.hexdigest()
+
+
+def write_files(project_dir, files):
+    """Write generate_files() output under project_dir, drop stale generated files.
+
+    Returns (config_file, output_digest, changed).
+    """
+    project_dir = os.path.abspath(project_dir)
+    os.makedirs(os.path.join(project_dir, ".circleci"), exist_ok=True)
+    changed = False
+    for name in generated_files:
+        path = os.path.join(project_dir, name)
+        if name in files:
+            changed = write_if_changed(path, files[name]) or changed
+        elif os.path.exists(path):
+            os.unlink(path)
+            changed = True
+    config_file = os.path.join(project_dir, ".circleci", "config.yml")
+    return config_file, files_digest(files), changed
+
+
+def read_generated_files(project_dir):
+    """The generated files currently on disk, as generate_files() returns them."""
+    files = {}
+    for name in generated_files:
+        try:
+            with open(os.path.join(project_dir, name), "rb") as f:
+                files[name] = f.read()
+        except FileNotFoundError:
+            pass
+    return files
+
+
+@lru_cache(maxsize=None)
+def generator_version():
+    """Hash of the generator's own source; part of every fingerprint."""
+    digest = hashlib.sha256()
+    for source in generator_sources:
+        with open(source, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def matrix_digest(matrix_config):
+    return hashlib.sha256(
+        json.dumps(matrix_config, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def project_fingerprint(project_dir, matrix_hash, history=None, image_lock=None):
+    """Hash every input of generate() for this project.
+
+    Covers the generator version, matrix.json, the directory name (nginx-*
+    collection detection), settings.yml, the specs' scanned archs,
+    the project's part of the sizing history and the image lock.
+    """
+    project_dir = os.path.abspath(project_dir)
+    digest = hashlib.sha256()
+    for part in (generator_version(), matrix_hash, os.path.basename(project_dir)):
+        digest.update(part.encode("utf-8") + b"\0")
+    if history:
+        records = sizing.project_history(history, os.path.basename(project_dir))
+        digest.update(json.dumps(sorted(records.items()), sort_keys=True).encode("utf-8") + b"\0")
+    if image_lock:
+        digest.update(json.dumps(image_lock, sort_keys=True).encode("utf-8") + b"\0")
+    settings_file = os.path.join(project_dir, "settings.yml")
+    if os.path.exists(settings_file):
+        with open(settings_file, "rb") as f:
+            digest.update(b"settings.yml\0" + f.read() + b"\0")
+    # The specs only matter through their scanned archs (cached by mtime and
+    # size, so detect_archs() doesn't read them again)
+    for spec_file in spec_paths(project_dir):
+        spec = specscan.scan_spec(spec_file, default_archs)
+        digest.update(
+            f"{os.path.basename(spec_file)}\0{spec.archs}\0{spec.noarch}\0".encode("utf-8")
+        )
+    return digest.hexdigest()
+
+
+def load_cache(cache_file):
+    try:
+        with open(cache_file, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_cache(cache_file, cache):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    write_if_changed(
+        cache_file, json.dumps(cache, indent=2, sort_keys=True).encode("utf-8")
+    )
+
+
+def regenerate(
+    project_dir, matrix_config, cache=None, matrix_hash=None, history=None, image_lock=None
+):
+    """Regenerate one project's generated files, skipping it if nothing changed.
+
+    `cache` maps absolute project dirs to {"fingerprint", "output"} entries
+    (as stored by save_cache()); pass None to always regenerate. Returns
+    (config_file, status, cache_entry) where status is "skipped" (inputs
+    unchanged, no YAML emitted), "unchanged" (emitted, same bytes) or
+    "generated" (file written).
+    """
+    project_dir = os.path.abspath(project_dir)
+    if matrix_hash is None:
+        matrix_hash = matrix_digest(matrix_config)
+    fingerprint = project_fingerprint(project_dir, matrix_hash, history, image_lock)
+    config_file = os.path.join(project_dir, ".circleci", "config.yml")
+    cached = (cache or {}).get(project_dir)
+    if (
+        cached
+        and cached.get("fingerprint") == fingerprint
+        and cached.get("output") == files_digest(read_generated_files(project_dir))
+    ):
+        return config_file, "skipped", cached
+    config_file, output_digest, changed = write_files(
+        project_dir, generate_files(project_dir, matrix_config, history, image_lock)
+    )
+    entry = {"fingerprint": fingerprint, "output": output_digest}
+    return config_file, "generated" if changed else "unchanged", entry
+
+
+def regenerate_or_fail(project_dir, **kwargs):
+    """regenerate() for batch runs: a project that can't be generated (bad
+    settings.yml, unknown collection, ...) yields (project_dir, "failed",
+    error message) instead of aborting every project after it.
+    """
+    try:
+        return regenerate(project_dir, **kwargs)
+    except Exception as exc:
+        return os.path.abspath(project_dir), "failed", f"{type(exc).__name__}: {exc}"
 
 
-for distro_name, distro_info in distros.items():
-    dist = distro_info.get("dist", distro_name)
-    versions = distro_info.get("versions", [])
-    for version in versions:
-        # Per-version distro overrides — primarily the plesk branch axis:
-        # matrix.yml's rhel.version_overrides.10.has_plesk=False excludes
-        # el10-plesk workflows even though el10 ∈ only_dists: ["el*"].
-        # matrix.json stores version_overrides keys as strings (e.g. "10")
-        # since JSON has no integer keys; matrix.yml versions arrive as ints.
-        # Look up by both for safety.
-        version_overrides_all = distro_info.get("version_overrides", {})
-        version_overrides = (
-            version_overrides_all.get(version)
-            or version_overrides_all.get(str(version))
-            or {}
+def expand_project_dirs(patterns):
+    """Expand --project-dirs arguments (plain paths or globs) to directories."""
+    project_dirs = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            if os.path.isdir(match) and match not in project_dirs:
+                project_dirs.append(match)
+    return project_dirs
+
+
+def main(argv=None):
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Generate CircleCI configuration.")
+    parser.add_argument("--project-dir", default=".", help="Root directory of the project.")
+    parser.add_argument(
+        "--project-dirs",
+        nargs="+",
+        metavar="DIR_OR_GLOB",
+        help="Batch mode: regenerate every matching project directory in one run "
+        "(e.g. '/rpm/*-rpm'). Overrides --project-dir.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Batch mode: number of worker processes (default: 1, no pool).",
+    )
+    parser.add_argument(
+        "--matrix",
+        default=default_matrix_file,
+        help="Path to matrix.json (default: the one shipped next to this script).",
+    )
+    parser.add_argument(
+        "--image-lock",
+        default=default_image_lock_file,
+        help="rpmbuilder image lock (see pull_images.py) pinning the build image of "
+        "settings.yml `pin_images: true` projects (default: the one next to this script).",
+    )
+    parser.add_argument(
+        "--cache-file",
+        default=default_cache_file,
+        help=f"Fingerprint cache location (default: {default_cache_file}).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Ignore the fingerprint cache and re-emit every config.",
+    )
+    parser.add_argument(
+        "--history",
+        help="Job history (JSON lines, see sizing.py) to size each cell's "
+        "resource_class from past peak RSS and OOMs.",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        help="Write the project's build config to FILE ('-' for stdout) instead of "
+        "regenerating .circleci/; no fingerprint cache. Used by the setup job of "
+        "config.yml / config_nginx.yml to continue with a config generated in CI. "
+        f"Exits {no_cells_status} (removing FILE) when no cell matches --build-*.",
+    )
+    parser.add_argument(
+        "--project-name",
+        help="With --output: the repository name, when it's not the project "
+        "directory's name (e.g. $CIRCLE_PROJECT_REPONAME for a CI checkout).",
+    )
+    for option, what in (
+        ("--build-dists", "dist versions (e.g. fc44)"),
+        ("--build-archs", "architectures"),
+        ("--build-branches", "matrix branches"),
+    ):
+        parser.add_argument(
+            option,
+            metavar="REGEX",
+            help=f"With --output: only the cells whose {what} match REGEX in full "
+            "(the setup job passes the build_* pipeline parameters).",
         )
-        has_plesk = version_overrides.get(
-            "has_plesk", distro_info.get("has_plesk", False)
+    args = parser.parse_args(argv)
+    if args.output and args.project_dirs:
+        parser.error("--output takes a single --project-dir")
+    restrict = {
+        "dist": args.build_dists,
+        "arch": args.build_archs,
+        "branch": args.build_branches,
+    }
+    if any(restrict.values()) and not args.output:
+        parser.error("--build-dists/--build-archs/--build-branches require --output")
+
+    if args.output:
+        # The whole build config: with settings.yml `plan:` / `changes:` this
+        # is the continuation config, every (requested) cell included
+        circleci_config = generate(
+            args.project_dir,
+            load_matrix(args.matrix),
+            sizing.load_history(args.history) if args.history else None,
+            args.project_name,
+            restrict,
+            load_image_lock(args.image_lock),
         )
-        for branch in branches:
-            branch_config = branches[branch]
-            # Skip plesk branch on distro versions that don't support Plesk
-            # (e.g. el10). Mirrors generate_config.py:175 logic.
-            if branch_config.get("git_branch", branch) == "plesk" and not has_plesk:
-                continue
-            # if only_dists list is present in branch_config, compare each element as wildcard "*" against current dist
-            # and if matches, skip this distro
-
-            if "only_dists" in branch_config:
-                if not any(
-                    fnmatch.fnmatch(f"{dist}{version}", pattern)
-                    for pattern in branch_config["only_dists"]
-                ):
-                    continue
-            # Per-branch resource_class overrides (opt-in, default-off).
-            # Apply to the BUILD job only — smoke keeps its current hard-coded
-            # medium/arm.medium so this contributes zero diff to consumers that
-            # do not set these keys. When unset, branch_config.get returns
-            # None and the existing emit path is preserved exactly.
-            branch_rc = branch_config.get("resource_class")           # x86_64 build override
-            branch_arm_rc = branch_config.get("arm_resource_class")   # aarch64 build override
-
-            for arch in archs:
-                # Skip architectures that are not supported
-                if arch == "aarch64" and not distro_info.get("has_aarch64", True):
-                    continue
-                # branch config
-                if "only_archs" in branch_config:
-                    if not any(
-                        fnmatch.fnmatch(arch, pattern)
-                        for pattern in branch_config["only_archs"]
-                    ):
-                        continue
-                # check if this distro and arch has been excluded
-                # exclude: config can either have exclude: el or el7 or exclude: el7-x86_64 items
-                # check excludes with wildcard support (e.g., "*", "el*", "amzn*-aarch64")
-                combo_values = [dist, f"{dist}{version}", f"{dist}{version}-{arch}"]
-                if any(fnmatch.fnmatch(value, pattern) for value in combo_values for pattern in exclude_patterns):
-                    continue
-                # If a `dists:` allowlist is set, drop anything that doesn't match it.
-                if dists_allowlist and not any(
-                    fnmatch.fnmatch(value, pattern)
-                    for value in combo_values
-                    for pattern in dists_allowlist
-                ):
-                    continue
-
-                workflow_name = get_workflow_name(dist, version, branch, arch)
-                build_job_name = get_build_job_name(dist, version, branch, arch)
-                deploy_job_name = get_deploy_job_name(dist, version, branch, arch)
-
-                # The branch filter and `git_branch` mapping in matrix.json are
-                # not always the same (e.g. nginx "stable" → master, varnish
-                # "varnish60" → master). Filter on the actual git branch name.
-                git_branch = branch_config.get("git_branch", branch)
-                only_branches = [git_branch]
-                # if git branch is "master", "main", or "stable", treat them
-                # as interchangeable so the workflow fires from any of them.
-                main_branches = ["main", "master", "stable"]
-                if git_branch in main_branches:
-                    only_branches = main_branches
-
-                # Build job parameters
-                build_job = {
-                    "build": {
-                        "name": build_job_name,
-                        "context": "org-global",
-                        "dist": f"{dist}{version}",
-                        "filters": {"branches": {"only": only_branches}},
-                    }
-                }
-                # Set enable_repos so check_packages_in_repo (in rpmbuilder image)
-                # can see prior builds in the channel where the artifact lives,
-                # and short-circuit re-builds of an already-published NVR.
-                # Convention: matrix.yml `collections.<X>.branches.<Y>` key is
-                # both the sub-channel suffix and (unless `git_branch:` overrides)
-                # the git branch name. "stable" is the canonical no-sub-channel case.
-                # A branch may carry `enable_repos:` to override the conventional
-                # repo id (e.g. freenginx-mainline ships as
-                # [getpagespeed-freenginx-mainline]); null suppresses emission.
-                if collection_name and branch != "stable":
-                    enable_repos = branch_config.get(
-                        "enable_repos", f"getpagespeed-extras-{branch}"
-                    )
-                    if enable_repos:
-                        build_job["build"]["enable_repos"] = enable_repos
-
-                # nginx collection: per-branch job-param overrides from matrix.json.
-                # plesk_version → `plesk: <ver>` (verbatim parity for the plesk branch).
-                # failure_tolerance → `failure_tolerance: '<frac>'` (e.g. ea4 = '1.0').
-                # `mod` intentionally not surfaced per-job: nginx-mod cohort retired
-                # (ABI-compatible with stable); standalone variant repos inherit
-                # the executor default 0 via param wiring above.
-                if collection_name == "nginx":
-                    if "plesk_version" in branch_config:
-                        build_job["build"]["plesk"] = branch_config["plesk_version"]
-                    if "failure_tolerance" in branch_config:
-                        build_job["build"]["failure_tolerance"] = branch_config["failure_tolerance"]
-
-                # Add extra parameters for 'aarch64'
-                if arch == "aarch64":
-                    build_job["build"]["resource_class"] = branch_arm_rc or arm_resource_class
-                elif branch_rc and branch_rc != resource_class:
-                    # x86_64 normally inherits via the job parameter default;
-                    # only emit an inline override when the branch differs
-                    # from project-wide. Keeps non-opting branches byte-identical.
-                    build_job["build"]["resource_class"] = branch_rc
-
-                deploy_job = {
-                    "deploy": {
-                        "name": deploy_job_name,
-                        "context": "org-global",
-                        "dist": f"{dist}{version}",
-                        "arch": arch,
-                        "filters": {"branches": {"only": only_branches}},
-                        "requires": [build_job_name],
-                    }
-                }
+        if not circleci_config["workflows"]:
+            # Nothing to continue with: drop what an earlier run in the same
+            # workspace may have left there, the setup job halts on this status
+            if args.output != "-" and os.path.exists(args.output):
+                os.unlink(args.output)
+            print("No cell matches the requested dists/archs/branches", file=sys.stderr)
+            return no_cells_status
+        data = render_config(template_continuation(circleci_config))
+        if args.output == "-":
+            sys.stdout.buffer.write(data)
+        else:
+            write_if_changed(args.output, data)
+        return 0
 
-                # if branch is "master", add "main" as well
-                if branch == "master":
-                    deploy_job["deploy"]["filters"]["branches"]["only"].append("main")
+    # Read matrix.json once, no matter how many projects we regenerate
+    matrix_config = load_matrix(args.matrix)
+    matrix_hash = matrix_digest(matrix_config)
+    cache = load_cache(args.cache_file)
+    history = sizing.load_history(args.history) if args.history else None
+    image_lock = load_image_lock(args.image_lock)
 
-                # Self mode replaces branch-based filters with tag-based ones:
-                # build fires for any tag, deploy only for /^v.*/ tags and never
-                # for plain branch pushes. Verbatim parity with the retired
-                # generated_config_self.yml template.
-                if self_mode:
-                    build_job["build"]["filters"] = {"tags": {"only": "/.*/"}}
-                    deploy_job["deploy"]["filters"] = {
-                        "branches": {"ignore": "/.*/"},
-                        "tags": {"only": "/^v.*/"},
-                    }
+    if args.project_dirs:
+        project_dirs = expand_project_dirs(args.project_dirs)
+        if not project_dirs:
+            print("No project directories matched", file=sys.stderr)
+            return 1
+    else:
+        project_dirs = [args.project_dir]
 
-                # Construct the workflow
-                workflows[workflow_name] = {"jobs": [build_job, deploy_job]}
-
-                # Opt-in post-deploy smoke job. Default-off: if the project's
-                # settings.yml has no post_deploy_smoke block, nothing is
-                # appended and the workflow stays byte-identical for that
-                # consumer. When opted in for this (branch, dist, arch), chain
-                # a smoke job after deploy so it pulls the just-published RPM
-                # from the channel and exercises a real install + crash probe
-                # (see consumer-repo scripts/smoke.sh for the body).
-                smoke_for_branch = post_deploy_smoke.get(branch)
-                if smoke_for_branch:
-                    smoke_dists = smoke_for_branch.get("dists", [])
-                    smoke_archs = smoke_for_branch.get("archs", [])
-                    if f"{dist}{version}" in smoke_dists and arch in smoke_archs:
-                        if len(branches) == 1:
-                            smoke_job_name = f"smoke-{dist}{version}-{arch}"
-                        else:
-                            smoke_job_name = (
-                                f"smoke-{dist}{version}-{branch}-{arch}"
-                            )
-                        smoke_rc = (
-                            arm_resource_class if arch == "aarch64" else "medium"
-                        )
-                        smoke_job = {
-                            "smoke": {
-                                "name": smoke_job_name,
-                                "context": "org-global",
-                                "dist": f"{dist}{version}",
-                                "arch": arch,
-                                "resource_class": smoke_rc,
-                                "filters": {"branches": {"only": only_branches}},
-                                "requires": [deploy_job_name],
-                            }
-                        }
-                        workflows[workflow_name]["jobs"].append(smoke_job)
+    worker = partial(
+        regenerate_or_fail,
+        matrix_config=matrix_config,
+        cache=None if args.force else cache,
+        matrix_hash=matrix_hash,
+        history=history,
+        image_lock=image_lock,
+    )
+    if args.jobs > 1 and len(project_dirs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
 
-# Add the generated workflows to the CircleCI config
-circleci_config["workflows"].update(workflows)
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(worker, project_dirs))
+    else:
+        results = [worker(project_dir) for project_dir in project_dirs]
 
-# Write the CircleCI config
-circleci_dir = os.path.join(project_dir, ".circleci")
-os.makedirs(circleci_dir, exist_ok=True)
-config_file = os.path.join(circleci_dir, "config.yml")
+    messages = {
+        "generated": "CircleCI configuration generated at {}",
+        "unchanged": "CircleCI configuration unchanged at {}",
+        "skipped": "CircleCI configuration up to date at {} (inputs unchanged)",
+    }
+    failed = 0
+    for project_dir, (config_file, status, entry) in zip(project_dirs, results):
+        if status == "failed":
+            # Regenerated on the next run, whatever its fingerprint
+            failed += 1
+            cache.pop(os.path.abspath(project_dir), None)
+            print(f"FAILED {os.path.abspath(project_dir)}: {entry}", file=sys.stderr)
+            continue
+        cache[os.path.abspath(project_dir)] = entry
+        print(messages[status].format(config_file))
+    # Projects generated before (or after) a failing one keep their fingerprints
+    save_cache(args.cache_file, cache)
+    return 1 if failed else 0
 
-with open(config_file, "w") as f:
-    yaml.dump(circleci_config, f)
 
-print(f"CircleCI configuration generated at {config_file}")
+if __name__ == "__main__":
+    sys.exit(main())
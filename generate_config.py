@@ -10,132 +10,429 @@ the build system consumes:
     (generate_circleci_config.py) reads.
   - buildstrap/matrix.sh — bash array of dist → distro/version, sourced by
     shell scripts (e.g. ~/scripts/upstream-check-and-build-all.sh).
+  - buildstrap/cells.json — every dist version with its settings resolved
+    (version_overrides, defaults), for downstream consumers.
   - ../rpmbuilder/distro_versions.json and defaults — feed the rpmbuilder
     image-build GitHub Action matrix.
+  - buildstrap/config_nginx.yml — a copy of the config.yml setup template
+    (edit config.yml only).
+
+All of them are rendered from one resolution pass by the exporters
+registered with @exporter, and written atomically and only when their bytes
+change; --changed-list reports which ones did, so cron.sh can skip the
+commit and push on days nothing changed.
+
+lastversion polls run concurrently on a bounded thread pool, each with its own
+timeout, so one slow or hung upstream can't stall the daily cron.sh run.
+Successful results are kept in an on-disk TTL cache; a distro whose poll
+fails (error or timeout) keeps the versions it had in the previous matrix.json.
 
 The old generated_config{,_nginx,_self,_specs_only,_nginx_without_plesk}.yml
 template writers retired 2026-06-12. Their consumers (~150 repos) all
 migrated to per-project settings.yml + generate_circleci_config.py.
 """
+import argparse
 import stat
 import json
-
-import lastversion
-import yaml
+import threading
+import time
 import os
 
-abspath = os.path.abspath(__file__)
-os.chdir(os.path.dirname(abspath))
-with open("matrix.yml", "r") as f:
+from buildfiles import write_if_changed
+
+# lastversion (and its requests/packaging/feedparser tree), PyYAML and the
+# thread pool are imported where they're used: distros with
+# `versions_check: false` or a fresh cache entry never poll, and importing
+# this module (benchmark.py, hooks) shouldn't pay for either.
+
+# lastversion results cache (see resolve_latest_versions())
+default_cache_file = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "buildstrap",
+    "lastversion.json",
+)
+
+
+def latest_release(distro):
+    """Major release number of the latest `distro` release, per lastversion."""
+    import lastversion
+
+    return lastversion.latest(distro).release[0]
+
+
+def call_with_timeout(fn, arg, timeout):
+    """Run fn(arg) in a daemon thread and give up after `timeout` seconds.
+
+    A hung call is abandoned rather than joined, so it can't keep the
+    process alive after everything else finished.
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome["value"] = fn(arg)
+        except Exception as exc:
+            outcome["error"] = exc
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"no answer within {timeout}s")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["value"]
+
+
+def poll_latest_versions(distro_names, latest=latest_release, workers=4, timeout=60):
+    """Poll `latest` for every distro concurrently.
+
+    Returns {distro: version or the exception the poll ended with}.
+    """
+    if not distro_names:
+        return {}
+    from concurrent.futures import ThreadPoolExecutor
+
+    def poll(distro):
+        try:
+            return call_with_timeout(latest, distro, timeout)
+        except Exception as exc:
+            return exc
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(distro_names, pool.map(poll, distro_names)))
+
+
+def load_version_cache(cache_file):
     try:
-        distros_config = yaml.safe_load(f)
-    except yaml.YAMLError as exc:
-        print(exc)
-        exit(1)
+        with open(cache_file, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
 
-distros = distros_config["distros"]
-for distro, distro_config in distros.items():
-    if "dir" not in distro_config:
-        distro_config["dir"] = distro_config["dist"]
-    if "versions_check" in distro_config and not distro_config["versions_check"]:
-        continue
-    distro_version = lastversion.latest(distro).release[0]
-    print(f"Latest version for {distro} is {distro_version}")
-    # array of OS releases, of course we build against the current version always:
-    distros[distro]["versions"] = [distro_version]
-    # build against that many past releases of OS
-    os_versions = distro_config.get(
-        "os_versions", distros_config["distro_defaults"]["os_versions"]
+def save_version_cache(cache_file, cache):
+    # Atomic, so that an interrupted or concurrent run can't leave a torn cache
+    cache_file = os.path.abspath(cache_file)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    write_if_changed(
+        cache_file, json.dumps(cache, indent=4, sort_keys=True).encode("utf-8")
     )
 
-    # now add past release of the OS:
-    for i in range(1, os_versions):
-        distros[distro]["versions"].append(distro_version - i)
-
-    if distro_config.get("include_rolling_release", False):
-        distros[distro]["versions"].append(distro_version + 1)
-
-# write helper bash arrays for shell scripts
-# declare -A dists=(
-#   ["el6"]="redhat/6"
-#   ["el7"]="redhat/7"
-#   ["el8"]="redhat/8"
-#   ["el9"]="redhat/9"
-#   ["fc33"]="fedora/33"
-#   ["fc34"]="fedora/34"
-#   ["fc35"]="fedora/35"
-#   ["fc36"]="fedora/36"
-#   ["fc37"]="fedora/37"
-#   ["amzn2"]="amzn/2"
-#   ["sles15"]="sles/15"
-# )
-dists_array_s_list = [
-    "#!/bin/bash",
-    "# auto-generated by generate_config.py from matrix.yml",
-    "# mapping of dists to directories:",
-    "declare -A dists=(",
-]
-for distro_name, distro_config in distros.items():
-    for v in distro_config["versions"]:
-        line_fmt = '  ["{}"]="{}"'
-        dists_array_s_list.append(
-            line_fmt.format(
-                f"{distro_config['dist']}{v}", f"{distro_config['dir']}/{v}"
+
+def resolve_latest_versions(
+    distro_names,
+    cache_file=default_cache_file,
+    ttl=6 * 3600,
+    latest=latest_release,
+    workers=4,
+    timeout=60,
+):
+    """Latest version per distro: cached if younger than `ttl`, polled otherwise.
+
+    Distros whose poll failed are reported in the second return value
+    ({distro: exception}) and are absent from the first.
+    """
+    now = time.time()
+    cache = load_version_cache(cache_file) if cache_file else {}
+    versions = {}
+    for distro in distro_names:
+        entry = cache.get(distro)
+        if entry and now - entry["checked"] < ttl:
+            versions[distro] = entry["version"]
+    to_poll = [distro for distro in distro_names if distro not in versions]
+    failures = {}
+    for distro, result in poll_latest_versions(
+        to_poll, latest=latest, workers=workers, timeout=timeout
+    ).items():
+        if isinstance(result, Exception):
+            failures[distro] = result
+            continue
+        versions[distro] = result
+        cache[distro] = {"version": result, "checked": now}
+    if cache_file and len(failures) < len(to_poll):
+        save_version_cache(cache_file, cache)
+    return versions, failures
+
+
+def load_previous_distros(matrix_file="matrix.json"):
+    """Distros of the previously written matrix.json, for last-known-good fallback."""
+    try:
+        with open(matrix_file, "r", encoding="utf-8") as f:
+            return json.load(f).get("distros", {})
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def apply_latest_versions(distros_config, latest_versions, failures, previous_distros):
+    """Fill in each polled distro's `versions` from its latest version.
+
+    A distro whose poll failed keeps the versions it has in
+    `previous_distros` (the previous matrix.json) instead; the failed distros
+    without any are returned, and the matrix mustn't be written then.
+    """
+    distros = distros_config["distros"]
+    missing = []
+    for distro, distro_config in distros.items():
+        if "dir" not in distro_config:
+            distro_config["dir"] = distro_config["dist"]
+        if "versions_check" in distro_config and not distro_config["versions_check"]:
+            continue
+        if distro in failures:
+            # Last-known-good: keep what the previous matrix.json had
+            previous_versions = previous_distros.get(distro, {}).get("versions")
+            if not previous_versions:
+                print(f"Failed to get latest version for {distro}: {failures[distro]}")
+                missing.append(distro)
+                continue
+            print(
+                f"Failed to get latest version for {distro}: {failures[distro]}; "
+                f"keeping previous versions {previous_versions}"
             )
+            distros[distro]["versions"] = previous_versions
+            continue
+        distro_version = latest_versions[distro]
+        print(f"Latest version for {distro} is {distro_version}")
+        # array of OS releases, of course we build against the current version always:
+        distros[distro]["versions"] = [distro_version]
+        # build against that many past releases of OS
+        os_versions = distro_config.get(
+            "os_versions", distros_config["distro_defaults"]["os_versions"]
         )
-dists_array_s_list.append(")")
-
-dists_array_s_list.append("# mapping of directories to full descriptive names:")
-# declare -A os_long=( ["redhat"]="CentOS/RHEL" ["amzn"]="Amazon Linux" ["fedora"]="Fedora Linux" )
-dists_array_s_list.append("declare -A os_long=(")
-for distro_name, distro_config in distros.items():
-    line_fmt = '  ["{}"]="{}"'
-    dists_array_s_list.append(
-        line_fmt.format(f"{distro_config['dir']}", f"{distro_config['description']}")
+
+        # now add past release of the OS:
+        for i in range(1, os_versions):
+            distros[distro]["versions"].append(distro_version - i)
+
+        if distro_config.get("include_rolling_release", False):
+            distros[distro]["versions"].append(distro_version + 1)
+    return missing
+
+
+def resolve_cells(distros_config):
+    """One fully resolved record per distro version, in matrix order.
+
+    Per-version `version_overrides` win over the distro's settings, which win
+    over `distro_defaults`; every exporter renders from these records.
+    """
+    defaults = distros_config.get("distro_defaults", {})
+    cells = []
+    for distro_name, distro_config in distros_config["distros"].items():
+        overrides = distro_config.get("version_overrides", {})
+        for version in distro_config["versions"]:
+            settings = {
+                **defaults,
+                **distro_config,
+                **(overrides.get(version) or overrides.get(str(version)) or {}),
+            }
+            dist = settings.get("dist", distro_name)
+            cells.append(
+                {
+                    "distro": distro_name,
+                    "dist": dist,
+                    "version": version,
+                    "dist_version": f"{dist}{version}",
+                    "dir": settings.get("dir", dist),
+                    "description": settings["description"],
+                    "human_label": settings.get("human_label", settings["description"]),
+                    "rpmbuilder_name": settings["rpmbuilder_name"],
+                    # The rpmbuilder image's base image, by default the
+                    # Docker Hub image named like the distro
+                    "docker": settings.get("docker", settings["rpmbuilder_name"]),
+                    "packager": settings.get("packager"),
+                    "has_plesk": settings.get("has_plesk", False),
+                    "has_aarch64": settings.get("has_aarch64", True),
+                }
+            )
+    return cells
+
+
+# Artifact exporters: path (relative to this script's directory) →
+# (render(matrix, cells) returning bytes, executable). Register new formats
+# with @exporter; export_artifacts() renders them all from one resolution
+# pass and only rewrites the files whose bytes change.
+exporters = {}
+
+rpmbuilder_dir = "../rpmbuilder"
+
+
+def exporter(*paths, executable=False):
+    def register(render):
+        for path in paths:
+            exporters[path] = (render, executable)
+        return render
+
+    return register
+
+
+@exporter("matrix.sh", executable=True)
+def render_matrix_sh(distros_config, cells):
+    """Bash arrays of dist → distro/version and dir → description, sourced by
+    shell scripts (e.g. ~/scripts/upstream-check-and-build-all.sh)."""
+    # declare -A dists=(
+    #   ["el9"]="redhat/9"
+    #   ["fc44"]="fedora/44"
+    #   ["amzn2"]="amzn/2"
+    # )
+    lines = [
+        "#!/bin/bash",
+        "# auto-generated by generate_config.py from matrix.yml",
+        "# mapping of dists to directories:",
+        "declare -A dists=(",
+    ]
+    for cell in cells:
+        lines.append(f'  ["{cell["dist_version"]}"]="{cell["dir"]}/{cell["version"]}"')
+    lines.append(")")
+    lines.append("# mapping of directories to full descriptive names:")
+    # declare -A os_long=( ["redhat"]="CentOS/RHEL" ["amzn"]="Amazon Linux" ["fedora"]="Fedora Linux" )
+    lines.append("declare -A os_long=(")
+    for distro_config in distros_config["distros"].values():
+        lines.append(f'  ["{distro_config["dir"]}"]="{distro_config["description"]}"')
+    lines.append(")")
+    lines.append("")
+    return "\n".join(lines).encode("utf-8")
+
+
+@exporter("matrix.json", f"{rpmbuilder_dir}/matrix.json")
+def render_matrix_json(distros_config, cells):
+    """matrix.yml with the versions filled in: what generate_circleci_config.py
+    and the Repo Explorer at GetPageSpeed read."""
+    return json.dumps(distros_config, indent=4).encode("utf-8")
+
+
+@exporter("cells.json")
+def render_cells_json(distros_config, cells):
+    """Every dist version with its settings resolved (resolve_cells()), for
+    consumers that shouldn't re-implement the defaults/overrides lookup."""
+    return (json.dumps({"cells": cells}, indent=4) + "\n").encode("utf-8")
+
+
+@exporter(f"{rpmbuilder_dir}/distro_versions.json")
+def render_distro_versions(distros_config, cells):
+    """The matrix: of the rpmbuilder image-build GitHub Actions workflow."""
+    distro_versions = [
+        {"os": cell["rpmbuilder_name"], "version": cell["version"]} for cell in cells
+    ]
+    return json.dumps({"include": distro_versions}, indent=4).encode("utf-8")
+
+
+@exporter(f"{rpmbuilder_dir}/defaults")
+def render_rpmbuilder_defaults(distros_config, cells):
+    """`<rpmbuilder name> <version>` lines for the rpmbuilder project."""
+    return "\n".join(f"{cell['rpmbuilder_name']} {cell['version']}" for cell in cells).encode(
+        "utf-8"
+    )
+
+
+@exporter("config_nginx.yml")
+def render_config_nginx(distros_config, cells):
+    """The config.yml setup template, under the name NGINX module repositories
+    were set up with: one template to edit, both URLs keep working."""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yml"), "rb") as f:
+        return f.read()
+
+
+def export_artifacts(distros_config, base_dir):
+    """Write every registered artifact under base_dir; returns the changed paths."""
+    cells = resolve_cells(distros_config)
+    # Artifacts sharing a renderer (matrix.json and its rpmbuilder copy) are
+    # rendered once
+    rendered = {}
+    changed = []
+    for path, (render, executable) in exporters.items():
+        if render not in rendered:
+            rendered[render] = render(distros_config, cells)
+        full_path = os.path.normpath(os.path.join(base_dir, path))
+        updated = write_if_changed(full_path, rendered[render])
+        if executable:
+            mode = os.stat(full_path).st_mode
+            if not mode & stat.S_IEXEC:
+                os.chmod(full_path, mode | stat.S_IEXEC)
+                updated = True
+        if updated:
+            changed.append(path)
+    return changed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Poll latest OS releases and write the matrix artifacts."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Concurrent lastversion polls."
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="Per-distro poll timeout in seconds (default: 60).",
+    )
+    parser.add_argument(
+        "--cache-file",
+        default=default_cache_file,
+        help=f"lastversion result cache (default: {default_cache_file}).",
     )
-dists_array_s_list.append(")")
-dists_array_s_list.append("")
-
-with open("matrix.sh", "w") as f:
-    f.write("\n".join(dists_array_s_list))
-
-st = os.stat("matrix.sh")
-os.chmod("matrix.sh", st.st_mode | stat.S_IEXEC)
-
-# Generate matrix.json which is useful for Repo Explorer feature at GetPageSpeed
-# Same as matrix.yml but in json format and with filled out versions
-# Just json dump distros variables
-with open("matrix.json", "w", encoding="utf-8") as f:
-    json.dump(distros_config, f, indent=4)
-
-# If rpmbuilder directory exists, cd into it, otherwise exit with error
-if not os.path.exists("../rpmbuilder"):
-    print("rpmbuilder directory not found")
-    exit(1)
-
-# cd into rpmbuilder directory
-os.chdir("../rpmbuilder")
-
-# Also write matrix.json for the rpmbuilder project
-with open("matrix.json", "w", encoding="utf-8") as f:
-    json.dump(distros_config, f, indent=4)
-
-# Create special distro_versions.json for the rpmbuilder project
-# Used in matrix: of its GitHub Actions workflow
-distro_versions = []
-for distro_name, distro_config in distros.items():
-    for v in distro_config["versions"]:
-        distro_versions.append({"os": distro_config["rpmbuilder_name"], "version": v})
-with open("distro_versions.json", "w", encoding="utf-8") as f:
-    json.dump({"include": distro_versions}, f, indent=4)
-
-# Write defaults file as well:
-default_lines = []
-for distro_name, distro_config in distros.items():
-    for v in distro_config["versions"]:
-        default_lines.append(f"{distro_config['rpmbuilder_name']} {v}")
-# write to defaults file at ../rpmbuilder/defaults
-with open("defaults", "w", encoding="utf-8") as f:
-    f.write("\n".join(default_lines))
-
-print("Done")
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=6 * 3600,
+        help="Seconds a cached lastversion result stays fresh (default: 21600).",
+    )
+    parser.add_argument(
+        "--refresh", action="store_true", help="Ignore cached results and re-poll."
+    )
+    parser.add_argument(
+        "--changed-list",
+        metavar="FILE",
+        help="Write the paths of the artifacts this run changed to FILE, one per "
+        "line (empty if none); cron.sh skips commit and push then.",
+    )
+    args = parser.parse_args(argv)
+
+    import yaml
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, "matrix.yml"), "r") as f:
+        try:
+            distros_config = yaml.safe_load(f)
+        except yaml.YAMLError as exc:
+            print(exc)
+            exit(1)
+
+    previous_distros = load_previous_distros(os.path.join(here, "matrix.json"))
+    distros = distros_config["distros"]
+    polled = [
+        distro
+        for distro, distro_config in distros.items()
+        if distro_config.get("versions_check", True)
+    ]
+    latest_versions, failures = resolve_latest_versions(
+        polled,
+        cache_file=args.cache_file,
+        ttl=0 if args.refresh else args.cache_ttl,
+        workers=args.workers,
+        timeout=args.timeout,
+    )
+    missing = apply_latest_versions(distros_config, latest_versions, failures, previous_distros)
+    if missing:
+        exit(1)
+
+    # If rpmbuilder directory exists, export there too, otherwise exit with error
+    if not os.path.exists(os.path.join(here, rpmbuilder_dir)):
+        print("rpmbuilder directory not found")
+        exit(1)
+
+    changed = export_artifacts(distros_config, here)
+    for path in changed:
+        print(f"Updated {path}")
+    if not changed:
+        print("No artifact changed")
+    if args.changed_list:
+        with open(args.changed_list, "w", encoding="utf-8") as f:
+            f.write("".join(f"{path}\n" for path in changed))
+
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
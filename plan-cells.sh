@@ -0,0 +1,75 @@
+#!/bin/sh
+# Pre-flight plan for generate_circleci_config.py (settings.yml `plan: true`).
+# Runs inside getpagespeed/rpmbuilder:<dist> on a small resource class, before
+# any build executor is provisioned, and decides per cell whether its NVR is
+# already published in the channel the build would check (its enable_repos).
+#
+#   plan-cells.sh OUT_FILE CELL...
+#
+# CELL is <workflow>:<arch>:<repo>:<git branch>[+<git branch>...][:<macro>=<value>[+...]]
+# Cells whose git branches don't include $CIRCLE_BRANCH are left out (their
+# workflows are filtered away by CircleCI anyway). For every other cell a
+# "<workflow> skip" or "<workflow> build" line is appended to OUT_FILE.
+# A cell is only skipped when the source RPM of every spec in the checkout
+# is found in the channel; anything that can't be determined builds.
+
+out=$1
+shift
+: > "$out"
+
+# published_srpms REPO ARCH: file listing the channel's source RPMs
+published_srpms() {
+    list=/tmp/plan-published-$1-$2
+    if [ ! -f "$list" ]; then
+        forcearch=""
+        if [ "$2" != noarch ] && [ "$2" != "$(uname -m)" ]; then
+            forcearch="--forcearch=$2"
+        fi
+        if command -v dnf > /dev/null 2>&1; then
+            dnf -q repoquery --disablerepo='*' --enablerepo="$1" $forcearch \
+                --qf '%{sourcerpm}' 2> /dev/null | sort -u > "$list" || : > "$list"
+        elif command -v repoquery > /dev/null 2>&1 && [ -z "$forcearch" ]; then
+            repoquery -a --disablerepo='*' --enablerepo="$1" \
+                --qf '%{sourcerpm}' 2> /dev/null | sort -u > "$list" || : > "$list"
+        else
+            : > "$list"
+        fi
+    fi
+    echo "$list"
+}
+
+# srpms_of MACROS: source RPM names of all specs, one per line
+srpms_of() {
+    defines="--define 'nginx_branch $CIRCLE_BRANCH'"
+    for macro in $(echo "$1" | tr '+' ' '); do
+        defines="$defines --define '${macro%%=*} ${macro#*=}'"
+    done
+    found=""
+    for spec in *.spec; do
+        [ -f "$spec" ] || continue
+        found=1
+        eval "rpmspec -q --srpm --qf '%{name}-%{version}-%{release}.src.rpm\n' $defines \"\$spec\"" 2> /dev/null \
+            || echo "unknown-spec-$spec"
+    done
+    [ -n "$found" ] || echo "no-spec-files"
+}
+
+for cell; do
+    IFS=: read -r workflow arch repo git_branches macros <<EOF
+$cell
+EOF
+    case "+$git_branches+" in
+        *"+$CIRCLE_BRANCH+"*) ;;
+        *) continue ;;
+    esac
+    list=$(published_srpms "$repo" "$arch")
+    status=skip
+    for srpm in $(srpms_of "$macros"); do
+        if ! grep -qxF "$srpm" "$list"; then
+            status=build
+            break
+        fi
+    done
+    echo "$workflow: $status ($arch, $repo)"
+    echo "$workflow $status" >> "$out"
+done
@@ -2,33 +2,10 @@
 
 set -euo pipefail
 
-# Always run from the buildstrap directory so matrix.sh is in a known location
+# Always run from the buildstrap directory so matrix.json is in a known location
 cd "$(dirname "${BASH_SOURCE[0]}")"
 
-# Load distro matrix (defines the 'dists' associative array)
-source ./matrix.sh
-
-if [ "$#" -gt 0 ]; then
-  # If specific dists are passed, only pull those
-  dists_to_pull=("$@")
-else
-  # Otherwise pull all known dists from the matrix
-  dists_to_pull=("${!dists[@]}")
-fi
-
-for dist in "${dists_to_pull[@]}"; do
-  echo "Pulling getpagespeed/rpmbuilder:${dist} ..."
-  docker pull "getpagespeed/rpmbuilder:${dist}"
-done
-
-
-
-
-
-
-
-
-
-
-
-
+# Pull the given dists (default: all of matrix.json) in parallel, skipping
+# tags whose image is unchanged, and refresh rpmbuilder.lock.json; see
+# pull_images.py for the options
+exec ./pull_images.py "$@"
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Pull the rpmbuilder images of every dist in matrix.json, in parallel.
+
+    ./pull_images.py                 # every dist (el9, fc44, ...) of matrix.json
+    ./pull_images.py el9 fc44        # just these
+    ./pull_images.py --jobs 8 --force
+
+Before pulling a tag, its registry manifest is checked (`docker manifest
+inspect`): a tag whose manifest is the one recorded in the digest index
+(~/.cache/buildstrap/rpmbuilder-images.json) and whose image is present
+locally is skipped. After a pull, the image's repo digest is recorded.
+
+The tag → digest map is written to rpmbuilder.lock.json next to
+matrix.json (only rewritten when it changes); generate_circleci_config.py
+pins the build executor's image by those digests for projects with
+settings.yml `pin_images: true`. A dist that fails to pull keeps its
+previous lock entry.
+
+--docker names the docker binary, e.g. a stub for testing.
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from buildfiles import default_image_lock_file, load_matrix, write_if_changed
+
+default_image = "getpagespeed/rpmbuilder"
+
+default_index_file = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "buildstrap",
+    "rpmbuilder-images.json",
+)
+
+
+def matrix_dists(matrix_config):
+    """Dist tags (el9, fc44, ...) of matrix.json, in matrix order."""
+    return [
+        f"{distro.get('dist', name)}{version}"
+        for name, distro in matrix_config.get("distros", {}).items()
+        for version in distro.get("versions", [])
+    ]
+
+
+def docker(docker_bin, *args):
+    """(exit status, stdout, stderr) of a docker command."""
+    result = subprocess.run([docker_bin, *args], capture_output=True, text=True)
+    return result.returncode, result.stdout, result.stderr
+
+
+def manifest_fingerprint(docker_bin, reference):
+    """Hash of the tag's registry manifest; None if it can't be checked."""
+    status, stdout, _ = docker(docker_bin, "manifest", "inspect", reference)
+    if status != 0:
+        return None
+    return hashlib.sha256(stdout.encode("utf-8")).hexdigest()
+
+
+def local_digest(docker_bin, image, reference):
+    """sha256:... repo digest of the local copy of reference; None if absent."""
+    status, stdout, _ = docker(
+        docker_bin, "image", "inspect", "--format", "{{json .RepoDigests}}", reference
+    )
+    if status != 0:
+        return None
+    try:
+        repo_digests = json.loads(stdout)
+    except ValueError:
+        return None
+    for repo_digest in repo_digests or []:
+        name, _, digest = repo_digest.partition("@")
+        if name == image or name.endswith("/" + image):
+            return digest
+    return None
+
+
+def pull_dist(docker_bin, image, dist, known, force=False):
+    """Bring one dist's image up to date.
+
+    `known` is the dist's digest index entry ({} if none). Returns (status,
+    index entry, message), status being "pulled", "unchanged" or "failed".
+    """
+    reference = f"{image}:{dist}"
+    manifest = manifest_fingerprint(docker_bin, reference)
+    if not force and manifest and manifest == known.get("manifest"):
+        digest = local_digest(docker_bin, image, reference)
+        if digest and digest == known.get("digest"):
+            return "unchanged", known, digest
+    status, stdout, stderr = docker(docker_bin, "pull", "--quiet", reference)
+    if status != 0:
+        return "failed", known, (stderr or stdout).strip().splitlines()[-1:] or ["docker pull failed"]
+    digest = local_digest(docker_bin, image, reference)
+    if not digest:
+        return "failed", known, [f"no repo digest for {reference} after pulling"]
+    # Without a manifest check (e.g. no `docker manifest`), the next run pulls again
+    return "pulled", {"manifest": manifest, "digest": digest}, digest
+
+
+def load_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return write_if_changed(path, (json.dumps(data, indent=2, sort_keys=True) + "\n").encode("utf-8"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pull rpmbuilder images in parallel.")
+    parser.add_argument("dists", nargs="*", help="Dists to pull (default: all of matrix.json).")
+    parser.add_argument("--matrix", help="Path to matrix.json (default: the shipped one).")
+    parser.add_argument("--image", default=default_image, help=f"Image (default: {default_image}).")
+    parser.add_argument("--jobs", type=int, default=4, help="Concurrent pulls (default: 4).")
+    parser.add_argument("--docker", default=os.environ.get("DOCKER", "docker"), help="docker binary.")
+    parser.add_argument(
+        "--index-file",
+        default=default_index_file,
+        help=f"Digest index (default: {default_index_file}).",
+    )
+    parser.add_argument(
+        "--lock-file",
+        default=default_image_lock_file,
+        help=f"Tag → digest lock file to write (default: {default_image_lock_file}).",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Pull even tags whose manifest is unchanged."
+    )
+    args = parser.parse_args(argv)
+
+    known_dists = matrix_dists(load_matrix(args.matrix))
+    dists = args.dists or known_dists
+    index = load_json(args.index_file)
+    images = index.setdefault(args.image, {})
+
+    def work(dist):
+        return dist, pull_dist(args.docker, args.image, dist, images.get(dist, {}), args.force)
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        for dist, (status, entry, message) in pool.map(work, dists):
+            if status == "failed":
+                failed += 1
+                print(f"FAILED {args.image}:{dist}: {' '.join(message)}", file=sys.stderr)
+                continue
+            images[dist] = entry
+            print(f"{status} {args.image}:{dist} {message}")
+
+    write_json(args.index_file, index)
+    # Only the matrix's dists are pinned; dists not pulled this time keep
+    # their previous digest
+    lock = load_json(args.lock_file)
+    lock = {
+        dist: images[dist]["digest"] if dist in images else lock[dist]
+        for dist in known_dists
+        if dist in images or dist in lock
+    }
+    if write_json(args.lock_file, lock):
+        print(f"Updated {args.lock_file}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
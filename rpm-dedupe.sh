@@ -0,0 +1,62 @@
+#!/bin/sh
+# Content-addressed RPM deploy helper, run on the build server by the deploy
+# jobs of generate_circleci_config.py (settings.yml `deploy: {dedupe: true}`).
+# The deploy job ships this file itself (installed as ~/.buildstrap/rpm-dedupe.sh),
+# so there is nothing to install on the server by hand.
+#
+#   rpm-dedupe.sh check ROOT   stdin: sha256sum manifest ("<sha256>  <relpath>").
+#                              RPMs whose content the store already has are
+#                              hard-linked into ROOT/<relpath>; the relpaths
+#                              that still need uploading are printed.
+#   rpm-dedupe.sh store DIR... add the RPMs in DIR(s) to the store (run after
+#                              the upload, before incoming.sh moves them away)
+#
+# Store: $RPM_DEDUPE_STORE (default ~/incoming/.objects), one file per sha256.
+# Objects not linked anywhere for $RPM_DEDUPE_TTL_DAYS (default 30) days are
+# pruned by `store`.
+set -e
+
+objects=${RPM_DEDUPE_STORE:-$HOME/incoming/.objects}
+ttl_days=${RPM_DEDUPE_TTL_DAYS:-30}
+
+link() {
+    ln -f "$1" "$2" 2>/dev/null || cp -p "$1" "$2"
+}
+
+check() {
+    root=$1
+    mkdir -p "$root" "$objects"
+    while read -r sum path; do
+        [ -n "$sum" ] || continue
+        dest=$root/$path
+        if [ -f "$objects/$sum" ]; then
+            mkdir -p "$(dirname "$dest")"
+            link "$objects/$sum" "$dest"
+        else
+            echo "$path"
+        fi
+    done
+}
+
+store() {
+    mkdir -p "$objects"
+    for dir; do
+        find "$dir" -name '*.rpm' -type f | while read -r rpm; do
+            sum=$(sha256sum "$rpm" | cut -d' ' -f1)
+            [ -f "$objects/$sum" ] || link "$rpm" "$objects/$sum"
+        done
+    done
+    # linking an object (check) refreshes its ctime; drop the stale ones
+    find "$objects" -type f -ctime +"$ttl_days" -exec rm -f {} +
+}
+
+command=$1
+shift
+case "$command" in
+    check) check "$@" ;;
+    store) store "$@" ;;
+    *)
+        echo "usage: $0 check ROOT < manifest | store DIR..." >&2
+        exit 64
+        ;;
+esac
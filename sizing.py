@@ -0,0 +1,131 @@
+"""
+Telemetry-driven resource_class sizing for build cells.
+
+The history file is JSON lines, one record per finished build job:
+
+    {"repo": "nginx-module-foo", "dist": "el9", "arch": "x86_64",
+     "branch": "mainline", "resource_class": "medium", "duration": 412,
+     "peak_rss_mb": 2710, "oom": false}
+
+`branch` is the matrix branch key (e.g. "stable", "master" for single-branch
+projects), `duration` is in seconds. For every cell with history, the
+classes whose memory fits the peak RSS of its recent runs (plus headroom)
+are candidates; a run that OOMed rules out the class it OOMed on and those
+below it. Among the candidates the cell has run on, the one its recent
+runs cost the fewest credits on (median duration × credits per minute)
+wins, the faster one when two are within 10%; without runs on any of them,
+the cheapest. A cell whose median build takes longer than
+slow_build_seconds on the picked class tries the next one up, if it hasn't
+run there yet: the following runs tell whether the bigger class pays off.
+
+Records of instrumented builds (timings_report.py --history-out) also carry
+`"specs": {"<name>.spec": seconds}`, the wall time of each spec's rpmbuild
+from %prep to its last written RPM; spec_weights() turns them into per-spec
+build times for sharded builds (settings.yml `shards:`).
+"""
+import json
+from collections import defaultdict
+
+# CircleCI Docker resource classes: (name, memory in MB, credits per minute),
+# cheapest first
+x86_resource_classes = [
+    ("small", 2048, 5),
+    ("medium", 4096, 10),
+    ("medium+", 6144, 15),
+    ("large", 8192, 20),
+    ("xlarge", 16384, 40),
+    ("2xlarge", 32768, 80),
+    ("2xlarge+", 40960, 100),
+]
+
+arm_resource_classes = [
+    ("arm.medium", 8192, 10),
+    ("arm.large", 16384, 20),
+    ("arm.xlarge", 32768, 40),
+    ("arm.2xlarge", 65536, 80),
+]
+
+# Only the most recent runs of a cell count: specs change over time
+recent_runs = 10
+# Peak RSS is multiplied by this before looking for a class that fits
+memory_headroom = 1.25
+# Median build seconds above which a cell tries the next class up
+slow_build_seconds = 30 * 60
+# Credit costs within this fraction of each other count as a tie, which
+# the faster class wins
+cost_tolerance = 0.1
+
+
+def load_history(history_file):
+    """Index a history file by (repo, dist, arch, branch), oldest record first."""
+    history = defaultdict(list)
+    with open(history_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            key = (record["repo"], record["dist"], record["arch"], record["branch"])
+            history[key].append(record)
+    return dict(history)
+
+
+def project_history(history, repo):
+    """The part of the history index that belongs to one repo."""
+    return {key: records for key, records in (history or {}).items() if key[0] == repo}
+
+
+def pick_resource_class(records, arch):
+    """Resource class for a cell from its recent runs (see above); None without history."""
+    records = records[-recent_runs:]
+    if not records:
+        return None
+    classes = arm_resource_classes if arch == "aarch64" else x86_resource_classes
+    memory = {name: mb for name, mb, _ in classes}
+    required_mb = max((r.get("peak_rss_mb") or 0) for r in records) * memory_headroom
+    for record in records:
+        # An OOM means the class it ran on was too small, whatever RSS was seen
+        if record.get("oom") and record.get("resource_class") in memory:
+            required_mb = max(required_mb, memory[record["resource_class"]] + 1)
+    fitting = [c for c in sorted(classes, key=lambda c: c[2]) if c[1] >= required_mb]
+    if not fitting:
+        return classes[-1][0]
+
+    # Durations of OOMed runs say nothing about a full build
+    durations = defaultdict(list)
+    for record in records:
+        if record.get("duration") and not record.get("oom"):
+            durations[record.get("resource_class")].append(record["duration"])
+    observed = []
+    for index, (name, _, credits) in enumerate(fitting):
+        if durations[name]:
+            seconds = median(durations[name])
+            observed.append((seconds / 60 * credits, seconds, index))
+    if not observed:
+        return fitting[0][0]
+    cheapest = min(cost for cost, _, _ in observed)
+    seconds, index = min(
+        (seconds, index)
+        for cost, seconds, index in observed
+        if cost <= cheapest * (1 + cost_tolerance)
+    )
+    if seconds > slow_build_seconds and index + 1 < len(fitting):
+        if not durations[fitting[index + 1][0]]:
+            return fitting[index + 1][0]
+    return fitting[index][0]
+
+
+def spec_weights(history):
+    """Median build seconds per spec over the recent runs of a history index."""
+    durations = defaultdict(list)
+    for records in (history or {}).values():
+        for record in records[-recent_runs:]:
+            for spec, seconds in (record.get("specs") or {}).items():
+                durations[spec].append(seconds)
+    return {spec: median(seconds) for spec, seconds in durations.items()}
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
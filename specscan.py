@@ -0,0 +1,325 @@
+"""
+Spec header scanning for arch detection.
+
+scan_spec() reads a spec's main preamble (up to its first section, %prep at
+the latest) line by line and works out, for every CI architecture, whether
+the spec can be built there and whether it is noarch:
+
+  - `BuildArch`, `ExclusiveArch` and `ExcludeArch` tags
+  - `%ifarch` / `%ifnarch` / `%elifarch` / `%else` / `%endif` blocks,
+    evaluated per architecture
+  - `%if` / `%elif` expressions made of numbers, strings, comparisons and
+    `&&` / `||` / `!` once macros are expanded
+  - `%global` / `%define` / `%undefine` in the preamble
+  - the arch list macros of known_macros (%{arm}, %{ix86}, %{go_arches},
+    ...), including `%{?name}` / `%{?name:value}` / `%{!?name:value}`
+
+Anything the scanner cannot decide (unknown macros, %{with ...}, shell
+expansion) is treated as "maybe": a tag under an undecidable condition or
+with an unknown macro never prunes an architecture. Only tags of the main
+package count; a noarch subpackage doesn't make the build noarch.
+
+Results are cached per (path, mtime, size), so the fingerprint and
+detect_archs() of one run scan each spec once.
+"""
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Arch list macros as defined by redhat-rpm-config / the *-srpm-macros
+# packages of the build images
+known_macros = {
+    "arm": "armv3l armv4b armv4l armv4tl armv5tl armv5tel armv5tejl armv6l armv6hl "
+    "armv7l armv7hl armv7hnl armv8l armv8hl armv8hnl armv8hcnl",
+    "arm32": "%{arm}",
+    "arm64": "aarch64",
+    "ix86": "i386 i486 i586 i686 pentium3 pentium4 athlon geode",
+    "x86_64": "x86_64 amd64 em64t",
+    "power64": "ppc64p7 ppc64 ppc64le",
+    "s390x": "s390x",
+    "mips": "mips mipsel mipsr6 mipsr6el mips64 mips64el mips64r6 mips64r6el",
+    "riscv": "riscv64",
+    "riscv64": "riscv64",
+    "sparc": "sparc sparcv8 sparcv9 sparcv9v sparc64 sparc64v",
+    "alpha": "alpha alphaev56 alphaev6 alphaev67",
+    "golang_arches": "%{ix86} x86_64 %{arm} aarch64 ppc64le s390x riscv64",
+    "go_arches": "%{golang_arches}",
+    "gccgo_arches": "%{mips} s390 s390x %{power64} %{sparc}",
+    "nodejs_arches": "%{ix86} x86_64 %{arm} aarch64 %{power64} s390x riscv64",
+    "rust_arches": "x86_64 %{ix86} armv7hl aarch64 ppc64 ppc64le riscv64 s390x",
+    "java_arches": "aarch64 ppc64le s390x x86_64",
+    "ldc_arches": "%{ix86} x86_64 %{arm} aarch64",
+    "mono_arches": "%{ix86} x86_64 sparc sparcv9 ia64 %{arm} aarch64 alpha s390x ppc ppc64 ppc64le",
+    "valgrind_arches": "%{ix86} x86_64 ppc ppc64 ppc64le s390x armv7hl aarch64",
+    "ghc_arches": "%{ix86} x86_64 ppc64le s390x aarch64 armv7hl",
+    "_os": "linux",
+    "nil": "",
+}
+
+# The tags scanned; BuildArchitectures is BuildArch's long form
+arch_tag_re = re.compile(
+    r"^(BuildArch(?:itectures)?|ExclusiveArch|ExcludeArch)\s*:\s*(.*)$", re.IGNORECASE
+)
+# Where the main preamble ends
+section_re = re.compile(
+    r"^%(package|description|prep|build|install|check|clean|files|changelog|pre|post|"
+    r"preun|postun|pretrans|posttrans|verifyscript|generate_buildrequires|conf|"
+    r"sourcelist|patchlist|(?:file|transfile)?trigger\w*)(\s|$)"
+)
+conditional_re = re.compile(
+    r"^%(if|ifarch|ifnarch|ifos|ifnos|elif|elifarch|elifnarch|else|endif)\b\s*(.*)$"
+)
+definition_re = re.compile(r"^%(global|define)\s+(\w+)(?:\([^)]*\))?\s+(.*)$")
+undefine_re = re.compile(r"^%undefine\s+(\w+)")
+# %{name}, %{?name}, %{!?name:value}, %{expand:...}, %name, %(shell), %%
+macro_re = re.compile(r"%(?:\{(!?\??)([\w]+)(?::((?:[^{}]|\{[^{}]*\})*))?\}|(\w+)|(\()|(%))")
+
+SpecArchs = namedtuple("SpecArchs", "archs noarch")
+
+
+class Undecidable(Exception):
+    """A macro or expression the scanner cannot evaluate."""
+
+
+# Marks a macro defined under an undecidable condition; a macro that is
+# certainly undefined (%undefine) maps to None
+unknown = object()
+
+
+def expand(text, macros, depth=0):
+    """text with macros expanded; raises Undecidable on anything unknown."""
+    if depth > 16:
+        raise Undecidable(text)
+
+    def replace(match):
+        flags, name, value, bare, shell, percent = match.groups()
+        if percent:
+            return "%"
+        if shell:
+            raise Undecidable(text)
+        name = name or bare
+        # A macro we know nothing about may well be defined on the builder
+        if name not in macros or macros[name] is unknown:
+            raise Undecidable(name)
+        defined = macros[name]
+        if flags:
+            if (defined is not None) == (flags == "?"):
+                return expand(value if value is not None else defined or "", macros, depth + 1)
+            return ""
+        if defined is None or value is not None:
+            raise Undecidable(name)
+        return expand(defined, macros, depth + 1)
+
+    return macro_re.sub(replace, text)
+
+
+expression_token_re = re.compile(r'\s*(\d+|"[^"]*"|&&|\|\||[=!<>]=|[<>!()]|\w+)')
+
+
+def evaluate(expression):
+    """Truth of an expanded %if expression; raises Undecidable if unsupported."""
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = expression_token_re.match(expression, position)
+        if not match:
+            raise Undecidable(expression)
+        tokens.append(match.group(1))
+        position = match.end()
+        while position < len(expression) and expression[position].isspace():
+            position += 1
+    if not tokens:
+        raise Undecidable(expression)
+
+    def atom(i):
+        token = tokens[i] if i < len(tokens) else None
+        if token == "(":
+            value, i = either(i + 1)
+            if i >= len(tokens) or tokens[i] != ")":
+                raise Undecidable(expression)
+            return value, i + 1
+        if token == "!":
+            value, i = atom(i + 1)
+            return int(not value), i
+        if token is not None and token.isdigit():
+            return int(token), i + 1
+        if token is not None and token.startswith('"'):
+            return token[1:-1], i + 1
+        # Bare words (%{with foo} leftovers, version literals, ...) aren't supported
+        raise Undecidable(expression)
+
+    def comparison(i):
+        left, i = atom(i)
+        if i < len(tokens) and tokens[i] in ("==", "!=", "<", ">", "<=", ">="):
+            operator = tokens[i]
+            right, i = atom(i + 1)
+            if type(left) is not type(right):
+                raise Undecidable(expression)
+            left = int(
+                {
+                    "==": left == right,
+                    "!=": left != right,
+                    "<": left < right,
+                    ">": left > right,
+                    "<=": left <= right,
+                    ">=": left >= right,
+                }[operator]
+            )
+        return left, i
+
+    def both(i):
+        value, i = comparison(i)
+        while i < len(tokens) and tokens[i] == "&&":
+            right, i = comparison(i + 1)
+            value = value and right
+        return value, i
+
+    def either(i):
+        value, i = both(i)
+        while i < len(tokens) and tokens[i] == "||":
+            right, i = both(i + 1)
+            value = value or right
+        return value, i
+
+    value, i = either(0)
+    if i != len(tokens):
+        raise Undecidable(expression)
+    return bool(value)
+
+
+def condition(directive, argument, macros, arch):
+    """True/False for a conditional line, None when undecidable."""
+    try:
+        argument = expand(argument, macros)
+        if directive in ("if", "elif"):
+            return evaluate(argument)
+    except Undecidable:
+        return None
+    words = argument.split()
+    if directive in ("ifarch", "elifarch"):
+        return arch in words
+    if directive == "ifnarch" or directive == "elifnarch":
+        return arch not in words
+    if directive == "ifos":
+        return "linux" in words
+    return "linux" not in words
+
+
+def preamble(lines):
+    """The stripped, non-comment lines of a spec's main preamble."""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if section_re.match(line):
+            return
+        yield line
+
+
+def scan_lines(lines, arch):
+    """(buildable, noarch) of the preamble `lines` when building on `arch`.
+
+    noarch is True only if a BuildArch: noarch applies for sure; buildable is
+    False only if a tag rules `arch` out for sure.
+    """
+    macros = dict(known_macros, _arch=arch, _target_cpu=arch, _build_arch=arch)
+    # One frame per open conditional: [branch state, any branch taken so far];
+    # states are True, False or None (undecidable)
+    frames = []
+    buildable = True
+    noarch = False
+    for line in lines:
+        match = conditional_re.match(line)
+        if match:
+            directive, argument = match.groups()
+            if directive == "endif":
+                if frames:
+                    frames.pop()
+            elif directive == "else":
+                if frames:
+                    taken = frames[-1][1]
+                    frames[-1][0] = None if taken is None else not taken
+            elif directive.startswith("el"):
+                if frames:
+                    taken = frames[-1][1]
+                    value = condition(directive[2:], argument, macros, arch)
+                    if taken is False:
+                        frames[-1] = [value, value]
+                    elif taken is None:
+                        frames[-1] = [False if value is False else None, True if value else None]
+                    else:
+                        frames[-1][0] = False
+            else:
+                value = condition(directive, argument, macros, arch)
+                frames.append([value, value])
+            continue
+        states = [frame[0] for frame in frames]
+        if False in states:
+            continue
+        certain = None not in states
+
+        match = definition_re.match(line)
+        if match:
+            _, name, value = match.groups()
+            try:
+                macros[name] = expand(value, macros) if certain else unknown
+            except Undecidable:
+                macros[name] = unknown
+            continue
+        match = undefine_re.match(line)
+        if match:
+            macros[match.group(1)] = None if certain else unknown
+            continue
+
+        match = arch_tag_re.match(line)
+        if not match or not certain:
+            continue
+        tag, value = match.group(1).lower(), match.group(2)
+        try:
+            values = expand(value, macros).replace(",", " ").split()
+        except Undecidable:
+            continue
+        if tag == "excludearch":
+            if arch in values:
+                buildable = False
+        elif tag == "exclusivearch":
+            if arch not in values and "noarch" not in values:
+                buildable = False
+        elif values == ["noarch"]:
+            noarch = True
+        elif arch not in values:
+            # BuildArch: x86_64 builds for that arch only
+            buildable = False
+    return buildable, noarch
+
+
+@lru_cache(maxsize=4096)
+def _scan_spec(spec_file, mtime_ns, size, archs):
+    with open(spec_file, "r", errors="replace") as f:
+        lines = list(preamble(f))
+    results = {arch: scan_lines(lines, arch) for arch in archs}
+    return SpecArchs(
+        archs=tuple(arch for arch in archs if results[arch][0]),
+        noarch=all(noarch for _, noarch in results.values()),
+    )
+
+
+def scan_spec(spec_file, archs):
+    """SpecArchs of one spec: the `archs` it can be built on, and whether it is noarch."""
+    stat = os.stat(spec_file)
+    return _scan_spec(os.path.abspath(spec_file), stat.st_mtime_ns, stat.st_size, tuple(archs))
+
+
+def project_archs(spec_files, archs):
+    """The `archs` to build a project's specs on: ["noarch"] if all of them are.
+
+    Union over the arch-specific specs; None when there is nothing to go by
+    (no specs, or none of them buildable on any of `archs`).
+    """
+    scanned = [scan_spec(spec_file, archs) for spec_file in spec_files]
+    if scanned and all(spec.noarch for spec in scanned):
+        return ["noarch"]
+    buildable = {arch for spec in scanned if not spec.noarch for arch in spec.archs}
+    return [arch for arch in archs if arch in buildable] or None
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Merge build-timings.json artifacts (settings.yml `instrument: true`, written
+by build-timings.sh) across cells and repos into a slowest-cells report.
+
+    ./timings_report.py ~/timings/            # every build-timings.json below
+    ./timings_report.py --top 30 a.json b.json
+    ./timings_report.py ~/timings/ --history-out ~/.cache/buildstrap/jobs.jsonl
+
+Artifacts are fetched from CircleCI (build-timings/build-timings.json of each
+build job) into any directory layout. --history-out appends one sizing
+record per report to a job history file for
+generate_circleci_config.py --history (see sizing.py).
+"""
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+
+
+def find_reports(paths):
+    """build-timings.json files among `paths` (files or directories)."""
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, _, names in os.walk(path):
+            for name in sorted(names):
+                if name == "build-timings.json":
+                    yield os.path.join(root, name)
+
+
+def load_reports(paths):
+    reports = []
+    for report_file in find_reports(paths):
+        with open(report_file, "r") as f:
+            try:
+                reports.append(json.load(f))
+            except ValueError as exc:
+                print(f"Skipping {report_file}: {exc}", file=sys.stderr)
+    return reports
+
+
+def cell_name(report):
+    return "{}:{}-{}-{}".format(
+        *(report.get(key, "?") for key in ("repo", "dist", "branch", "arch"))
+    )
+
+
+def history_record(report):
+    """The sizing.py history record of one report."""
+    # Per-spec wall time, from %prep to the spec's last written RPM; reports
+    # from before build-timings.sh measured it have none
+    spec_times = report.get("spec_times") or {}
+    record = {
+        "repo": report.get("repo"),
+        "dist": report.get("dist"),
+        "arch": report.get("arch"),
+        "branch": report.get("branch"),
+        "resource_class": report.get("resource_class"),
+        "duration": report.get("duration"),
+        "peak_rss_mb": report.get("peak_rss_mb"),
+        "oom": report.get("oom", False),
+    }
+    if spec_times:
+        record["specs"] = dict(spec_times)
+    return record
+
+
+def print_report(reports, top):
+    reports = sorted(reports, key=lambda r: r.get("duration", 0), reverse=True)
+    print(f"Slowest {min(top, len(reports))} of {len(reports)} cells:")
+    print(f"{'cell':<60} {'total':>8} {'RSS MB':>7} {'RPMs':>5}  slowest phases")
+    for report in reports[:top]:
+        phases = sorted(report.get("phases", {}).items(), key=lambda p: p[1], reverse=True)
+        slowest = ", ".join(f"{name} {seconds:.0f}s" for name, seconds in phases[:3])
+        print(
+            f"{cell_name(report):<60} {report.get('duration', 0):>7.0f}s "
+            f"{report.get('peak_rss_mb', 0):>7} {report.get('rpm_count', 0):>5}  {slowest}"
+            + ("  (OOM)" if report.get("oom") else "")
+        )
+
+    totals = defaultdict(float)
+    for report in reports:
+        for name, seconds in report.get("phases", {}).items():
+            totals[name] += seconds
+    overall = sum(totals.values()) or 1
+    print()
+    print("Time per phase across all cells:")
+    for name, seconds in sorted(totals.items(), key=lambda p: p[1], reverse=True):
+        print(f"  {name:<12} {seconds / 60:>9.1f} min  {100 * seconds / overall:5.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report the slowest build cells.")
+    parser.add_argument("paths", nargs="+", help="build-timings.json files or directories.")
+    parser.add_argument("--top", type=int, default=20, help="Cells to list (default: 20).")
+    parser.add_argument(
+        "--history-out", help="Append sizing history records (JSON lines) to this file."
+    )
+    args = parser.parse_args(argv)
+
+    reports = load_reports(args.paths)
+    if not reports:
+        print("No build-timings.json found", file=sys.stderr)
+        return 1
+    print_report(reports, args.top)
+
+    if args.history_out:
+        with open(args.history_out, "a", encoding="utf-8") as f:
+            for report in reports:
+                f.write(json.dumps(history_record(report), sort_keys=True) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+Trigger CircleCI pipelines for many spec repositories at once.
+
+    CIRCLE_TOKEN=... ./trigger_pipelines.py repos.txt
+    ./trigger_pipelines.py repos.txt --param build_dists=fc44 --concurrency 16 --rate 10
+    ls -d /rpm/*-rpm | xargs -n1 basename | ./trigger_pipelines.py -
+
+The repository list has one `repo`, `org/repo` or `org/repo@branch` per
+line (`#` comments allowed); bare names belong to --org. Each gets a
+POST /api/v2/project/gh/<org>/<repo>/pipeline with the --param pipeline
+parameters (e.g. the cell-scoped build_dists of settings.yml
+`cell_parameters: true`).
+
+Requests go out from --concurrency worker threads, each keeping one
+keep-alive connection, and are paced by a token bucket (--rate per second,
+--burst at once). 429 and 5xx answers, and requests that never went out
+(connecting or sending failed), are retried with exponential backoff,
+honouring Retry-After; other errors fail the repo. A request that went out
+but got no answer (connection lost while waiting, a gateway timeout) may
+well have started a pipeline, so it isn't POSTed again: the repo's outcome
+is "unknown", to be checked on CircleCI.
+
+With --journal FILE every outcome is appended to FILE (JSON lines), and a
+rerun with the same file, branch and parameters skips the repos already
+triggered or unknown, so an interrupted or partially failed run is resumed
+by running it again (--force ignores the journal). Use one journal per bulk
+run, e.g. named after the change being rolled out. --base-url points the
+client elsewhere, e.g. at a local stub server.
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+# Answers worth retrying: rate limited, or the API having a bad moment
+retry_statuses = {429, 500, 502, 503}
+# Answers after which the pipeline may or may not exist: the gateway gave up
+# waiting for the API, which may still have created it
+unknown_statuses = {504}
+
+# Seconds a kept-alive connection may sit idle before it's replaced: the
+# server (or a load balancer) may have closed it meanwhile, and a request
+# sent on it would then have to be given up as "unknown"
+keep_alive_idle = 15.0
+
+
+class RequestNotSent(Exception):
+    """Connecting or sending failed: the API never got the request."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `burst` saved up."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class PipelineClient:
+    """POSTs pipelines over one keep-alive connection per thread."""
+
+    def __init__(self, base_url, token, timeout=30):
+        url = urlsplit(base_url)
+        self.connection_class = (
+            http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        )
+        self.netloc = url.netloc
+        self.path_prefix = url.path.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None and time.monotonic() - self.local.used > keep_alive_idle:
+            self.close()
+            connection = None
+        if connection is None:
+            connection = self.connection_class(self.netloc, timeout=self.timeout)
+            self.local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def trigger(self, slug, body):
+        """(HTTP status, response headers, parsed JSON body) of one trigger request.
+
+        Raises RequestNotSent when the request didn't go out, OSError or
+        HTTPException when it did but its answer was lost.
+        """
+        path = f"{self.path_prefix}/api/v2/project/{quote(slug)}/pipeline"
+        headers = {
+            "Circle-Token": self.token,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        connection = self.connection()
+        try:
+            if connection.sock is None:
+                connection.connect()
+            connection.request("POST", path, body=json.dumps(body), headers=headers)
+        except (OSError, http.client.HTTPException) as exc:
+            self.close()
+            raise RequestNotSent(f"{type(exc).__name__}: {exc}") from exc
+        try:
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            # The next request reconnects
+            self.close()
+            raise
+        finally:
+            self.local.used = time.monotonic()
+        if response.getheader("Connection", "").lower() == "close":
+            self.close()
+        try:
+            payload = json.loads(data) if data else {}
+        except ValueError:
+            payload = {"message": data.decode("utf-8", "replace")}
+        return response.status, response.headers, payload
+
+
+def retry_delay(attempt, headers=None, backoff=1.0, max_delay=60.0):
+    """Seconds to wait before retry number `attempt` (1-based).
+
+    Retry-After (in seconds) wins; otherwise exponential backoff with full
+    jitter, so throttled workers don't come back in lockstep.
+    """
+    retry_after = headers.get("Retry-After") if headers is not None else None
+    if retry_after:
+        try:
+            return min(max_delay, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return random.uniform(0, min(max_delay, backoff * 2 ** (attempt - 1)))
+
+
+def parse_repos(lines, org):
+    """[(slug, branch or None)] of a repository list, in order, without duplicates."""
+    repos = []
+    seen = set()
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        repo, _, branch = line.partition("@")
+        if "/" not in repo:
+            repo = f"{org}/{repo}"
+        entry = (f"gh/{repo}", branch or None)
+        if entry not in seen:
+            seen.add(entry)
+            repos.append(entry)
+    return repos
+
+
+def request_key(branch, parameters):
+    """Identifies a trigger request in the journal: same key, same pipeline."""
+    return hashlib.sha256(
+        json.dumps([branch, parameters], sort_keys=True).encode("utf-8")
+    ).hexdigest()[:16]
+
+
+def load_journal(journal_file):
+    """{(slug, key): status} of the requests the journal records as triggered or unknown."""
+    done = {}
+    try:
+        with open(journal_file, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    continue
+                status = record.get("status")
+                if status in ("triggered", "unknown"):
+                    # triggered wins over an earlier unknown
+                    if done.get((record["repo"], record["key"])) != "triggered":
+                        done[(record["repo"], record["key"])] = status
+    except FileNotFoundError:
+        pass
+    return done
+
+
+class Journal:
+    """Appends one JSON line per outcome, flushed right away."""
+
+    def __init__(self, journal_file):
+        self.lock = threading.Lock()
+        self.file = None
+        if journal_file:
+            os.makedirs(os.path.dirname(os.path.abspath(journal_file)), exist_ok=True)
+            self.file = open(journal_file, "a", encoding="utf-8")
+
+    def record(self, **record):
+        if self.file is None:
+            return
+        with self.lock:
+            self.file.write(json.dumps(record, sort_keys=True) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def trigger_one(client, bucket, slug, branch, parameters, retries, backoff):
+    """Trigger one pipeline, retrying transient failures; returns an outcome dict."""
+    body = {}
+    if branch:
+        body["branch"] = branch
+    if parameters:
+        body["parameters"] = parameters
+    attempt = 0
+    while True:
+        attempt += 1
+        bucket.acquire()
+        headers = None
+        try:
+            status, headers, payload = client.trigger(slug, body)
+        except RequestNotSent as exc:
+            status, payload = None, {"message": str(exc)}
+        except (OSError, http.client.HTTPException) as exc:
+            # Sent, but no answer: POSTing again could start a second pipeline
+            return {
+                "status": "unknown",
+                "http": None,
+                "attempts": attempt,
+                "message": f"{type(exc).__name__}: {exc}",
+            }
+        if status in unknown_statuses:
+            return {
+                "status": "unknown",
+                "http": status,
+                "attempts": attempt,
+                "message": payload.get("message"),
+            }
+        if status is not None and 200 <= status < 300:
+            return {
+                "status": "triggered",
+                "http": status,
+                "attempts": attempt,
+                "number": payload.get("number"),
+                "id": payload.get("id"),
+            }
+        if (status is None or status in retry_statuses) and attempt <= retries:
+            time.sleep(retry_delay(attempt, headers, backoff))
+            continue
+        return {
+            "status": "failed",
+            "http": status,
+            "attempts": attempt,
+            "message": payload.get("message"),
+        }
+
+
+def trigger_all(
+    repos,
+    parameters=None,
+    base_url="https://circleci.com",
+    token="",
+    concurrency=8,
+    rate=5.0,
+    burst=None,
+    retries=5,
+    backoff=1.0,
+    journal_file=None,
+    force=False,
+    report=print,
+):
+    """Trigger a pipeline for each (slug, branch) of `repos`.
+
+    Returns {(slug, branch): outcome}; repos the journal already has as
+    triggered or unknown (same branch and parameters) get {"status":
+    "skipped", "journal": <that status>}.
+    """
+    parameters = parameters or {}
+    done = {} if force or not journal_file else load_journal(journal_file)
+    client = PipelineClient(base_url, token)
+    bucket = TokenBucket(rate, burst or max(1, concurrency))
+    journal = Journal(journal_file)
+    report_lock = threading.Lock()
+    outcomes = {}
+
+    def work(entry):
+        slug, branch = entry
+        key = request_key(branch, parameters)
+        if (slug, key) in done:
+            outcome = {"status": "skipped", "journal": done[(slug, key)]}
+        else:
+            outcome = trigger_one(client, bucket, slug, branch, parameters, retries, backoff)
+            journal.record(repo=slug, key=key, branch=branch, at=time.time(), **outcome)
+        with report_lock:
+            report(format_outcome(slug, outcome))
+        return entry, outcome
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = dict(pool.map(work, repos))
+    finally:
+        journal.close()
+    return outcomes
+
+
+def format_outcome(slug, outcome):
+    if outcome["status"] == "triggered":
+        return f"triggered {slug}: pipeline #{outcome.get('number')}"
+    if outcome["status"] == "skipped":
+        if outcome.get("journal") == "unknown":
+            return f"skipped {slug}: outcome unknown (journal), check CircleCI or use --force"
+        return f"skipped {slug}: already triggered (journal)"
+    if outcome["status"] == "unknown":
+        return (
+            f"UNKNOWN {slug}: HTTP {outcome.get('http') or '-'} on attempt "
+            f"{outcome.get('attempts')}: {outcome.get('message')}; not retried, "
+            f"check CircleCI"
+        )
+    return (
+        f"FAILED {slug}: HTTP {outcome.get('http') or '-'} after "
+        f"{outcome.get('attempts')} attempts: {outcome.get('message')}"
+    )
+
+
+def parse_parameter(value):
+    """(name, value) of NAME=VALUE or NAME:=JSON.
+
+    NAME=VALUE is always a string (build_dists=8 stays "8"); NAME:=JSON is
+    for CircleCI's boolean and integer parameter types (run_tests:=false,
+    jobs:=4).
+    """
+    name, sep, raw = value.partition("=")
+    if not sep or not name.rstrip(":"):
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE or NAME:=JSON, got {value!r}")
+    if not name.endswith(":"):
+        return name, raw
+    try:
+        parsed = json.loads(raw)
+    except ValueError:
+        parsed = None
+    if not isinstance(parsed, (bool, int, str)):
+        raise argparse.ArgumentTypeError(
+            f"expected a JSON boolean, integer or string after {name}=, got {raw!r}"
+        )
+    return name[:-1], parsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Trigger CircleCI pipelines in bulk.")
+    parser.add_argument("repos", help="Repository list file ('-' for stdin).")
+    parser.add_argument(
+        "--param",
+        action="append",
+        type=parse_parameter,
+        default=[],
+        metavar="NAME=VALUE",
+        help="Pipeline parameter (repeatable), e.g. build_dists=fc44; NAME:=JSON for "
+        "boolean and integer parameters.",
+    )
+    parser.add_argument("--branch", help="Branch to build (default: the project's default).")
+    parser.add_argument("--org", default="GetPageSpeed", help="Org of bare repo names.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight.")
+    parser.add_argument("--rate", type=float, default=5.0, help="Requests per second.")
+    parser.add_argument("--burst", type=int, help="Token bucket size (default: --concurrency).")
+    parser.add_argument("--retries", type=int, default=5, help="Retries per repo on 429/5xx.")
+    parser.add_argument(
+        "--backoff", type=float, default=1.0, help="Base of the exponential backoff, seconds."
+    )
+    parser.add_argument(
+        "--base-url", default="https://circleci.com", help="API base URL (e.g. a local stub)."
+    )
+    parser.add_argument(
+        "--journal",
+        help="JSON lines journal of this run's outcomes; a rerun with it resumes the run.",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Trigger repos the journal has as done too."
+    )
+    args = parser.parse_args(argv)
+
+    token = os.environ.get("CIRCLE_TOKEN")
+    if not token:
+        parser.error("CIRCLE_TOKEN is not set")
+    if args.repos == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.repos, "r") as f:
+            lines = f.readlines()
+    repos = [
+        (slug, branch or args.branch) for slug, branch in parse_repos(lines, args.org)
+    ]
+    if not repos:
+        print("No repositories to trigger", file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    outcomes = trigger_all(
+        repos,
+        parameters=dict(args.param),
+        base_url=args.base_url,
+        token=token,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        burst=args.burst,
+        retries=args.retries,
+        backoff=args.backoff,
+        journal_file=args.journal,
+        force=args.force,
+    )
+    counts = {}
+    for outcome in outcomes.values():
+        counts[outcome["status"]] = counts.get(outcome["status"], 0) + 1
+    print(
+        f"{len(outcomes)} repos in {time.perf_counter() - start:.1f}s: "
+        + ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    )
+    return 1 if counts.get("failed") or counts.get("unknown") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())